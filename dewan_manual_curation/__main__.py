@@ -1,7 +1,33 @@
 import os
 os.environ['ISX'] = '0'
 
-from dewan_manual_curation import manual_curation
+# Only QtWidgets is imported up front so the splash screen can go up before everything else loads
+from PySide6.QtCore import Qt
+from PySide6.QtGui import QPixmap, QColor, QPainter, QFont
+from PySide6.QtWidgets import QApplication, QSplashScreen
+
+
+def _make_splash():
+    pixmap = QPixmap(420, 140)
+    pixmap.fill(QColor(32, 33, 36))
+
+    painter = QPainter(pixmap)
+    painter.setPen(QColor(Qt.GlobalColor.white))
+    painter.setFont(QFont("Arial", 16, QFont.Weight.Bold))
+    painter.drawText(pixmap.rect(), Qt.AlignmentFlag.AlignCenter, 'Dewan Manual Curation')
+    painter.end()
+
+    splash = QSplashScreen(pixmap)
+    splash.showMessage('Starting...', Qt.AlignmentFlag.AlignBottom | Qt.AlignmentFlag.AlignHCenter,
+                       Qt.GlobalColor.white)
+    return splash
+
 
 if __name__ == '__main__':
-    manual_curation.launch_gui()
+    app = QApplication([])
+    splash = _make_splash()
+    splash.show()
+    app.processEvents()
+
+    from dewan_manual_curation import manual_curation
+    manual_curation.launch_gui(splash=splash)
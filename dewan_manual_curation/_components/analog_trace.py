@@ -1,28 +1,40 @@
 """ CellTrace class for displaying calcium transient data """
 
+import hashlib
+
 import numpy as np
 import pandas as pd
 
-import matplotlib as mpl
 from matplotlib.pyplot import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
 
+from PySide6.QtCore import Qt, QBuffer, QByteArray, QIODevice, QSize
+from PySide6.QtGui import QImage
 from PySide6.QtWidgets import QSizePolicy
-from sklearn.preprocessing import MinMaxScaler
-
 
-# Let's set the default font to be Arial Bold 14pt
-mpl.rcParams['font.family'] = 'arial'
-mpl.rcParams['font.weight'] = 'bold'
-mpl.rcParams['font.size'] = 14
+from . import painter_renderer
+from . import trace_plotting  # Also sets up the matplotlib rcParams
+from .envelope_pyramid import EnvelopePyramid
+from .instrumentation import stage
+from .normalization import normalize_traces, scale_values
+from .trace_store import TraceStore
 
 LICK_SIZE = 20
 PRE_FV_TIME = -2000
 MAX_POST_FV_TIME = 2000
+CELL_TRACE_SIZE = QSize(1000, 110)
+SNIFF_TRACE_SIZE = QSize(1000, 250)
+DEFAULT_DPI = 100
+# 'matplotlib' plots every row on a figure (publication quality, and can use the render engine's process pool);
+# 'qpainter' draws the same visuals straight onto a QImage on the GUI thread, which is much quicker per row
+RENDER_BACKENDS = ('matplotlib', 'qpainter')
+DEFAULT_RENDER_BACKEND = 'matplotlib'
+RENDER_VERSION = 1  # Bump whenever a backend's output changes, so cached thumbnails from older versions aren't reused
 
 class AnalogTrace(FigureCanvasQTAgg):
-    def __init__(self, parent=None, width=30, height=1.1, dpi=100, figure_min_max=(0, 1), reference_line=False,
-                 reference_line_color='r', sniff_trace: bool=False):
+    def __init__(self, parent=None, width=30, height=1.1, dpi=DEFAULT_DPI, figure_min_max=(0, 1),
+                 reference_line=False, reference_line_color='r', sniff_trace: bool=False):
         self.parent = parent
         self.dpi = dpi
         self.sniff_trace = sniff_trace
@@ -50,10 +62,11 @@ class AnalogTrace(FigureCanvasQTAgg):
         else:
             sub_name = f'Cell: {self.trace_name}'
 
-        ymin_label = round(trace_data.min(), 4)  # We want the original max/min to display alongside the z-scored data
-        ymax_label = round(trace_data.max(), 4)
+        data_2_plot, trace_min, trace_max, trace_mean = normalize_traces(trace_data, self.figure_min_max)
+        data_2_plot = data_2_plot[0]
 
-        data_2_plot = self._scale_data(trace_data, self.figure_min_max)
+        ymin_label = round(float(trace_min[0]), 4)  # We want the original max/min to display alongside the scaled data
+        ymax_label = round(float(trace_max[0]), 4)
 
         if x_timestamps is None:
             x_values = np.arange(len(data_2_plot))  # Quicker than list(range(x))
@@ -68,38 +81,66 @@ class AnalogTrace(FigureCanvasQTAgg):
         xaxis_offset = largest_x * 0.01
         x_minlim = -xaxis_offset
         x_maxlim = largest_x + xaxis_offset
-        self.axes.set_ylim([0, 1])  # y-values will always be [0, 1]
 
-        if self.reference_line:
-            y_line_val = np.mean(data_2_plot)
-            self.axes.hlines(y=y_line_val, xmin=x_minlim, xmax=x_maxlim,
-                             linestyles=(0, (5, 10)), colors=self.reference_line_color)
+        if x_timestamps is not None:
+            x_minlim, x_maxlim = PRE_FV_TIME, MAX_POST_FV_TIME
 
-        if x_timestamps is None:
-            self.axes.tick_params(axis='both', which='both', left=False, bottom=False)
-            self.axes.set_xticks([], labels=[])
-            self.axes.set_xlim([-xaxis_offset, (x_values[-1] + xaxis_offset)])
-        else:
-            self.axes.tick_params(axis='both', which='both', left=False, bottom=True)
-            self.axes.set_xlim([PRE_FV_TIME, MAX_POST_FV_TIME])
+        y_line_val = trace_plotting.scale_to_range(trace_mean[0], trace_min[0], trace_max[0], self.figure_min_max)
+        self._format_axes(sub_name, ymin_label, ymax_label, y_line_val, (x_minlim, x_maxlim),
+                          show_x_ticks=x_timestamps is not None)
 
-        self.axes.set_yticks([0, 1], labels=[ymin_label, ymax_label])
 
-        self.axes.get_yaxis().set_label_coords(-0.1, 0.5)  # Align all the things
-        self.axes.yaxis.tick_right()
+    def plot_envelope(self, x_values, lows, highs, cell_name, trace_min, trace_max, trace_mean, x_window,
+                      line_width=0.5):
+        self.trace_name = cell_name
+        trace_plotting.plot_envelope(self.axes, x_values, lows, highs, cell_name, trace_min, trace_max, trace_mean,
+                                     x_window, self.figure_min_max, self.reference_line, self.reference_line_color,
+                                     line_width)
+        self._set_trace_sizing()  # Reset sizing after plotting
+
 
-        self.axes.set_ylabel(f'{sub_name}', rotation=0, va='center', ha='center')
+    def _format_axes(self, sub_name, ymin_label, ymax_label, y_line_val, x_limits, show_x_ticks):
+        if not self.reference_line:
+            y_line_val = None
 
+        trace_plotting.format_axes(self.axes, sub_name, ymin_label, ymax_label, x_limits, show_x_ticks, y_line_val,
+                                   self.reference_line_color)
         self._set_trace_sizing()  # Reset sizing after plotting
 
 
     def plot_sniff_trace(self, trace_data, lick_data, cell_name, timestamps):
         self.plot_trace(trace_data, cell_name, x_timestamps=timestamps, line_width=1.0)
-        self.axes.vlines(x=lick_data, ymin=.8, ymax=1, linewidth=1.2, color='red')
+        trace_plotting.plot_licks(self.axes, lick_data)
         self.axes.vlines(x=0, ymin=0, ymax=1, color='cyan', linewidth=3.0)
         self._set_trace_sizing()  # Reset sizing after plotting
 
 
+    def plot_sniff_trial(self, time_values, sniff_data, lick_times, trial_name, trial_min, trial_max):
+        self.trace_name = trial_name
+        trace_plotting.plot_sniff(self.axes, time_values, sniff_data, lick_times, trial_name, trial_min, trial_max,
+                                  (PRE_FV_TIME, MAX_POST_FV_TIME))
+        self._set_trace_sizing()  # Reset sizing after plotting
+
+
+    def to_image(self, size: QSize) -> QImage:
+        # Render the figure off-screen at the requested pixel size and hand back a copy of the Agg buffer. Drawn on a
+        # throwaway canvas, so the full size buffer is freed straight away rather than kept with every trace
+        self.figure.set_size_inches(size.width() / self.dpi, size.height() / self.dpi)
+        canvas = FigureCanvasAgg(self.figure)
+        canvas.draw()
+        width, height = canvas.get_width_height(physical=True)
+        image = QImage(canvas.buffer_rgba(), width, height, QImage.Format.Format_RGBA8888).copy()
+        self.figure.set_canvas(self)
+
+        return image
+
+
+    def close_figure(self):
+        # Drops the artists; to_image never leaves an Agg buffer behind, so that's all a throwaway trace holds on to.
+        # A closed trace isn't drawn again -- plot a new AnalogTrace instead
+        self.figure.clear()
+
+
     def _set_trace_sizing(self):
         width, height = self.get_width_height()
         self.resize(width/3, height)
@@ -107,43 +148,298 @@ class AnalogTrace(FigureCanvasQTAgg):
 
 
     @staticmethod
-    def _scale_data(trace_data: pd.Series, feature_range: tuple):
+    def generate_cell_traces(cell_trace_data, cell_names, backend=DEFAULT_RENDER_BACKEND, low_memory=False):
+        # Nothing is plotted here; the trace panel renders rows from the matrix as they scroll into view.
+        # cell_trace_data is a preprocessed DataFrame or a TraceStore, whose rows are used in place
+        with stage('trace_generation'):
+            if isinstance(cell_trace_data, TraceStore):
+                return TraceMatrix(cell_names, cell_trace_data.rows(cell_names), backend=backend,
+                                   row_stats=cell_trace_data.row_stats(cell_names))
+
+            trace_matrix = cell_trace_data[cell_names].to_numpy().T
+            return TraceMatrix(cell_names, trace_matrix, backend=backend, low_memory=low_memory)
+
+    @staticmethod
+    def generate_sniff_matrix(trial_names, h5_file, filtered_traces=None):
+        # Nothing is plotted here either; pass the matrix straight to launch_sniff_gui
+        return SniffTrialMatrix.from_h5(trial_names, h5_file, filtered_traces)
 
-        _min, _max = feature_range
+    @staticmethod
+    def generate_sniff_traces(trial_names, h5_file, filtered_traces=None):
+        # Plots every trial up front; generate_sniff_matrix is much quicker to open for a whole session
+        sniff_matrix = SniffTrialMatrix.from_h5(trial_names, h5_file, filtered_traces)
 
-        scaler = MinMaxScaler(feature_range=(_min, _max))
-        scaled_data = scaler.fit_transform(trace_data.reshape(-1, 1)).ravel()
+        all_sniff_traces = []
+        for row in range(len(sniff_matrix)):
+            _sniff_trace = AnalogTrace(height=2.5, sniff_trace=True, reference_line=False)
+            _sniff_trace.plot_sniff_trial(**sniff_matrix.plot_kwargs(row))
+            all_sniff_traces.append(_sniff_trace)
 
-        return scaled_data
+        return all_sniff_traces
 
 
-    @staticmethod
-    def generate_cell_traces(cell_trace_data, cell_names):
-        cell_traces = []
-        for cell in cell_names:
-            data = cell_trace_data[cell].values
-            _cell_trace = AnalogTrace(reference_line=True)
-            _cell_trace.plot_trace(data, cell)
-            cell_traces.append(_cell_trace)
+class TraceMatrix:
+    """
+    Cells x time trace data backing the trace panel; AnalogTraces are only plotted when a row is drawn. low_memory
+    skips the cached envelope levels, so the float32 matrix is all a row costs (see EnvelopePyramid).
+    row_stats, each row's (min, max, mean) worked out beforehand, leaves trace_data as it is -- unscaled and
+    uncopied, e.g. rows of a TraceStore's memmap -- and each envelope is scaled as it's drawn instead (no levels are
+    cached either).
+    """
+    def __init__(self, cell_names, trace_data, reference_line=True, backend=DEFAULT_RENDER_BACKEND, low_memory=False,
+                 row_stats=None):
+        self.cells = list(cell_names)
+        self.reference_line = reference_line
+        self.backend = _check_backend(backend)
 
-        return cell_traces
+        if row_stats is None:
+            # Scaled once for the whole session; the pyramid and every rendered row reuse these arrays
+            self.scaled_data, self.trace_min, self.trace_max, self.trace_mean = \
+                normalize_traces(np.asarray(trace_data))
+            self.pyramid = EnvelopePyramid(self.scaled_data, cache_levels=not low_memory)
+        else:
+            self.scaled_data = None
+            self.trace_min, self.trace_max, self.trace_mean = row_stats
+            self.pyramid = EnvelopePyramid(trace_data, cache_levels=False)
+
+        self.n_samples = self.pyramid.n_samples
+        self.row_digests = [None] * len(self.cells)  # Content hashes for thumbnail_key, filled in as rows are drawn
+
+    def __len__(self):
+        return len(self.cells)
+
+    @property
+    def nbytes(self):
+        # Unscaled rows are only referenced (a memmap's live in the page cache, not in this process's heap)
+        return 0 if self.scaled_data is None else self.pyramid.nbytes
+
+    def size_hint(self, row):
+        return CELL_TRACE_SIZE
+
+    def render(self, row, size: QSize, time_window=None, backend=None) -> QImage:
+        plot_kwargs = self.plot_kwargs(row, size, time_window)
+
+        if (backend or self.backend) == 'qpainter':
+            return painter_renderer.paint_envelope(size, reference_line=self.reference_line, dpi=DEFAULT_DPI,
+                                                   **plot_kwargs)
+
+        _cell_trace = AnalogTrace(reference_line=self.reference_line)
+        _cell_trace.plot_envelope(**plot_kwargs)
+        image = _cell_trace.to_image(size)
+        _cell_trace.close_figure()
+
+        return image
+
+    def render_job(self, key, row, size: QSize, time_window=None):
+        # Only the envelope slice for this row at screen resolution is sent to the worker, not the whole trace
+        plot_kwargs = self.plot_kwargs(row, size, time_window)
+        plot_kwargs['reference_line'] = self.reference_line
+
+        return key, size.width(), size.height(), DEFAULT_DPI, plot_kwargs
+
+    def plot_kwargs(self, row, size: QSize, time_window=None):
+        if time_window is None:
+            time_window = (0, self.n_samples)
+
+        start, stop = time_window
+        x_values, lows, highs = self.pyramid.envelope(row, start, stop, size.width())
+        if self.scaled_data is None:
+            lows = scale_values(lows, self.trace_min[row], self.trace_max[row])
+            highs = lows if highs is lows else scale_values(highs, self.trace_min[row], self.trace_max[row])
+
+        return dict(x_values=x_values, lows=lows, highs=highs, cell_name=self.cells[row],
+                    trace_min=self.trace_min[row], trace_max=self.trace_max[row], trace_mean=self.trace_mean[row],
+                    x_window=time_window)
+
+    def thumbnail_key(self, row, size: QSize, time_window=None, backend=None):
+        """
+        Names a rendered row by what it shows rather than where it came from: the row's data and every parameter that
+        changes the pixels. Re-curating a session only misses for the rows whose traces actually changed.
+        """
+        if self.row_digests[row] is None:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(str(self.cells[row]).encode())
+            digest.update(np.ascontiguousarray(self.pyramid.trace_data[row]).tobytes())
+            digest.update(np.array([self.trace_min[row], self.trace_max[row], self.trace_mean[row]],
+                                   dtype=np.float64).tobytes())
+            self.row_digests[row] = digest.digest()
+
+        render_params = (size.width(), size.height(), time_window or (0, self.n_samples), backend or self.backend,
+                         self.reference_line, DEFAULT_DPI, RENDER_VERSION)
+        key = hashlib.blake2b(self.row_digests[row], digest_size=20)
+        key.update(repr(render_params).encode())
+
+        return key.hexdigest()
+
+
+class StreamingTraceMatrix:
+    """
+    Trace panel source for a session that is still loading. Every cell has a row from the start; rows are backed by
+    TraceMatrix chunks as they arrive and paint as placeholders until then.
+    """
+    def __init__(self, cell_names, reference_line=True, backend=DEFAULT_RENDER_BACKEND):
+        self.cells = list(cell_names)
+        self.reference_line = reference_line
+        self.backend = _check_backend(backend)  # Applies to every chunk, whatever backend it was made with
+        self.row_chunks = [None] * len(self.cells)  # (TraceMatrix, row within it) once the row has arrived
+        self.n_samples = None  # Unknown until the first chunk arrives
+
+    def __len__(self):
+        return len(self.cells)
+
+    def add_chunk(self, first_row, trace_matrix: TraceMatrix):
+        for i in range(len(trace_matrix)):
+            self.row_chunks[first_row + i] = (trace_matrix, i)
+        self.n_samples = trace_matrix.n_samples
+
+    def is_ready(self, row):
+        return self.row_chunks[row] is not None
+
+    def size_hint(self, row):
+        return CELL_TRACE_SIZE
+
+    def render(self, row, size: QSize, time_window=None) -> QImage:
+        trace_matrix, chunk_row = self.row_chunks[row]
+        return trace_matrix.render(chunk_row, size, time_window, self.backend)
+
+    def render_job(self, key, row, size: QSize, time_window=None):
+        trace_matrix, chunk_row = self.row_chunks[row]
+        return trace_matrix.render_job(key, chunk_row, size, time_window)
+
+    def plot_kwargs(self, row, size: QSize, time_window=None):
+        trace_matrix, chunk_row = self.row_chunks[row]
+        return trace_matrix.plot_kwargs(chunk_row, size, time_window)
+
+    def thumbnail_key(self, row, size: QSize, time_window=None):
+        trace_matrix, chunk_row = self.row_chunks[row]
+        return trace_matrix.thumbnail_key(chunk_row, size, time_window, self.backend)
+
+
+class SniffTrialMatrix:
+    """
+    Trials x time sniff data aligned to final valve (FV) onset on one shared time grid, with each trial's lick times
+    kept as a ragged array (lick_times[lick_offsets[i]:lick_offsets[i + 1]] belong to trial i). Samples outside
+    PRE_FV_TIME..MAX_POST_FV_TIME are never displayed, so they are dropped; trials that don't cover the whole grid are
+    padded with NaN. Backs the trace panel directly, plotting a trial only when its row is drawn.
+    """
+    def __init__(self, trial_names, time_values, sniff_data, lick_times, lick_offsets):
+        self.cells = list(trial_names)  # The trace panel and cell lists call every row a cell
+        self.time_values = np.asarray(time_values)
+        self.lick_times = np.asarray(lick_times, dtype=np.float64)
+        self.lick_offsets = np.asarray(lick_offsets, dtype=np.int64)
+        self.scaled_data, self.trial_min, self.trial_max, _ = normalize_traces(sniff_data)
+        self.n_samples = None  # Trials are always shown over the whole FV window, so there's no time axis to zoom
+
+    @classmethod
+    def from_h5(cls, trial_names, h5_file, filtered_traces=None):
+        """
+        Reads each trial's sniff (or filtered sniff) Series and lick times once, then aligns every trial in a single
+        vectorized scatter onto a grid with the median sample spacing
+        """
+        sniff_source = h5_file.sniff if filtered_traces is None else filtered_traces
+        trial_names = list(trial_names)
+
+        trial_series = [sniff_source[name] for name in trial_names]
+        trial_licks = [np.asarray(h5_file.lick1[name], dtype=np.float64).ravel() for name in trial_names]
+
+        trial_lengths = np.array([len(series) for series in trial_series])
+        timestamps = np.concatenate([series.index.to_numpy(dtype=np.float64) for series in trial_series])
+        values = np.concatenate([series.to_numpy(dtype=np.float32) for series in trial_series])
+        trial_rows = np.repeat(np.arange(len(trial_names)), trial_lengths)
+
+        # Sample spacing from within trials only; the steps between one trial and the next are meaningless
+        time_steps = np.diff(timestamps)[trial_rows[1:] == trial_rows[:-1]]
+        time_step = float(np.median(time_steps)) if len(time_steps) else 1.0
+
+        grid_start = max(np.floor(timestamps.min() / time_step) * time_step, PRE_FV_TIME)
+        grid_stop = min(timestamps.max(), MAX_POST_FV_TIME)
+        n_columns = int(np.floor((grid_stop - grid_start) / time_step)) + 1
+        time_values = grid_start + np.arange(n_columns) * time_step
+
+        columns = np.rint((timestamps - grid_start) / time_step).astype(np.int64)
+        on_grid = (columns >= 0) & (columns < n_columns)
+
+        sniff_data = np.full((len(trial_names), n_columns), np.nan, dtype=np.float32)
+        sniff_data[trial_rows[on_grid], columns[on_grid]] = values[on_grid]
+
+        lick_offsets = np.concatenate(([0], np.cumsum([len(licks) for licks in trial_licks])))
+        lick_times = np.concatenate(trial_licks) if trial_licks else np.empty(0)
+
+        return cls(trial_names, time_values, sniff_data, lick_times, lick_offsets)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def licks(self, row):
+        return self.lick_times[self.lick_offsets[row]:self.lick_offsets[row + 1]]
+
+    def size_hint(self, row):
+        return SNIFF_TRACE_SIZE
+
+    def plot_kwargs(self, row):
+        return dict(time_values=self.time_values, sniff_data=self.scaled_data[row], lick_times=self.licks(row),
+                    trial_name=self.cells[row], trial_min=self.trial_min[row], trial_max=self.trial_max[row])
+
+    def render(self, row, size: QSize, time_window=None) -> QImage:
+        _sniff_trace = AnalogTrace(height=2.5, sniff_trace=True, reference_line=False)
+        _sniff_trace.plot_sniff_trial(**self.plot_kwargs(row))
+        image = _sniff_trace.to_image(size)
+        _sniff_trace.close_figure()
+
+        return image
+
+
+class PlottedTraces:
+    """
+    Wraps a list of already plotted AnalogTraces (e.g. sniff traces) so they can back the trace panel. Each one keeps
+    a full size Agg buffer and its line data; with compress, every trace is rendered once at its size hint into a PNG
+    and its figure is cleared, so all that's left per row is the compressed image.
+    """
+    def __init__(self, traces: list[AnalogTrace], compress=False):
+        self.traces = traces
+        self.cells = [trace.trace_name for trace in traces]
+        self.n_samples = None  # Already plotted, so there is no shared time axis to zoom
+        self.sizes = [self._trace_size(trace) for trace in traces]
+        self.compressed = None
+
+        if compress:
+            self.compressed = [self._compress(trace, size) for trace, size in zip(traces, self.sizes)]
+            self.traces = None
+
+    def __len__(self):
+        return len(self.cells)
+
+    def size_hint(self, row):
+        return self.sizes[row]
+
+    def render(self, row, size: QSize, time_window=None) -> QImage:
+        if self.compressed is None:
+            return self.traces[row].to_image(size)
+
+        image = QImage.fromData(self.compressed[row], 'PNG')
+        if image.size() != size:
+            image = image.scaled(size, Qt.AspectRatioMode.IgnoreAspectRatio,
+                                 Qt.TransformationMode.SmoothTransformation)
+        return image
 
     @staticmethod
-    def generate_sniff_traces(trial_names, h5_file, filtered_traces=None):
-        all_sniff_traces = []
+    def _trace_size(trace: AnalogTrace):
+        width, height = trace.get_width_height()
+        return QSize(int(width / 3), height)
 
-        for name in trial_names:
-            if filtered_traces is None:
-                _sniff_data = h5_file.sniff[name]
-            else:
-                _sniff_data = filtered_traces[name]
+    @staticmethod
+    def _compress(trace: AnalogTrace, size: QSize):
+        png_data = QByteArray()
+        buffer = QBuffer(png_data)
+        buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+        trace.to_image(size).save(buffer, 'PNG')
+        buffer.close()
 
-            sniff_data = _sniff_data.values
-            timestamps = _sniff_data.index.values
-            lick_data = h5_file.lick1[name]
+        trace.close_figure()
+        return bytes(png_data)
 
-            _sniff_trace = AnalogTrace(height=2.5, sniff_trace=True, reference_line=False)
-            _sniff_trace.plot_sniff_trace(sniff_data, lick_data, name, timestamps)
-            all_sniff_traces.append(_sniff_trace)
 
-        return all_sniff_traces
+def _check_backend(backend):
+    if backend not in RENDER_BACKENDS:
+        raise ValueError(f'Unknown render backend "{backend}"; expected one of {RENDER_BACKENDS}')
+    return backend
@@ -3,79 +3,160 @@
 from PySide6.QtCore import Qt
 from PySide6 import QtWidgets
 
-UNCHECKED = Qt.CheckState.Unchecked
-CHECKED = Qt.CheckState.Checked
+from .funcs import CORRELATED_PAIRS_SORT
+from .instrumentation import track_interaction
 
 
 class GuiCallbacks:
 
     def select_none(self):
-        for checkbox in self.cell_selection_checkbox_list:
-            checkbox.setCheckState(UNCHECKED)
+        track_interaction('select_none')
+        self.cell_selection_model.set_all(False)
 
     def select_all(self):
-        for checkbox in self.cell_selection_checkbox_list:
-            checkbox.setCheckState(CHECKED)
+        track_interaction('select_all')
+        self.cell_selection_model.set_all(True)
 
     def export_cells(self):
-        for checkbox in self.cell_selection_checkbox_list:
-            if checkbox.checkState() is CHECKED:
-                self.curated_cells.append(checkbox.text())
+        self.curated_cells.extend(str(cell) for cell in self.cell_selection_model.checked_cells())
         self.accept()
 
     def view_all(self):
+        track_interaction('view_all')
         self.change_view_checkboxes(True)
-        for trace in self.trace_pointers:
-            trace.setHidden(False)
+        self._refresh_trace_visibility()
 
         if self.max_projection is not None:
             self.max_projection.reset_polygon_colors()
 
     def view_none(self):
+        track_interaction('view_none')
         self.change_view_checkboxes(False)
-        for trace in self.trace_pointers:
-            trace.setHidden(True)
+        self._refresh_trace_visibility()
         if self.max_projection is not None:
             self.max_projection.reset_polygon_colors()
 
     def transfer_view(self):
+        track_interaction('transfer_view')
         modifiers = QtWidgets.QApplication.keyboardModifiers()
 
-        for i, checkbox in enumerate(self.cell_view_checkbox_list):
-            selection_checkbox = self.cell_selection_checkbox_list[i]
-            view_checkbox_state = checkbox.checkState()
+        view_checked = self.cell_view_model.checked
+        if modifiers == Qt.KeyboardModifier.ControlModifier:
+            view_checked = ~view_checked
 
-            if modifiers == Qt.KeyboardModifier.ControlModifier:
-                if view_checkbox_state == CHECKED:
-                    view_checkbox_state = UNCHECKED
-                else:
-                    view_checkbox_state = CHECKED
+        self.cell_selection_model.set_checked(view_checked)
 
-            selection_checkbox.setCheckState(view_checkbox_state)
+    def on_view_checks_changed(self, rows, checked):
+        # rows are indices into self.cells, which are also the trace rows
+        trace_visible = self.trace_visible.copy()
+        # Filtered-out cells stay hidden until the filter lets them through
+        trace_visible[rows] = self.filter_passes[rows] if checked else False
+        self._set_trace_visibility(trace_visible)
 
+        if self.max_projection is not None:
+            outline_state = 1 if checked else 0
+            for row in rows:
+                self.max_projection.change_outline_color(self.cells[row], outline_state)
+
+    def on_cell_clicked(self, cell):
+        track_interaction('cell_click')
+        row = self.cell_view_model.cell_rows[cell]
+        self.cell_view_model.set_rows_checked([row], not self.cell_view_model.checked[row])
+
+    def on_cell_hovered(self, cell):
+        if cell is None:
+            return
+
+        trace = self.trace_pointers_dict[cell]
+        if self.trace_visible[trace.row]:
+            if self._stacked_view_active():
+                self.stacked_trace_view.scroll_to_row(trace.row)
+            else:
+                trace.scroll_into_view()
+
+        view_index = self.cell_view_model.view_index(self.cell_view_model.cell_rows[cell])
+        if view_index.isValid():
+            self.cell_view_list.scrollTo(view_index)
+
+    def on_cells_lassoed(self, cells):
+        track_interaction('lasso')
+        # Lassoed cells are shown; holding Ctrl while releasing the lasso hides them instead
+        modifiers = QtWidgets.QApplication.keyboardModifiers()
+        checked = not modifiers & Qt.KeyboardModifier.ControlModifier
 
-    def on_checkbox_release(self, checkbox):
-        cell_key = checkbox.text()
-        check_state = checkbox.checkState()
+        rows = [self.cell_view_model.cell_rows[cell] for cell in cells]
+        self.cell_view_model.set_rows_checked(rows, checked)
 
-        outline_state = []
+    def add_cell_traces(self, first_row, trace_matrix):
+        first_chunk = self.cell_trace_model.n_samples() is None
+        self.cell_trace_model.add_traces(first_row, trace_matrix)
+        if self.memory_budget is not None:
+            self._reserve_memory(trace_matrix.nbytes)
 
-        if check_state == CHECKED:
-            self.trace_pointers_dict[cell_key].setHidden(False)
-            outline_state = 1
-        elif check_state == UNCHECKED:
-            self.trace_pointers_dict[cell_key].setHidden(True)
-            outline_state = 0
+        if first_chunk:  # The length of the recording is known now
+            self._configure_time_controls()
 
-        self.max_projection.change_outline_color(cell_key, outline_state)
+    def set_cell_metrics(self, cell_metrics):
+        """ cell_metrics is a DataFrame indexed by cell name; enables sorting/filtering both lists and the traces """
+        self.cell_metrics = cell_metrics
+        self._populate_metric_controls()
 
-    def change_view_checkboxes(self, checked=False):
-        check_state = Qt.CheckState.Unchecked
-        if checked:
-            check_state = Qt.CheckState.Checked
+    def set_correlated_pairs(self, correlated_pairs):
+        """ correlated_pairs is a DataFrame from correlation.find_correlated_pairs, strongest pair first """
+        self.correlated_pairs = correlated_pairs
+        self._set_pair_partners()
 
-        for checkbox in self.cell_view_checkbox_list:
-            checkbox.setCheckState(check_state)
+        if self.max_projection is not None:
+            self.max_projection.flag_pairs(correlated_pairs[['cell_a', 'cell_b', 'r']].itertuples(index=False))
+
+        if len(correlated_pairs) > 0:
+            self.sort_metric_box.addItem(f'Correlated pairs ({len(correlated_pairs)})', CORRELATED_PAIRS_SORT)
+            self.sort_metric_box.setEnabled(True)
+
+    def apply_metric_view(self):
+        track_interaction('metric_view')
+        if self.cell_metrics is None and self.correlated_pairs is None:
+            return
+
+        cell_order, passes = self._metric_order_and_mask()
+        self.filter_passes = passes
+
+        self._relabel_cell_lists(cell_order, passes)
+        self.cell_trace_model.set_row_order(cell_order)
+        self._refresh_trace_visibility()
+
+    def set_stacked_view(self, stacked):
+        track_interaction('stacked_view_toggle')
+        if stacked:
+            self.stacked_trace_view.set_visible_rows(self.trace_visible)
+        else:  # The list view's rows weren't touched while stacked
+            self._sync_trace_list()
+
+        self.cell_trace_scroll_area.setVisible(not stacked)
+        self.stacked_trace_view.setVisible(stacked)
+
+    def show_load_progress(self, done, total, message):
+        self.load_progress_bar.show()
+        self.cancel_load_button.show()
+        self.load_progress_bar.setRange(0, total)
+        self.load_progress_bar.setValue(done)
+        self.load_progress_bar.setFormat(message)
+
+    def finish_loading(self):
+        self.load_progress_bar.hide()
+        self.cancel_load_button.hide()
+
+    def load_failed(self, message):
+        self.load_progress_bar.setFormat(f'Loading failed: {message}')
+
+    def show_warning(self, message):
+        # Kept on screen under the traces; earlier warnings stay above the newest one
+        text = self.status_label.text()
+        self.status_label.setText(f'{text}\n{message}' if text else message)
+        self.status_label.show()
+
+    def change_view_checkboxes(self, checked=False):
+        self.cell_view_model.set_all(checked)
 
     def reset_image_zoom(self):
         self.scale = 1
@@ -86,3 +167,37 @@ class GuiCallbacks:
 
     def zoom_image_out(self):
         self._zoom_image(-1)
+
+    def adjust_image_levels(self, _value=None):
+        track_interaction('image_levels')
+        # Mid-drag updates only map a preview; releasing the slider (or any other change) renders the full image
+        dragging = any(slider.isSliderDown() for slider in (self.black_level_slider, self.white_level_slider,
+                                                             self.gamma_slider))
+        self.max_projection.set_levels(self.black_level_slider.value(), self.white_level_slider.value(),
+                                       self._slider_gamma(), preview=dragging)
+
+    def auto_contrast(self):
+        track_interaction('auto_contrast')
+        self.max_projection.clip_levels(self.clip_percent_box.value())
+        self._sync_contrast_controls()
+
+    def reset_contrast(self):
+        track_interaction('reset_contrast')
+        self.max_projection.reset_levels()
+        self._sync_contrast_controls()
+
+    def zoom_time_in(self):
+        track_interaction('time_zoom')
+        self._zoom_time(0.5)
+
+    def zoom_time_out(self):
+        track_interaction('time_zoom')
+        self._zoom_time(2)
+
+    def reset_time_zoom(self):
+        track_interaction('time_zoom')
+        self._zoom_time(None)
+
+    def pan_time(self, start):
+        track_interaction('time_pan')
+        self.cell_trace_model.set_time_window(start, start + self.time_window_length)
@@ -0,0 +1,127 @@
+""" Checkable cell list model; the selection and view lists keep their check state as a mask instead of widgets """
+import numpy as np
+
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex, Signal
+
+from .instrumentation import track_interaction
+
+CELL_ROLE = Qt.ItemDataRole.UserRole  # The cell name itself; the label can also show a metric
+
+
+class CellCheckListModel(QAbstractListModel):
+    """
+    One checkable row per cell, backed by the boolean mask in checked (indexed by source row, i.e. position in cells).
+    Bulk changes are a single mask assignment and one dataChanged. checks_changed(source rows, checked) fires for boxes
+    ticked in the view and for set_rows_checked; whole-mask changes (set_all/set_checked) don't, so the caller can
+    refresh whatever depends on the mask once.
+    """
+    checks_changed = Signal(object, bool)
+
+    def __init__(self, cells, parent=None):
+        super().__init__(parent)
+        self.cells = list(cells)
+        self.cell_rows = {cell: i for i, cell in enumerate(self.cells)}
+        self.checked = np.ones(len(self.cells), dtype=bool)
+        self.labels = None  # One string per source row; None shows the cell names
+        self.tooltips = None
+        # Source rows in display order, minus any a filter hid, and the reverse lookup (-1 for hidden rows)
+        self.display_rows = np.arange(len(self.cells))
+        self.view_rows = np.arange(len(self.cells))
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.display_rows)
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemFlag.NoItemFlags
+        return Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsUserCheckable
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+
+        row = self.source_row(index.row())
+
+        if role == Qt.ItemDataRole.DisplayRole:
+            return str(self.cells[row]) if self.labels is None else self.labels[row]
+        elif role == Qt.ItemDataRole.CheckStateRole:
+            return Qt.CheckState.Checked if self.checked[row] else Qt.CheckState.Unchecked
+        elif role == Qt.ItemDataRole.ToolTipRole and self.tooltips is not None:
+            return self.tooltips[row]
+        elif role == CELL_ROLE:
+            return self.cells[row]
+
+        return None
+
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        if not index.isValid() or role != Qt.ItemDataRole.CheckStateRole:
+            return False
+
+        track_interaction('check_toggle')
+        checked = Qt.CheckState(value) == Qt.CheckState.Checked
+        self.set_rows_checked([self.source_row(index.row())], checked)
+        return True
+
+    def source_row(self, row):
+        return int(self.display_rows[row])
+
+    def view_index(self, source_row):
+        """ The row's index in the list, or an invalid index if a filter hid it """
+        row = self.view_rows[source_row]
+        return QModelIndex() if row < 0 else self.index(int(row))
+
+    def checked_cells(self):
+        """ Checked cells in session order """
+        return [self.cells[row] for row in np.flatnonzero(self.checked)]
+
+    def set_rows_checked(self, rows, checked: bool):
+        rows = np.asarray(rows, dtype=np.int64)
+        self.checked[rows] = checked
+        self._emit_changed(rows, [Qt.ItemDataRole.CheckStateRole])
+        self.checks_changed.emit(rows, checked)
+
+    def set_all(self, checked: bool):
+        self.checked[:] = checked
+        self._emit_changed(None, [Qt.ItemDataRole.CheckStateRole])
+
+    def set_checked(self, checked):
+        self.checked = np.array(checked, dtype=bool)
+        self._emit_changed(None, [Qt.ItemDataRole.CheckStateRole])
+
+    def set_labels(self, labels):
+        self.labels = labels
+        self._emit_changed(None, [Qt.ItemDataRole.DisplayRole])
+
+    def set_tooltips(self, tooltips):
+        self.tooltips = tooltips
+
+    def set_display(self, row_order, shown):
+        """ row_order lists source rows in display order (None for session order); shown masks the rows a filter keeps """
+        self.layoutAboutToBeChanged.emit()
+
+        old_source_rows = [self.source_row(index.row()) for index in self.persistentIndexList()]
+
+        order = np.arange(len(self.cells)) if row_order is None else np.asarray(row_order, dtype=np.int64)
+        self.display_rows = order[np.asarray(shown, dtype=bool)[order]]
+        self.view_rows = np.full(len(self.cells), -1, dtype=np.int64)
+        self.view_rows[self.display_rows] = np.arange(len(self.display_rows))
+
+        # Keeps the view's current item and selection on the same cells, or drops them if they were filtered out
+        self.changePersistentIndexList(self.persistentIndexList(),
+                                       [self.view_index(row) for row in old_source_rows])
+        self.layoutChanged.emit()
+
+    def _emit_changed(self, rows, roles):
+        if len(self.display_rows) == 0:
+            return
+
+        if rows is not None and len(rows) == 1:
+            index = self.view_index(rows[0])
+            if index.isValid():
+                self.dataChanged.emit(index, index, roles)
+            return
+
+        # One signal for everything; the view only repaints the rows that are on screen
+        self.dataChanged.emit(self.index(0), self.index(len(self.display_rows) - 1), roles)
@@ -0,0 +1,102 @@
+""" Ragged-array storage and vectorized geometry for cell contours """
+import numpy as np
+
+
+class ContourStore:
+    """
+    Every cell outline packed into one (n_vertices, 2) coordinate array plus an (n_cells + 1) offsets array, where
+    cell i's outline is coordinates[offsets[i]:offsets[i + 1]]. Geometry is computed for all cells at once.
+    """
+    def __init__(self, cell_names, coordinates, offsets):
+        self.cells = list(cell_names)
+        self.coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.cell_index = {cell: i for i, cell in enumerate(self.cells)}
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __getitem__(self, cell):
+        # Same layout as a parse_json contour dict entry, so a store can stand in for one
+        return [self.outline(self.cell_index[cell])]
+
+    @classmethod
+    def from_dict(cls, cell_names, cell_contours):
+        """ Packs {cell: [[(x, y), ...]]} (the parse_json format) for the given cells; also subsets another store """
+        if isinstance(cell_contours, ContourStore) and cell_contours.cells == list(cell_names):
+            return cell_contours
+
+        outlines = [np.asarray(cell_contours[cell][0], dtype=np.float64).reshape(-1, 2) for cell in cell_names]
+        lengths = [len(outline) for outline in outlines]
+
+        offsets = np.zeros(len(outlines) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        coordinates = np.concatenate(outlines) if outlines else np.empty((0, 2))
+
+        return cls(cell_names, coordinates, offsets)
+
+    def outline(self, i):
+        return self.coordinates[self.offsets[i]:self.offsets[i + 1]]
+
+    def signed_areas(self):
+        cross, _, _ = self._shoelace_terms()
+        return 0.5 * self._sum_per_cell(cross)
+
+    def areas(self):
+        return np.abs(self.signed_areas())
+
+    def perimeters(self):
+        x = self.coordinates[:, 0]
+        y = self.coordinates[:, 1]
+        next_vertex = self._next_vertex()
+
+        return self._sum_per_cell(np.hypot(x[next_vertex] - x, y[next_vertex] - y))
+
+    def compactness(self):
+        """ 4*pi*area / perimeter**2; 1 for a circle and smaller for elongated or ragged outlines """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 4 * np.pi * self.areas() / np.square(self.perimeters())
+
+    def centroids(self):
+        """ (n_cells, 2) polygon centroids from the shoelace formula, vectorized over every cell """
+        cross, x_sum, y_sum = self._shoelace_terms()
+
+        area = 0.5 * self._sum_per_cell(cross)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            centroid_x = self._sum_per_cell(x_sum * cross) / (6 * area)
+            centroid_y = self._sum_per_cell(y_sum * cross) / (6 * area)
+
+        centroids = np.column_stack((centroid_x, centroid_y))
+
+        degenerate = ~np.isfinite(centroids).all(axis=1) | (area == 0)
+        if degenerate.any():  # Lines/points have no area; fall back to the mean of their vertices
+            vertex_counts = np.maximum(np.diff(self.offsets), 1)[:, np.newaxis]
+            vertex_means = np.column_stack((self._sum_per_cell(self.coordinates[:, 0]),
+                                            self._sum_per_cell(self.coordinates[:, 1]))) / vertex_counts
+            centroids[degenerate] = vertex_means[degenerate]
+
+        return centroids
+
+    def _shoelace_terms(self):
+        x = self.coordinates[:, 0]
+        y = self.coordinates[:, 1]
+        next_vertex = self._next_vertex()
+
+        x_next = x[next_vertex]
+        y_next = y[next_vertex]
+
+        return x * y_next - x_next * y, x + x_next, y + y_next
+
+    def _next_vertex(self):
+        # Index of each vertex's successor, wrapping the last vertex of every outline back to its first
+        next_vertex = np.arange(1, len(self.coordinates) + 1)
+        non_empty = np.diff(self.offsets) > 0
+        next_vertex[self.offsets[1:][non_empty] - 1] = self.offsets[:-1][non_empty]
+
+        return next_vertex
+
+    def _sum_per_cell(self, values):
+        # np.add.reduceat misbehaves on empty segments, so sum via a cumulative sum instead
+        cumulative = np.concatenate(([0.0], np.cumsum(values)))
+        return cumulative[self.offsets[1:]] - cumulative[self.offsets[:-1]]
+
@@ -0,0 +1,168 @@
+""" Blockwise trace correlations for spotting duplicate or split ROIs """
+import numpy as np
+import pandas as pd
+
+DUPLICATE_THRESHOLD = 0.8  # Pearson r above which neighboring ROIs get flagged as a likely duplicate/split
+NEIGHBOR_DIAMETERS = 2  # Neighbor search radius, in median ROI diameters
+BLOCK_BYTES = 64 * 2 ** 20  # float32 working set per block; bounds memory regardless of the number of cells
+PAIR_COLUMNS = ['cell_a', 'cell_b', 'r', 'distance']
+
+
+def find_correlated_pairs(cell_names, trace_matrix, cell_contours, threshold=DUPLICATE_THRESHOLD, radius=None,
+                          all_pairs=False):
+    """
+    Returns a DataFrame (PAIR_COLUMNS) of the cell pairs whose traces correlate at or above threshold, highest r first.
+    Only spatial neighbors (centroids within radius contour units, NEIGHBOR_DIAMETERS median ROI diameters by default)
+    are compared unless all_pairs is set. trace_matrix is cells x time, in the same order as cell_names.
+    """
+    contour_rows = [cell_contours.cell_index[cell] for cell in cell_names]
+    centroids = cell_contours.centroids()[contour_rows]
+
+    if all_pairs:
+        pairs, r = all_pair_correlations(trace_matrix, threshold)
+    else:
+        if radius is None:
+            radius = default_neighbor_radius(cell_contours.areas()[contour_rows])
+        pairs = neighbor_pairs(centroids, radius)
+        r = pair_correlations(trace_matrix, pairs)
+        keep = r >= threshold
+        pairs, r = pairs[keep], r[keep]
+
+    order = np.argsort(-r, kind='stable')
+    pairs, r = pairs[order], r[order]
+    cell_names = np.asarray(cell_names, dtype=object)
+
+    return pd.DataFrame({
+        'cell_a': cell_names[pairs[:, 0]],
+        'cell_b': cell_names[pairs[:, 1]],
+        'r': r,
+        'distance': np.linalg.norm(centroids[pairs[:, 0]] - centroids[pairs[:, 1]], axis=1),
+    }, columns=PAIR_COLUMNS)
+
+
+def default_neighbor_radius(areas):
+    median_diameter = 2 * np.sqrt(np.nanmedian(areas) / np.pi)
+    return NEIGHBOR_DIAMETERS * median_diameter if np.isfinite(median_diameter) else 0.0
+
+
+def neighbor_pairs(centroids, radius):
+    """
+    (n_pairs, 2) index pairs (i < j) of centroids no more than radius apart. Points are bucketed into a uniform grid
+    of radius-sized bins, so each point is only compared with points in its own and the neighboring bins.
+    """
+    centroids = np.asarray(centroids, dtype=np.float64)
+    valid = np.flatnonzero(np.isfinite(centroids).all(axis=1))
+    if len(valid) < 2 or radius <= 0:
+        return np.empty((0, 2), dtype=np.int64)
+
+    points = centroids[valid]
+    bins = np.floor(points / radius).astype(np.int64)
+    bins -= bins.min(axis=0)
+    bins[:, 1] += 1  # Leaves an empty bin either side of every column so a y offset of -1/+1 never wraps around
+    n_rows = bins[:, 1].max() + 2
+    keys = bins[:, 0] * n_rows + bins[:, 1]
+
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    found = []
+    for dx, dy in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):  # Half the neighborhood, so every pair turns up once
+        target_keys = keys + dx * n_rows + dy
+        starts = np.searchsorted(sorted_keys, target_keys, side='left')
+        counts = np.searchsorted(sorted_keys, target_keys, side='right') - starts
+
+        first = np.repeat(np.arange(len(points)), counts)
+        within_bin = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        second = order[np.repeat(starts, counts) + within_bin]
+
+        if (dx, dy) == (0, 0):  # Same bin; drop self pairs and the mirrored copy of each pair
+            same_bin = first < second
+            first, second = first[same_bin], second[same_bin]
+
+        close = np.linalg.norm(points[first] - points[second], axis=1) <= radius
+        found.append(np.column_stack((first[close], second[close])))
+
+    pairs = valid[np.concatenate(found)]
+    pairs.sort(axis=1)
+
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
+def pair_correlations(trace_matrix, pairs):
+    """ Pearson r of each (i, j) row pair of trace_matrix, computed in float32 a bounded block of pairs at a time """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    r = np.empty(len(pairs), dtype=np.float32)
+    if len(pairs) == 0:
+        return r
+
+    # A block of pairs touches at most twice as many rows; each of them is standardized once per block
+    pairs_per_block = _block_rows(trace_matrix, copies=2)
+    for start in range(0, len(pairs), pairs_per_block):
+        block = pairs[start:start + pairs_per_block]
+        block_rows, block_pairs = np.unique(block, return_inverse=True)
+        block_pairs = block_pairs.reshape(-1, 2)
+
+        standardized = standardize(trace_matrix[block_rows])
+        r[start:start + pairs_per_block] = np.einsum('ij,ij->i', standardized[block_pairs[:, 0]],
+                                                     standardized[block_pairs[:, 1]])
+
+    return np.clip(r, -1, 1, out=r)
+
+
+def all_pair_correlations(trace_matrix, threshold=None, block_size=None):
+    """
+    Every pair's Pearson r from blockwise float32 matrix products over standardized rows, one pair of row blocks at a
+    time, so memory stays at two blocks no matter how many cells there are. Returns ((n_pairs, 2) index pairs with
+    i < j, r); only pairs at or above threshold are kept when one is given.
+    """
+    n_cells = len(trace_matrix)
+    if block_size is None:
+        block_size = _block_rows(trace_matrix, copies=2)
+
+    found_pairs = []
+    found_r = []
+
+    for first_start in range(0, n_cells, block_size):
+        first_block = standardize(trace_matrix[first_start:first_start + block_size])
+
+        for second_start in range(first_start, n_cells, block_size):
+            if second_start == first_start:
+                second_block = first_block
+            else:
+                second_block = standardize(trace_matrix[second_start:second_start + block_size])
+
+            block_r = first_block @ second_block.T
+            rows, columns = np.nonzero(_keep_mask(block_r, threshold, same_block=second_start == first_start))
+
+            found_pairs.append(np.column_stack((rows + first_start, columns + second_start)))
+            found_r.append(block_r[rows, columns])
+
+    if not found_pairs:
+        return np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    return np.concatenate(found_pairs), np.clip(np.concatenate(found_r), -1, 1)
+
+
+def standardize(trace_block):
+    """ Rows centered and scaled to unit length in float32, so the dot product of two rows is their Pearson r """
+    block = np.array(trace_block, dtype=np.float32)
+    block -= np.nanmean(block, axis=1, dtype=np.float64)[:, np.newaxis].astype(np.float32)
+    np.nan_to_num(block, copy=False)  # Missing samples count as the mean
+
+    norms = np.sqrt(np.einsum('ij,ij->i', block, block, dtype=np.float64)).astype(np.float32)
+    norms[norms == 0] = np.inf  # Flat traces correlate with nothing
+    block /= norms[:, np.newaxis]
+
+    return block
+
+
+def _keep_mask(block_r, threshold, same_block):
+    keep = np.ones(block_r.shape, dtype=bool) if threshold is None else block_r >= threshold
+    if same_block:  # The diagonal block is symmetric; only take what's above the diagonal
+        keep &= np.triu(np.ones(block_r.shape, dtype=bool), k=1)
+    return keep
+
+
+def _block_rows(trace_matrix, copies):
+    n_samples = max(np.shape(trace_matrix)[1], 1)
+    return int(np.clip(BLOCK_BYTES // (copies * n_samples * 4), 16, 4096))
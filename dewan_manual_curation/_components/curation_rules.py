@@ -0,0 +1,67 @@
+""" Declarative keep/reject rules applied to the per-cell metrics table """
+import json
+
+import numpy as np
+
+RULE_SECTIONS = ('reject_if_any', 'keep_if_all')
+
+
+def load_rules(rules_path):
+    with open(rules_path) as rules_file:
+        return json.load(rules_file)
+
+
+def classify_cells(metrics, rules: dict):
+    """
+    Splits the cells in metrics into (keep, reject, ambiguous) name lists. rules looks like
+
+        {"reject_if_any": {"snr": {"max": 2}, "area": {"max": 15}},
+         "keep_if_all": {"snr": {"min": 5}, "skewness": {"min": 0.5}}}
+
+    where each condition is an inclusive min and/or max on a metrics column. A cell is rejected if any reject condition
+    holds, kept if every keep condition holds (and it wasn't rejected) and ambiguous otherwise. A NaN never satisfies
+    a condition, so cells that can't be measured end up ambiguous rather than silently kept or rejected. With no keep
+    conditions nothing is kept automatically, e.g.
+
+        {"reject_if_any": {"snr": {"max": 2}}}
+
+    only weeds out the obvious rejects and leaves every other cell ambiguous, to be reviewed in the GUI.
+    """
+    unknown_sections = set(rules) - set(RULE_SECTIONS)
+    if unknown_sections:
+        raise ValueError(f'Unknown rule sections {sorted(unknown_sections)}; expected {RULE_SECTIONS}')
+
+    reject_conditions = _evaluate_conditions(metrics, rules.get('reject_if_any', {}))
+    keep_conditions = _evaluate_conditions(metrics, rules.get('keep_if_all', {}))
+
+    reject = reject_conditions.any(axis=0)
+    if len(keep_conditions):
+        keep = keep_conditions.all(axis=0) & ~reject
+    else:  # all() over no conditions would keep every cell that wasn't rejected
+        keep = np.zeros(len(metrics), dtype=bool)
+    ambiguous = ~(keep | reject)
+
+    cell_names = metrics.index.to_numpy()
+    return cell_names[keep].tolist(), cell_names[reject].tolist(), cell_names[ambiguous].tolist()
+
+
+def _evaluate_conditions(metrics, conditions: dict):
+    # (n_conditions, n_cells) boolean matrix, one row per condition
+    results = np.ones((len(conditions), len(metrics)), dtype=bool)
+
+    for i, (metric, bounds) in enumerate(conditions.items()):
+        if metric not in metrics:
+            raise ValueError(f'Unknown metric "{metric}"; available metrics are {list(metrics.columns)}')
+
+        unknown_bounds = set(bounds) - {'min', 'max'}
+        if unknown_bounds:
+            raise ValueError(f'Conditions on "{metric}" can only have a min and/or max, got {sorted(unknown_bounds)}')
+
+        values = metrics[metric].to_numpy(dtype=np.float64)
+        results[i] = ~np.isnan(values)
+        if 'min' in bounds:
+            results[i] &= values >= bounds['min']
+        if 'max' in bounds:
+            results[i] &= values <= bounds['max']
+
+    return results
@@ -0,0 +1,85 @@
+""" Multi-resolution min/max envelopes for drawing long traces at screen resolution """
+import numpy as np
+
+LEVEL_FACTOR = 4  # Each level bins LEVEL_FACTOR samples of the level below it
+MIN_LEVEL_SAMPLES = 256  # Stop decimating once a level is this short; nobody draws traces narrower than this
+
+
+class EnvelopePyramid:
+    def __init__(self, trace_data: np.ndarray, cache_levels=True):
+        """
+        With cache_levels off nothing but trace_data is kept, and each envelope is binned from its row's raw samples
+        when asked for; slower per row, but the levels no longer cost another two thirds of the matrix
+        """
+        self.trace_data = trace_data  # Level 0 is the cells x time matrix itself, no copy is made
+        self.n_samples = trace_data.shape[1]
+        self.cache_levels = cache_levels
+
+        self.levels = []  # (lows, highs) for level 1..n, where level k bins LEVEL_FACTOR**k samples
+        self.n_levels = 0
+        if cache_levels:
+            self._build_levels()
+        else:
+            n_samples = self.n_samples
+            while n_samples > MIN_LEVEL_SAMPLES:
+                n_samples = -(-n_samples // LEVEL_FACTOR)
+                self.n_levels += 1
+
+    @property
+    def nbytes(self):
+        return self.trace_data.nbytes + sum(lows.nbytes + highs.nbytes for lows, highs in self.levels)
+
+    def envelope(self, row, start, stop, n_pixels):
+        """
+        Returns x positions (in samples) and the low/high envelope for samples [start, stop) of one trace, taken from
+        the coarsest level that still has at least one bin per pixel. At level 0 lows and highs are the raw samples.
+        """
+        level = self._pick_level(stop - start, n_pixels)
+
+        if level == 0:
+            samples = self.trace_data[row, start:stop]
+            return np.arange(start, stop), samples, samples
+
+        bin_size = LEVEL_FACTOR ** level
+        first_bin = start // bin_size
+        # Ceiling division so the final partial bin is included
+        last_bin = min(-(-stop // bin_size), -(-self.n_samples // bin_size))
+        x_values = np.arange(first_bin, last_bin) * bin_size
+
+        if not self.cache_levels:
+            samples = self.trace_data[row, first_bin * bin_size:last_bin * bin_size]
+            bin_starts = np.arange(0, len(samples), bin_size)
+            return (x_values, np.minimum.reduceat(samples, bin_starts).astype(np.float32),
+                    np.maximum.reduceat(samples, bin_starts).astype(np.float32))
+
+        lows, highs = self.levels[level - 1]
+        return x_values, lows[row, first_bin:last_bin], highs[row, first_bin:last_bin]
+
+    def _pick_level(self, n_window_samples, n_pixels):
+        level = 0
+        while level < self.n_levels and n_window_samples / LEVEL_FACTOR ** (level + 1) >= n_pixels:
+            level += 1
+
+        return level
+
+    def _build_levels(self):
+        lows = highs = self.trace_data
+
+        while lows.shape[1] > MIN_LEVEL_SAMPLES:
+            lows = self._decimate(lows, np.minimum)
+            highs = self._decimate(highs, np.maximum)
+            self.levels.append((lows, highs))
+
+        self.n_levels = len(self.levels)
+
+    @staticmethod
+    def _decimate(level_data, reducer):
+        n_cells, n_samples = level_data.shape
+        remainder = n_samples % LEVEL_FACTOR
+
+        if remainder:  # Pad the last bin with its final sample so it reduces like the others
+            padding = np.repeat(level_data[:, -1:], LEVEL_FACTOR - remainder, axis=1)
+            level_data = np.concatenate([level_data, padding], axis=1)
+
+        binned = level_data.reshape(n_cells, -1, LEVEL_FACTOR)
+        return reducer.reduce(binned, axis=2).astype(np.float32)
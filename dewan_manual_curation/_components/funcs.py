@@ -1,36 +1,71 @@
 """ Parent Class for ManualCurationUI to provide general GUI function """
 
 
-from PySide6.QtCore import Qt, QSize
-from PySide6.QtWidgets import QCheckBox, QListWidgetItem, QGraphicsView, QSizePolicy
-from functools import partial
+from PySide6.QtCore import Qt
+from PySide6.QtWidgets import QGraphicsView, QSizePolicy
+
+import numpy as np
+
+from .analog_trace import PlottedTraces
+from .cell_list_model import CellCheckListModel
+from .render_engine import TraceRenderEngine
+from .stacked_traces import StackedTraceView
+from .trace_model import TraceListModel, TraceDelegate, TraceRow
+
+
+MIN_TIME_WINDOW = 100  # Samples; zooming in any further than this isn't useful
+CORRELATED_PAIRS_SORT = 'correlated_pairs'  # Sort option that puts flagged pairs next to each other
+DEFAULT_CLIP_PERCENT = 0.35  # Auto contrast clips this much at each end of the max projection's histogram
+GAMMA_SLIDER_STEPS = 100  # Gamma slider positions per factor of 10; the slider spans 0.1 to 10
 
 
 # noinspection PyUnresolvedReferences
 class GuiFuncs:
     def _populate_selection_list(self):
-        for each in self.cells:
-            selection_CB = QCheckBox(str(each))
-            selection_CB.setCheckState(Qt.CheckState.Checked)
-            self.cell_selection_checkbox_list.append(selection_CB)
-            self.cell_select_checkbox_layout.addWidget(selection_CB)
+        self.cell_selection_model = CellCheckListModel(self.cells, self)
+        self.cell_list.setModel(self.cell_selection_model)
 
     def _populate_view_list(self):
-        for each in self.cells:
-            view_CB = QCheckBox(str(each))
-            view_CB.setCheckState(Qt.CheckState.Checked)
-            view_CB.released.connect(partial(self.on_checkbox_release, view_CB))
-            # Pass a reference of each checkbox to the click callback
-            self.cell_view_checkbox_list.append(view_CB)
-            self.cell_view_checkbox_layout.addWidget(view_CB)
+        self.cell_view_model = CellCheckListModel(self.cells, self)
+        self.cell_view_model.checks_changed.connect(self.on_view_checks_changed)
+        self.cell_view_list.setModel(self.cell_view_model)
+        self.filter_passes = np.ones(len(self.cells), dtype=bool)
 
     def _populate_cell_traces(self):
-        for each in self.cell_traces:
-            each.installEventFilter(self)
-            _list_widget = QListWidgetItem()
-            _list_widget.setSizeHint(QSize(each.width() / 3, each.height()))
-            self.cell_trace_scroll_area.addItem(_list_widget)
-            self.cell_trace_scroll_area.setItemWidget(_list_widget, each)
+        trace_source = self.cell_traces
+        if isinstance(trace_source, list):  # Pre-plotted AnalogTraces (sniff GUI)
+            trace_source = PlottedTraces(trace_source, compress=self.memory_budget is not None)
+        if self.memory_budget is not None and hasattr(trace_source, 'nbytes'):  # Streamed sources reserve per chunk
+            self._reserve_memory(trace_source.nbytes)
+
+        # QPainter rows are quick enough to draw on the GUI thread, and the worker processes only have matplotlib
+        if self.render_workers and getattr(trace_source, 'backend', None) != 'qpainter':
+            self.render_engine = TraceRenderEngine(self.render_workers, self)
+
+        self.cell_trace_model = TraceListModel(trace_source, self.render_engine, self, self.thumbnail_cache)
+        self.cell_trace_delegate = TraceDelegate(self.cell_trace_scroll_area, memory_budget=self.memory_budget)
+        self.cell_trace_model.row_ready.connect(self.cell_trace_delegate.add_pixmap)
+        self.cell_trace_scroll_area.setModel(self.cell_trace_model)
+        self.cell_trace_scroll_area.setItemDelegate(self.cell_trace_delegate)
+
+        n_rows = self.cell_trace_model.rowCount()
+        self.trace_visible = np.ones(n_rows, dtype=bool)
+        self.trace_list_hidden = np.zeros(n_rows, dtype=bool)
+
+        if hasattr(trace_source, 'render_job'):  # Stacking needs the trace data itself, not pre-plotted figures
+            self.stacked_trace_view = StackedTraceView(self.cell_trace_model)
+            self.stacked_trace_view.setSizePolicy(QSizePolicy.Policy.MinimumExpanding,
+                                                  QSizePolicy.Policy.MinimumExpanding)
+            self.stacked_trace_view.viewport().installEventFilter(self)
+            self.stacked_trace_view.hide()
+            trace_list_index = self.cell_trace_view_layout.indexOf(self.cell_trace_scroll_area)
+            self.cell_trace_view_layout.insertWidget(trace_list_index + 1, self.stacked_trace_view)
+            self.stacked_view_button.setEnabled(True)
+
+    def _reserve_memory(self, n_bytes):
+        warning = self.memory_budget.reserve(n_bytes)
+        if warning is not None:
+            self.show_warning(warning)
 
     def _zoom_image(self, steps: int):
         if steps != self.direction:
@@ -40,9 +75,162 @@ class GuiFuncs:
         self.scale += (self.scale_factor * steps)
         self.max_projection_view.scale(self.scale, self.scale)
 
+    def _zoom_time(self, factor):
+        n_samples = self.cell_trace_model.n_samples()
+        if n_samples is None:
+            return
+
+        start, stop = self.cell_trace_model.time_window or (0, n_samples)
+        center = (start + stop) // 2
+
+        if factor is None:  # Reset to the whole recording
+            new_length = n_samples
+        else:
+            new_length = int(np.clip(self.time_window_length * factor, min(MIN_TIME_WINDOW, n_samples), n_samples))
+
+        new_start = int(np.clip(center - new_length // 2, 0, n_samples - new_length))
+        self.time_window_length = new_length
+        self._update_time_scroll_bar(new_start)
+        self.cell_trace_model.set_time_window(new_start, new_start + new_length)
+
+    def _update_time_scroll_bar(self, start):
+        n_samples = self.cell_trace_model.n_samples()
+
+        self.time_scroll_bar.blockSignals(True)  # Moving the bar here shouldn't re-trigger pan_time
+        self.time_scroll_bar.setRange(0, n_samples - self.time_window_length)
+        self.time_scroll_bar.setPageStep(self.time_window_length)
+        self.time_scroll_bar.setSingleStep(max(self.time_window_length // 20, 1))
+        self.time_scroll_bar.setValue(start)
+        self.time_scroll_bar.blockSignals(False)
+
+    def _configure_time_controls(self):
+        n_samples = self.cell_trace_model.n_samples()
+
+        # Pre-plotted traces can't be re-windowed, and streaming traces can't be until the first chunk arrives
+        for control in (self.time_zoom_in, self.time_zoom_out, self.time_zoom_reset, self.time_scroll_bar):
+            control.setVisible(n_samples is not None)
+
+        if n_samples is None:
+            return
+
+        self.time_window_length = n_samples
+        self._update_time_scroll_bar(0)
+
+    def _enable_metric_controls(self, enabled):
+        for control in (self.sort_metric_box, self.sort_descending_box, self.filter_metric_box, self.filter_min_edit,
+                        self.filter_max_edit):
+            control.setEnabled(enabled)
+
+    def _populate_metric_controls(self):
+        for metric_box in (self.sort_metric_box, self.filter_metric_box):
+            metric_box.blockSignals(True)
+            for metric in self.cell_metrics.columns:
+                metric_box.addItem(metric.replace('_', ' '), metric)
+            metric_box.blockSignals(False)
+
+        tooltips = [self._metric_summary(cell) for cell in self.cells]
+        self.cell_trace_model.set_tooltips(tooltips)
+        self.cell_selection_model.set_tooltips(tooltips)
+        self.cell_view_model.set_tooltips(tooltips)
+
+        self._enable_metric_controls(True)
+
+    def _metric_summary(self, cell):
+        return '\n'.join(f'{metric}: {value:.3g}' for metric, value in self.cell_metrics.loc[cell].items())
+
+    def _metric_order_and_mask(self):
+        """ Display order (indices into self.cells, or None for session order) and which cells pass the filter """
+        sort_metric = self.sort_metric_box.currentData()
+        filter_metric = self.filter_metric_box.currentData()
+
+        cell_order = None
+        if sort_metric == CORRELATED_PAIRS_SORT:
+            cell_order = self._pair_order()
+        elif sort_metric is not None:
+            values = self.cell_metrics[sort_metric].reindex(self.cells).to_numpy(dtype=np.float64)
+            if self.sort_descending_box.isChecked():
+                values = -values
+            cell_order = np.argsort(values, kind='stable')  # NaNs go last either way
+
+        passes = np.ones(len(self.cells), dtype=bool)
+        if filter_metric is not None:
+            values = self.cell_metrics[filter_metric].reindex(self.cells).to_numpy(dtype=np.float64)
+            for bound_edit, compare in ((self.filter_min_edit, np.greater_equal), (self.filter_max_edit, np.less_equal)):
+                bound = self._parse_bound(bound_edit.text())
+                if bound is not None:
+                    passes &= compare(values, bound)  # NaN never passes a bound
+
+        return cell_order, passes
+
+    def _pair_order(self):
+        # Strongest pair first with each cell next to its partner; unpaired cells follow in session order
+        cell_rows = {cell: i for i, cell in enumerate(self.cells)}
+        paired_cells = dict.fromkeys(self.correlated_pairs[['cell_a', 'cell_b']].to_numpy().ravel())
+        paired_rows = [cell_rows[cell] for cell in paired_cells]
+
+        unpaired = np.ones(len(self.cells), dtype=bool)
+        unpaired[paired_rows] = False
+
+        return np.concatenate((np.array(paired_rows, dtype=np.int64), np.flatnonzero(unpaired)))
+
+    def _set_pair_partners(self):
+        self.pair_partners = {}
+        for cell_a, cell_b, r in self.correlated_pairs[['cell_a', 'cell_b', 'r']].itertuples(index=False):
+            self.pair_partners.setdefault(cell_a, (cell_b, r))  # Pairs come strongest first
+            self.pair_partners.setdefault(cell_b, (cell_a, r))
+
+    def _cell_label(self, cell, label_metric):
+        if label_metric is None:
+            return str(cell)
+
+        if label_metric == CORRELATED_PAIRS_SORT:
+            if cell not in self.pair_partners:
+                return str(cell)
+            partner, r = self.pair_partners[cell]
+            return f'{cell}  ~{partner} {r:.2f}'
+
+        return f'{cell}  {self.cell_metrics.at[cell, label_metric]:.3g}'
+
+    @staticmethod
+    def _parse_bound(text):
+        try:
+            return float(text)
+        except ValueError:  # Empty or half-typed; no bound
+            return None
+
+    def _relabel_cell_lists(self, cell_order, passes):
+        label_metric = self.sort_metric_box.currentData() or self.filter_metric_box.currentData()
+        labels = None if label_metric is None else [self._cell_label(cell, label_metric) for cell in self.cells]
+
+        for cell_model in (self.cell_selection_model, self.cell_view_model):
+            cell_model.set_labels(labels)
+            cell_model.set_display(cell_order, passes)
+
+    def _refresh_trace_visibility(self):
+        # A trace is shown when its view box is ticked and the metric filter lets it through
+        self._set_trace_visibility(self.cell_view_model.checked & self.filter_passes)
+
+    def _set_trace_visibility(self, trace_visible):
+        self.trace_visible = trace_visible
+
+        if self._stacked_view_active():  # Re-packs the lanes; no per-row widget updates at all
+            self.stacked_trace_view.set_visible_rows(trace_visible)
+        else:
+            self._sync_trace_list()
+
+    def _sync_trace_list(self):
+        # Only touches the rows whose state actually changed
+        hidden = ~self.trace_visible
+        for row in np.flatnonzero(hidden != self.trace_list_hidden):
+            self.trace_pointers[row].setHidden(bool(hidden[row]))
+        self.trace_list_hidden = hidden
+
+    def _stacked_view_active(self):
+        return self.stacked_trace_view is not None and self.stacked_view_button.isChecked()
+
     def _get_trace_pointers(self):
-        for trace in range(self.cell_trace_scroll_area.count()):
-            _trace = self.cell_trace_scroll_area.item(trace)
+        for trace in range(self.cell_trace_model.rowCount()):
+            _trace = TraceRow(self.cell_trace_scroll_area, trace)
             self.trace_pointers.append(_trace)
 
         self.trace_pointers_dict = dict(list(zip(self.cells, self.trace_pointers)))
@@ -58,6 +246,30 @@ class GuiFuncs:
         self.max_projection_view.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
         self.max_projection_view.viewport().installEventFilter(self)
 
+        self.max_projection.cell_clicked.connect(self.on_cell_clicked)
+        self.max_projection.cell_hovered.connect(self.on_cell_hovered)
+        self.max_projection.cells_lassoed.connect(self.on_cells_lassoed)
+
+        self.gamma_slider.setRange(-GAMMA_SLIDER_STEPS, GAMMA_SLIDER_STEPS)  # log10(gamma) * GAMMA_SLIDER_STEPS
+        self._sync_contrast_controls()
+
+    def _sync_contrast_controls(self):
+        # Moves the contrast controls to wherever the max projection's levels are now, without re-rendering it
+        levels = self.max_projection.levels
+        data_min, data_max = levels.data_range()  # The sliders span the values actually in the image
+
+        for slider, value in ((self.black_level_slider, levels.black), (self.white_level_slider, levels.white),
+                              (self.gamma_slider, round(np.log10(levels.gamma) * GAMMA_SLIDER_STEPS))):
+            slider.blockSignals(True)
+            if slider is not self.gamma_slider:
+                slider.setRange(data_min, data_max)
+                slider.setPageStep(max((data_max - data_min) // 20, 1))
+            slider.setValue(value)
+            slider.blockSignals(False)
+
+    def _slider_gamma(self):
+        return 10 ** (self.gamma_slider.value() / GAMMA_SLIDER_STEPS)
+
     def _init_window_params(self):
         self.setWindowTitle('Dewan Manual Curation')
         self.setSizePolicy(QSizePolicy.Minimum, QSizePolicy.Minimum)
@@ -0,0 +1,119 @@
+""" High-bit-depth max projection: the raw uint16 pixels, their histogram and cached 8-bit display lookup tables """
+import math
+from collections import OrderedDict
+
+import numpy as np
+from PySide6.QtGui import QImage
+
+N_LEVELS = 2 ** 16
+LUT_CACHE_SIZE = 32  # 64 KB each; enough to drag a control back and forth without rebuilding any
+PREVIEW_PIXELS = 2 ** 20  # Pixels mapped per update while a control is being dragged; ~3 ms, well inside a frame
+MIN_GAMMA = 0.01
+
+
+class ImageLevels:
+    """
+    A grayscale image kept at its full 16-bit depth, with its histogram worked out once up front. The display
+    settings (black point, white point, gamma) become a lookup table from every 16-bit value to an 8-bit one, cached
+    per setting, so changing them is a single table lookup over the pixels; nothing is reloaded. While a control is
+    being dragged, render(preview=True) maps a decimated copy of at most PREVIEW_PIXELS instead of the whole image.
+    """
+    def __init__(self, pixels: np.ndarray):
+        self.pixels = pixels
+        self.histogram = np.bincount(pixels.ravel(), minlength=N_LEVELS)
+        self.cumulative_histogram = np.cumsum(self.histogram)
+
+        self.black, self.white = self.data_range()
+        self.gamma = 1.0
+        self.lut_cache = OrderedDict()
+
+        # Every preview_step-th pixel each way; the preview is drawn preview_step times larger to cover the same area
+        self.preview_step = max(math.ceil(math.sqrt(pixels.size / PREVIEW_PIXELS)), 1)
+        self.preview_pixels = None  # Made the first time it's needed
+
+    @classmethod
+    def load(cls, image_path):
+        """ Reads image_path at 16 bits; 8-bit and RGB images are converted, spreading them over the 16-bit range """
+        image = QImage(str(image_path))
+        if image.isNull():  # Unreadable; shows as an empty image, as a bare QImage would have
+            return cls(np.zeros((0, 0), dtype=np.uint16))
+
+        if image.format() != QImage.Format.Format_Grayscale16:
+            image = image.convertToFormat(QImage.Format.Format_Grayscale16)
+
+        rows = np.frombuffer(image.constBits(), dtype=np.uint16).reshape(image.height(), image.bytesPerLine() // 2)
+        return cls(rows[:, :image.width()].copy())  # Drops the row padding and no longer needs the QImage
+
+    def data_range(self):
+        """ The darkest and brightest values in the image """
+        return self.percentile(0), self.percentile(100)
+
+    def percentile(self, percent):
+        """ The smallest value at least percent of the pixels are at or below, from the cached histogram """
+        n_pixels = self.cumulative_histogram[-1]
+        if n_pixels == 0:
+            return 0
+
+        value = np.searchsorted(self.cumulative_histogram, max(percent / 100 * n_pixels, 1))
+        return int(min(value, N_LEVELS - 1))
+
+    def set_levels(self, black=None, white=None, gamma=None):
+        """ Anything left as None keeps its current setting; gamma above 1 brightens the midtones """
+        if black is not None:
+            self.black = int(black)
+        if white is not None:
+            self.white = int(white)
+        if gamma is not None:
+            self.gamma = max(float(gamma), MIN_GAMMA)
+
+    def clip(self, percent):
+        """ Stretches the image so percent of the pixels are clipped to black and percent to white """
+        self.black, self.white = self.percentile(percent), self.percentile(100 - percent)
+
+    def reset(self):
+        self.black, self.white = self.data_range()
+        self.gamma = 1.0
+
+    def lut(self):
+        key = (self.black, self.white, self.gamma)
+        if key in self.lut_cache:
+            self.lut_cache.move_to_end(key)
+            return self.lut_cache[key]
+
+        # A black point above the white point just thresholds at the black point
+        scaled = (np.arange(N_LEVELS, dtype=np.float64) - self.black) / max(self.white - self.black, 1)
+        np.clip(scaled, 0, 1, out=scaled)
+        if self.gamma != 1:
+            np.power(scaled, 1 / self.gamma, out=scaled)
+        lut = np.rint(scaled * 255).astype(np.uint8)
+
+        self.lut_cache[key] = lut
+        if len(self.lut_cache) > LUT_CACHE_SIZE:
+            self.lut_cache.popitem(last=False)
+
+        return lut
+
+    def render(self, preview=False) -> QImage:
+        """ A new 8-bit QImage of the image (or its preview) with the current settings applied """
+        pixels = self._preview() if preview else self.pixels
+        height, width = pixels.shape
+
+        image = QImage(width, height, QImage.Format.Format_Grayscale8)
+        if image.isNull():
+            return image
+
+        # Writes straight into the QImage's own buffer; the table has every uint16 value, so there's nothing to clip
+        image_rows = np.frombuffer(image.bits(), dtype=np.uint8).reshape(height, image.bytesPerLine())
+        np.take(self.lut(), pixels, out=image_rows[:, :width], mode='clip')
+
+        return image
+
+    def _preview(self):
+        if self.preview_pixels is None:
+            step = self.preview_step
+            height, width = self.pixels.shape
+            # Whole steps only, so the scaled-up preview never reaches past the edges of the full image
+            self.preview_pixels = np.ascontiguousarray(self.pixels[:height // step * step:step,
+                                                                   :width // step * step:step])
+
+        return self.preview_pixels
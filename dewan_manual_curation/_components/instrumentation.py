@@ -0,0 +1,231 @@
+"""
+Opt-in timing of the launch stages and of UI responsiveness, written to a JSON log.
+
+Nothing is recorded unless an Instrumentation is active (launch_gui(instrument=True) or the PROFILE_ENV_VAR
+environment variable); until then stage() and track_interaction() return straight away, so they can stay in place
+on every code path. Only the standard library is imported here (the heavier ones only once it's on) so
+manual_curation can use it at import time.
+"""
+import contextlib
+import os
+import pathlib
+import sys
+import threading
+import time
+
+PROFILE_ENV_VAR = 'DEWAN_CURATION_PROFILE'  # Any value but ''/'0' turns instrumentation on
+LOG_NAME = 'manual_curation_profile-{timestamp}.json'
+RSS_SAMPLE_INTERVAL = 0.002  # s
+LOOP_MONITOR_INTERVAL = 50  # ms between event loop heartbeats
+LOOP_STALL_THRESHOLD = 0.05  # s a heartbeat has to be late by to count as a stall
+
+_active = None
+
+
+class RssSampler:
+    """ Polls the resident set size on a background thread while a stage runs and keeps the peak """
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start_rss = None
+        self.peak_rss = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = current_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _poll(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = current_rss()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+
+
+def current_rss():
+    """ Resident set size in bytes, or None where it can't be read cheaply """
+    try:
+        with open('/proc/self/statm') as statm:  # Linux
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    try:  # No current RSS elsewhere; the lifetime peak is the next best thing
+        import resource
+    except ImportError:  # Windows
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Bytes on macOS, KB everywhere else
+
+
+class Instrumentation:
+    """
+    Collects stage records (wall time and memory of a block of work, on whichever thread ran it) and interaction
+    records (how long the event loop took to come back around after a UI handler started, repaints included).
+    Stages on different threads can overlap, so their memory figures are for the whole process over that time.
+    """
+    def __init__(self):
+        import datetime
+
+        self.started_at = datetime.datetime.now()
+        self.start_time = time.perf_counter()
+        self.stages = []
+        self.interactions = []
+        self.lock = threading.Lock()
+        self.loop_monitor = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        with RssSampler() as sampler:
+            yield
+        end = time.perf_counter()
+
+        self.add_stage(name, start, end, sampler.peak_rss, sampler.start_rss)
+
+    def add_stage(self, name, start, end, peak_rss=None, start_rss=None):
+        record = {
+            'name': name,
+            'thread': threading.current_thread().name,
+            'start_s': start - self.start_time,
+            'seconds': end - start,
+            'peak_rss_mb': _megabytes(peak_rss),
+            'rss_growth_mb': _megabytes(None if peak_rss is None or start_rss is None else peak_rss - start_rss),
+        }
+        with self.lock:
+            self.stages.append(record)
+
+    def add_interaction(self, name, start, latency):
+        with self.lock:
+            self.interactions.append({'name': name, 'start_s': start - self.start_time, 'latency_s': latency})
+
+    def start_loop_monitor(self):
+        """ Starts recording event loop stalls (as 'event_loop_stall' interactions); needs a running Qt app """
+        from PySide6.QtCore import QTimer
+
+        self.loop_monitor = QTimer()
+        self.loop_monitor.setInterval(LOOP_MONITOR_INTERVAL)
+        last_beat = [time.perf_counter()]
+
+        def beat():
+            now = time.perf_counter()
+            lateness = now - last_beat[0] - LOOP_MONITOR_INTERVAL / 1000
+            if lateness > LOOP_STALL_THRESHOLD:
+                self.add_interaction('event_loop_stall', last_beat[0], lateness)
+            last_beat[0] = now
+
+        self.loop_monitor.timeout.connect(beat)
+        self.loop_monitor.start()
+
+    def stop_loop_monitor(self):
+        if self.loop_monitor is not None:
+            self.loop_monitor.stop()
+            self.loop_monitor = None
+
+    def summary(self):
+        """ Per interaction name: count, median, 95th percentile and worst latency """
+        with self.lock:
+            latencies = {}
+            for interaction in self.interactions:
+                latencies.setdefault(interaction['name'], []).append(interaction['latency_s'])
+
+        return {name: {'count': len(values), 'median_s': _percentile(values, 50), 'p95_s': _percentile(values, 95),
+                       'max_s': max(values)}
+                for name, values in latencies.items()}
+
+    def to_dict(self):
+        with self.lock:
+            stages, interactions = list(self.stages), list(self.interactions)
+
+        return {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'duration_s': time.perf_counter() - self.start_time,
+            'python': sys.version.split()[0],
+            'platform': sys.platform,
+            'stages': stages,
+            'interaction_summary': self.summary(),
+            'interactions': interactions,
+        }
+
+    def write(self, directory):
+        """ Writes the log into directory and returns its path """
+        import json
+
+        path = pathlib.Path(directory) / LOG_NAME.format(timestamp=self.started_at.strftime('%Y%m%d-%H%M%S'))
+        path.write_text(json.dumps(self.to_dict(), indent=2))
+        return path
+
+
+def enabled_by_env():
+    return os.environ.get(PROFILE_ENV_VAR, '') not in ('', '0')
+
+
+def activate(instrumentation):
+    global _active
+    _active = instrumentation
+
+
+def active():
+    return _active
+
+
+@contextlib.contextmanager
+def stage(name):
+    """ Records the enclosed block as a stage if instrumentation is on """
+    if _active is None:
+        yield
+        return
+
+    with _active.stage(name):
+        yield
+
+
+def stage_until_idle(name):
+    """
+    Records a stage from now until the event loop has worked through what's already queued, e.g. the paint events a
+    show() just posted; the memory figure is the RSS at the end
+    """
+    if _active is None:
+        return
+
+    from PySide6.QtCore import QTimer
+
+    instrumentation = _active
+    start = time.perf_counter()
+    QTimer.singleShot(0, lambda: instrumentation.add_stage(name, start, time.perf_counter(), current_rss()))
+
+
+def track_interaction(name):
+    """
+    Call at the start of a UI handler; records how long until the event loop gets back to its queue, i.e. the handler
+    itself plus whatever it posted ahead of that (repaints, queued signals)
+    """
+    if _active is None:
+        return
+
+    from PySide6.QtCore import QTimer
+
+    instrumentation = _active
+    start = time.perf_counter()
+    QTimer.singleShot(0, lambda: instrumentation.add_interaction(name, start, time.perf_counter() - start))
+
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(round(percent / 100 * (len(ordered) - 1)), len(ordered) - 1)]
+
+
+def _megabytes(n_bytes):
+    return None if n_bytes is None else n_bytes / 2 ** 20
@@ -0,0 +1,156 @@
+""" Tile-by-tile export of the max projection scene to a tiled TIFF """
+import math
+import queue
+import threading
+import time
+
+from PySide6.QtCore import QObject, QRectF, QTimer, Qt, Signal
+from PySide6.QtGui import QImage, QPainter
+
+from .tiled_tiff import TiledTiffWriter
+
+TILE_SIZE = 512
+MAX_QUEUED_TILES = 8  # Rendered tiles waiting on the writer; bounds export memory to a few MB
+TICK_BUDGET_S = 0.015  # Render time per event loop pass, so the GUI keeps repainting during an export
+FULL_QUEUE_RETRY_MS = 5  # Wait between passes while the writer is behind, rather than spinning the GUI thread
+
+
+class MaxProjectionExporter(QObject):
+    """
+    Renders the scene one tile at a time from a QTimer on the GUI thread (scene items can't be painted from anywhere
+    else) and hands each tile to a writer thread that streams it into a TiledTiffWriter. Only a handful of tiles are
+    ever in memory, regardless of the output size.
+    """
+    progress = Signal(int, int)  # (tiles rendered, total tiles)
+    finished = Signal(str)  # Output path
+    failed = Signal(str)  # Error message
+    aborted = Signal()  # Stopped by cancel(); the partial file has been removed
+    _writer_done = Signal(str, bool)  # (error, written) from the writer thread; the error is empty unless it failed
+
+    def __init__(self, scene, output_path, scale=1.0, labeled=True, tile_size=TILE_SIZE, parent=None):
+        super().__init__(parent)
+        self.scene = scene
+        self.output_path = output_path
+        self.scale = scale
+        self.labeled = labeled
+        self.image = scene.image  # The contrast the export started with, even if it's changed part way through
+
+        if labeled:  # Labels can hang off the edge of the image, so take everything in the scene
+            self.source_rect = QRectF(scene.sceneRect())
+        else:
+            self.source_rect = QRectF(self.image.rect())
+
+        self.width = max(round(self.source_rect.width() * scale), 1)
+        self.height = max(round(self.source_rect.height() * scale), 1)
+        # Qt's TIFF reader can't decode tiles wider than the image, and tile sizes have to be multiples of 16
+        self.tile_size = min(tile_size, max(self.width // 16 * 16, 16))
+        self.tiles_across = math.ceil(self.width / self.tile_size)
+        self.n_tiles = self.tiles_across * math.ceil(self.height / self.tile_size)
+
+        self.next_tile = 0
+        self.tile_queue = queue.Queue(maxsize=MAX_QUEUED_TILES)
+        self.writer_thread = None
+        self.cancelled = False
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self._render_tiles)
+        # Queued even from the GUI thread, so a failure in start() is reported after the caller has connected failed
+        self._writer_done.connect(self._on_writer_done, Qt.ConnectionType.QueuedConnection)
+
+    def start(self):
+        try:
+            writer = TiledTiffWriter(self.output_path, self.width, self.height, self.tile_size)
+        except (OSError, ValueError) as e:  # Too large for a TIFF, or the file couldn't be created
+            self._writer_done.emit(str(e), False)
+            return
+
+        self.writer_thread = threading.Thread(target=self._write_tiles, args=(writer,), daemon=True)
+        self.writer_thread.start()
+        self.timer.start()
+
+    def cancel(self):
+        if self.cancelled or self.writer_thread is None:
+            return
+
+        self.cancelled = True
+        self.timer.stop()
+        self._put(None)
+
+    def _render_tiles(self):
+        tick_start = time.perf_counter()
+
+        while self.next_tile < self.n_tiles and time.perf_counter() - tick_start < TICK_BUDGET_S:
+            if self.tile_queue.full():  # Let the writer catch up; try again shortly
+                self.timer.setInterval(FULL_QUEUE_RETRY_MS)
+                return
+
+            self.timer.setInterval(0)
+
+            self.tile_queue.put((self.next_tile, self._render_tile(self.next_tile)))
+            self.next_tile += 1
+            self.progress.emit(self.next_tile, self.n_tiles)
+
+        if self.next_tile == self.n_tiles:
+            self.timer.stop()
+            self._put(None)
+
+    def _render_tile(self, index):
+        row, column = divmod(index, self.tiles_across)
+        tile = QImage(self.tile_size, self.tile_size, QImage.Format.Format_RGB888)
+        tile.fill(Qt.GlobalColor.black)
+
+        target = QRectF(0, 0, self.tile_size, self.tile_size)
+        source_size = self.tile_size / self.scale
+        source = QRectF(self.source_rect.left() + column * source_size, self.source_rect.top() + row * source_size,
+                        source_size, source_size)
+
+        painter = QPainter(tile)
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+        if self.labeled:
+            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+            self.scene.render(painter, target, source, Qt.AspectRatioMode.IgnoreAspectRatio)
+        else:
+            painter.drawImage(target, self.image, source)
+        painter.end()
+
+        # Rows of a multiple-of-16 wide RGB888 image are already 4-byte aligned, so the buffer is the tile verbatim
+        return bytes(tile.constBits())
+
+    def _put(self, item):
+        # The sentinel has to get through even when the queue is full
+        while True:
+            try:
+                self.tile_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if not self.writer_thread.is_alive():
+                    return
+
+    def _write_tiles(self, writer):
+        error = ''
+        written = False
+        try:
+            while (item := self.tile_queue.get()) is not None:
+                writer.write_tile(*item)
+
+            if self.cancelled:
+                writer.abort()
+            else:
+                writer.close()
+                written = True
+        except (OSError, ValueError) as e:
+            writer.abort()
+            error = str(e)
+
+        self._writer_done.emit(error, written)
+
+    def _on_writer_done(self, error, written):
+        self.timer.stop()
+
+        if error:
+            self.failed.emit(error)
+        elif written:  # Even if cancel() came in after the last tile was already written
+            self.finished.emit(str(self.output_path))
+        else:
+            self.aborted.emit()
@@ -1,26 +1,45 @@
 """ Maximum Projection QGraphicsScene extension """
 import pathlib
 
-from PySide6.QtCore import QPoint, Qt, QRect, QRectF
-from PySide6.QtGui import QImage, QPixmap, QPolygonF, QPen, QBrush, QFont, QPainter
+from PySide6.QtCore import QLineF, QPoint, Qt, QRect, Signal
+from PySide6.QtGui import QPixmap, QPolygonF, QPen, QBrush, QFont, QPainterPath
 from PySide6.QtWidgets import QGraphicsScene, QGraphicsPixmapItem, QGraphicsTextItem
-from shapely import Polygon
+
+import numpy as np
+import shiboken6
+
+from .contours import ContourStore
+from .image_levels import ImageLevels
+from .maxproj_export import MaxProjectionExporter
+from .spatial_index import SpatialIndex
+
+CONTOUR_SCALE = 4  # The HD max projection is 4x the resolution the contours were drawn at
+OUTLINE_PEN_WIDTH = 2
+HOVER_PEN_WIDTH = 5
+CLICK_TOLERANCE = 4  # Screen pixels the mouse can move between press and release and still count as a click
+PAIR_PEN_WIDTH = 3
 
 
 class MaximumProjection(QGraphicsScene):
-    def __init__(self, cell_names, cell_contours, max_projection_path):
+    cell_clicked = Signal(str)
+    cell_hovered = Signal(object)  # Cell name, or None once the pointer leaves every outline
+    cells_lassoed = Signal(list)
+
+    def __init__(self, cell_names, cell_contours, max_projection_path, cell_centroids=None):
         super().__init__()
 
         self.default_font = QFont("Arial", 12, 1)
         self.cells = cell_names
-        self.cell_contours = cell_contours
+        self.cell_contours = ContourStore.from_dict(cell_names, cell_contours)
         self.image_path = max_projection_path
 
-        self.new_centroids = None
+        self.new_centroids = cell_centroids  # May already be known from a cached session
 
-        self.image = None
+        self.levels = None  # ImageLevels; the 16-bit image and the contrast it's shown with
+        self.image = None  # 8-bit rendering of levels at full resolution
         self.pixmap = None
         self.pixmap_item = None
+        self.preview_shown = False  # A decimated rendering is up while a contrast control is dragged
 
         self.pen = None
         self.brush = None
@@ -32,7 +51,17 @@ class MaximumProjection(QGraphicsScene):
         self.cell_outline_references = []
         self.outline_dict = {}
 
-        self._generate_new_centroids()
+        #  Picking
+        self.spatial_index = SpatialIndex(self.cell_contours)
+        self.hovered_cell = None
+        self.press_position = None
+        self.lasso_path = None
+        self.lasso_item = None
+
+        self.pair_items = []  # Lines joining flagged (highly correlated) neighbor pairs
+
+        if self.new_centroids is None:
+            self._generate_new_centroids()
         self._load_maxproj_image()
         self._create_outline_polygons()
         self._create_cell_labels()
@@ -49,42 +78,166 @@ class MaximumProjection(QGraphicsScene):
             color = Qt.GlobalColor.red
 
         self.pen.setColor(color)  # This might just work?
+        if key == self.hovered_cell:
+            self.pen.setWidth(HOVER_PEN_WIDTH)
         polygon.setPen(self.pen)
+        self.pen.setWidth(OUTLINE_PEN_WIDTH)
         polygon.update()
 
+    def flag_pairs(self, pairs):
+        """ Joins the centroids of each (cell_a, cell_b, r) pair with a line; replaces any pairs flagged before """
+        for item in self.pair_items:
+            self.removeItem(item)
+        self.pair_items = []
+
+        pair_pen = QPen(Qt.GlobalColor.magenta, PAIR_PEN_WIDTH)
+        pair_pen.setCosmetic(True)  # Stays visible however far out the view is zoomed
+
+        for cell_a, cell_b, r in pairs:
+            line = QLineF(*np.multiply(self.new_centroids[cell_a], CONTOUR_SCALE),
+                          *np.multiply(self.new_centroids[cell_b], CONTOUR_SCALE))
+            item = self.addLine(line, pair_pen)
+            item.setToolTip(f'{cell_a} / {cell_b}: r = {r:.3f}')
+            item.setZValue(1)  # Above the outlines
+            self.pair_items.append(item)
+
+    def cell_at(self, scene_position):
+        # Scene coordinates are in HD max projection pixels; the index works in contour units
+        hits = self.spatial_index.cells_at(scene_position.x() / CONTOUR_SCALE, scene_position.y() / CONTOUR_SCALE)
+        if not hits:
+            return None
+
+        return self.cell_contours.cells[hits[0]]
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.MouseButton.LeftButton and event.modifiers() & Qt.KeyboardModifier.ShiftModifier:
+            # Shift+drag draws a lasso; accepting the press stops the view from panning instead
+            self.lasso_path = QPainterPath(event.scenePos())
+            lasso_pen = QPen(Qt.GlobalColor.yellow, 2, Qt.PenStyle.DashLine)
+            lasso_pen.setCosmetic(True)
+            self.lasso_item = self.addPath(self.lasso_path, lasso_pen)
+            event.accept()
+            return
+
+        self.press_position = event.screenPos()
+        super().mousePressEvent(event)
+
+    def mouseMoveEvent(self, event):
+        if self.lasso_item is not None:
+            self.lasso_path.lineTo(event.scenePos())
+            self.lasso_item.setPath(self.lasso_path)
+            return
+
+        if event.buttons() == Qt.MouseButton.NoButton:
+            self._set_hovered_cell(self.cell_at(event.scenePos()))
+
+        super().mouseMoveEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        if self.lasso_item is not None:
+            lasso = self.lasso_path.toFillPolygon()
+            self.removeItem(self.lasso_item)
+            self.lasso_item = None
+            self.lasso_path = None
+
+            lasso_points = np.array([(point.x(), point.y()) for point in lasso]) / CONTOUR_SCALE
+            enclosed = self.spatial_index.cells_in_polygon(lasso_points)
+            self.cells_lassoed.emit([self.cell_contours.cells[i] for i in enclosed])
+            return
+
+        if self.press_position is not None and event.button() == Qt.MouseButton.LeftButton:
+            if (event.screenPos() - self.press_position).manhattanLength() <= CLICK_TOLERANCE:  # Not a pan
+                cell = self.cell_at(event.scenePos())
+                if cell is not None:
+                    self.cell_clicked.emit(cell)
+
+        self.press_position = None
+        super().mouseReleaseEvent(event)
+
     def reset_polygon_colors(self):
         for cell in self.cells:
             self.change_outline_color(cell, 0)
 
-    def save(self):
-        self.reset_polygon_colors()
-        scene_rect = QRectF(self.sceneRect())
-        scene_size = scene_rect.size().toSize()
-        image = QImage(scene_size.width(), scene_size.height(), QImage.Format.Format_ARGB32_Premultiplied)
-        painter = QPainter(image)
+    def set_levels(self, black=None, white=None, gamma=None, preview=False):
+        """
+        Re-renders the image with new display settings (see ImageLevels.set_levels). preview=True is for updates while
+        a control is being dragged; call again without it once the drag ends to get the full-resolution image back.
+        """
+        self.levels.set_levels(black, white, gamma)
+        self._show_levels(preview)
+
+    def clip_levels(self, percent):
+        """ Auto contrast; percent of the pixels are clipped at each end """
+        self.levels.clip(percent)
+        self._show_levels()
+
+    def reset_levels(self):
+        self.levels.reset()
+        self._show_levels()
+
+    def save(self, scale=1.0, labeled=True, parent=None):
+        """
+        Starts a background export of the max projection to a tiled TIFF next to the source image and returns the
+        MaxProjectionExporter; an event loop has to be running for it to make progress. scale is relative to the HD
+        image, and labeled=False exports the bare image without outlines or labels. The image is exported with the
+        contrast it's currently shown with.
+        """
+        if self.preview_shown:
+            self._show_levels()
 
-        self.render(painter, image.rect(), scene_rect)
-        painter.end()
-        save_path = self.image_path.with_stem(f'labeled-HD-maxproj').with_suffix('.tif')
-        image.save(str(save_path))
+        if labeled:
+            self.reset_polygon_colors()
+            save_path = self.image_path.with_stem(f'labeled-HD-maxproj').with_suffix('.tif')
+        else:
+            save_path = self.image_path.with_stem(f'unlabeled-HD-maxproj').with_suffix('.tif')
+
+        exporter = MaxProjectionExporter(self, save_path, scale, labeled, parent=parent)
+        exporter.start()
+
+        return exporter
 
     def _load_maxproj_image(self):
-        self.image = QImage(self.image_path)
+        self.levels = ImageLevels.load(self.image_path)
+        self.image = self.levels.render()
         self.pixmap = QPixmap.fromImage(self.image)
         self.pixmap_item = QGraphicsPixmapItem(self.pixmap)
         self.addItem(self.pixmap_item)
 
-    def _create_outline_polygons(self):
-        for cell in self.cells:  # Iterate through cells
-            polygon_verts = []
-            cell_coordinates = self.cell_contours[cell][0]  # Get the vertices for a specific cell
+    def _show_levels(self, preview=False):
+        # render() always makes a new QImage, so an export holding the previous one isn't changed under it
+        if preview:
+            image = self.levels.render(preview=True)
+            self.pixmap_item.setScale(self.levels.preview_step)
+        else:
+            image = self.image = self.levels.render()
+            self.pixmap_item.setScale(1)
 
-            for pair in cell_coordinates:
-                _x, _y = pair
-                _point = QPoint(_x, _y) * 4
-                polygon_verts.append(_point)  # We need a list of QPoints, so generate a QPoint for each pair
+        self.pixmap = QPixmap.fromImage(image)
+        self.pixmap_item.setPixmap(self.pixmap)
+        self.preview_shown = preview
 
-            _cell_polygon = QPolygonF(polygon_verts)
+    def _set_hovered_cell(self, cell):
+        if cell == self.hovered_cell:
+            return
+
+        for key, width in ((self.hovered_cell, OUTLINE_PEN_WIDTH), (cell, HOVER_PEN_WIDTH)):
+            if key is None:
+                continue
+            polygon = self.outline_dict[key]
+            pen = polygon.pen()
+            pen.setWidth(width)
+            polygon.setPen(pen)
+
+        self.hovered_cell = cell
+        self.cell_hovered.emit(cell)
+
+    def _create_outline_polygons(self):
+        scaled_coordinates = self.cell_contours.coordinates * CONTOUR_SCALE  # One multiply for every vertex
+        offsets = self.cell_contours.offsets
+
+        for cell in self.cells:  # Iterate through cells
+            i = self.cell_contours.cell_index[cell]
+            _cell_polygon = self._polygon_from_array(scaled_coordinates[offsets[i]:offsets[i + 1]])
             self.cell_outline_polygons.append(_cell_polygon)
 
     def _create_reference_dict(self):
@@ -97,7 +250,7 @@ class MaximumProjection(QGraphicsScene):
             _cell_label = str(int(cell.split('C')[1]))  # Little trickery to drop leading zeros
 
             _label = QGraphicsTextItem(_cell_label)
-            _position = QPoint(_x, _y) * 4
+            _position = QPoint(_x, _y) * CONTOUR_SCALE
             _label.setPos(_position)
 
             _label.setFont(self.default_font)
@@ -106,7 +259,7 @@ class MaximumProjection(QGraphicsScene):
     def _draw_cell_outlines(self):
         self.brush = QBrush()
         self.brush.setStyle(Qt.BrushStyle.NoBrush)
-        self.pen = QPen(Qt.GlobalColor.red, 2, Qt.PenStyle.SolidLine, Qt.PenCapStyle.SquareCap,
+        self.pen = QPen(Qt.GlobalColor.red, OUTLINE_PEN_WIDTH, Qt.PenStyle.SolidLine, Qt.PenCapStyle.SquareCap,
                         Qt.PenJoinStyle.RoundJoin)
 
         for i, polygon in enumerate(self.cell_outline_polygons):
@@ -117,11 +270,18 @@ class MaximumProjection(QGraphicsScene):
             self.cell_outline_references.append(_polygon_reference)
 
     def _generate_new_centroids(self):
-        centroids = []
-        for cell in self.cells:
-            polygon_verts = self.cell_contours[cell][0]
-            polygon = Polygon(polygon_verts)
-            new_centroid = (polygon.centroid.x, polygon.centroid.y)
-            centroids.append(new_centroid)
+        centroids = self.cell_contours.centroids()
+        self.new_centroids = {cell: tuple(centroids[self.cell_contours.cell_index[cell]]) for cell in self.cells}
+
+    @staticmethod
+    def _polygon_from_array(points: np.ndarray) -> QPolygonF:
+        # Size the polygon, then copy the vertices straight into its QPointF storage (two doubles per point)
+        polygon = QPolygonF()
+        polygon.resize(len(points))
+        if len(points) == 0:
+            return polygon
+
+        point_buffer = shiboken6.VoidPtr(polygon.data(), points.size * 8, True)
+        np.frombuffer(point_buffer, dtype=np.float64).reshape(-1, 2)[:] = points
 
-        self.new_centroids = dict(list(zip(self.cells, centroids)))
+        return polygon
@@ -0,0 +1,36 @@
+""" Low-memory mode: one byte budget shared by the session's traces and the rendered rows kept for repainting """
+import logging
+
+MIN_CACHED_ROWS = 16  # Roughly two screens of rows; any fewer and scrolling back re-renders what was just on screen
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBudget:
+    """
+    The traces are a fixed cost (the float32 matrix, registered with reserve() as each chunk arrives); whatever they
+    leave of max_bytes is what the trace panel may spend on rendered rows, so memory grows with the rows on screen
+    rather than with the number of cells. If the traces alone go over, the row cache shrinks to MIN_CACHED_ROWS and a
+    warning is logged once.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.reserved_bytes = 0
+        self.warned = False
+
+    def reserve(self, n_bytes):
+        """ Returns the warning the first time the budget is exceeded, so it can be shown to the user; otherwise None """
+        self.reserved_bytes += n_bytes
+
+        if self.reserved_bytes > self.max_bytes and not self.warned:
+            self.warned = True
+            message = (f'The traces need more than the {self.max_bytes / 2 ** 20:.0f} MB memory budget; only '
+                       f'{MIN_CACHED_ROWS} rendered rows will be kept')
+            logger.warning(message)
+            return message
+
+        return None
+
+    def pixmap_bytes(self):
+        """ Bytes left over for rendered rows """
+        return max(self.max_bytes - self.reserved_bytes, 0)
@@ -0,0 +1,90 @@
+""" Vectorized per-cell statistics used to triage cells before (or instead of) manual review """
+import numpy as np
+import pandas as pd
+
+MAD_TO_SIGMA = 1.4826  # Scales a median absolute deviation to a Gaussian standard deviation
+EVENT_THRESHOLD_SIGMA = 3  # An event starts where the trace rises past baseline + this many noise sigmas
+METRIC_CHUNK_SIZE = 256  # Cells per pass; bounds the float32 temporaries on long recordings
+
+TRACE_METRIC_NAMES = ('snr', 'skewness', 'event_rate', 'baseline_noise', 'peak')
+CONTOUR_METRIC_NAMES = ('area', 'compactness')
+METRIC_NAMES = TRACE_METRIC_NAMES + CONTOUR_METRIC_NAMES
+
+
+def compute_cell_metrics(cell_names, trace_matrix: np.ndarray, cell_contours, cell_props=None, sampling_rate=None,
+                         chunk_size=METRIC_CHUNK_SIZE):
+    """
+    Returns a DataFrame indexed by cell name with one column per statistic in METRIC_NAMES. The trace statistics are
+    computed chunk_size cells at a time, each chunk vectorized over its whole cells x time block. event_rate is in
+    events per minute and needs the sampling_rate (Hz); it is NaN without one. Any numeric columns of cell_props
+    (e.g. Inscopix's own SNR or size) are joined on as well so rules can refer to them.
+    """
+    n_cells = len(cell_names)
+    trace_metrics = {name: np.full(n_cells, np.nan) for name in TRACE_METRIC_NAMES}
+
+    for start in range(0, n_cells, chunk_size):
+        chunk = np.asarray(trace_matrix[start:start + chunk_size], dtype=np.float32)
+        for name, values in _trace_metrics(chunk, sampling_rate).items():
+            trace_metrics[name][start:start + chunk_size] = values
+
+    contour_rows = [cell_contours.cell_index[cell] for cell in cell_names]
+
+    metrics = pd.DataFrame({
+        **trace_metrics,
+        'area': cell_contours.areas()[contour_rows],
+        'compactness': cell_contours.compactness()[contour_rows],
+    }, index=pd.Index(cell_names, name='Name'))
+
+    if cell_props is not None:
+        metrics = join_props(metrics, cell_props)
+
+    return metrics
+
+
+def join_props(metrics, cell_props):
+    numeric_props = cell_props.set_index('Name').select_dtypes('number')
+    numeric_props = numeric_props.drop(columns=[column for column in numeric_props if column in metrics])
+
+    return metrics.join(numeric_props)
+
+
+def sampling_rate(time_values):
+    """ Sampling rate in Hz from a trace's time index (in seconds) """
+    time_values = np.asarray(time_values, dtype=np.float64)
+    if len(time_values) < 2:
+        return None
+
+    return 1 / np.median(np.diff(time_values))
+
+
+def skewness(trace_matrix: np.ndarray):
+    """ Sample skewness of every row; float64 accumulators keep long float32 recordings from losing precision """
+    mean = np.nanmean(trace_matrix, axis=1, dtype=np.float64)
+    deviations = trace_matrix - mean[:, np.newaxis].astype(trace_matrix.dtype)
+
+    second_moment = np.nanmean(np.square(deviations), axis=1, dtype=np.float64)
+    third_moment = np.nanmean(deviations ** 3, axis=1, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return third_moment / second_moment ** 1.5
+
+
+def _trace_metrics(trace_chunk, trace_sampling_rate):
+    baseline = np.nanmedian(trace_chunk, axis=1)
+    baseline_noise = MAD_TO_SIGMA * np.nanmedian(np.abs(trace_chunk - baseline[:, np.newaxis]), axis=1)
+    peak = np.nanmax(trace_chunk, axis=1)
+
+    # Count rising edges through the event threshold; a trace that starts above it counts as one event
+    above = trace_chunk > (baseline + EVENT_THRESHOLD_SIGMA * baseline_noise)[:, np.newaxis]
+    n_events = above[:, 0] + np.count_nonzero(above[:, 1:] & ~above[:, :-1], axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = (peak - baseline) / baseline_noise
+
+        if trace_sampling_rate:
+            event_rate = n_events / (trace_chunk.shape[1] / trace_sampling_rate / 60)
+        else:
+            event_rate = np.full(len(trace_chunk), np.nan)
+
+    return {'snr': snr, 'skewness': skewness(trace_chunk), 'event_rate': event_rate,
+            'baseline_noise': baseline_noise, 'peak': peak}
@@ -0,0 +1,45 @@
+""" Batched min/max normalization of a whole cells x time trace matrix """
+import numpy as np
+
+
+def normalize_traces(trace_data: np.ndarray, feature_range: tuple = (0, 1)):
+    """
+    Scales every row of trace_data into feature_range with one set of vectorized operations, replacing a
+    per-trace MinMaxScaler. Returns the scaled float32 matrix along with each cell's original min, max and mean so
+    labels and reference lines don't need to look at the data again.
+    """
+    _min, _max = feature_range
+    trace_data = np.atleast_2d(trace_data)
+
+    scaled_data = trace_data.astype(np.float32)  # The one full-size allocation; everything after is in-place
+    trace_min = np.nanmin(scaled_data, axis=1)
+    trace_max = np.nanmax(scaled_data, axis=1)
+    trace_mean = np.nanmean(scaled_data, axis=1, dtype=np.float64)
+
+    data_range = trace_max - trace_min
+    data_range[data_range == 0] = 1  # Flat traces get pinned to the bottom of the range, same as MinMaxScaler
+
+    scaled_data -= trace_min[:, np.newaxis]
+    scaled_data *= ((_max - _min) / data_range)[:, np.newaxis]
+    scaled_data += _min
+
+    return scaled_data, trace_min, trace_max, trace_mean
+
+
+def scale_values(values, value_min, value_max, feature_range: tuple = (0, 1)):
+    """
+    Scales part of one trace (e.g. an envelope slice) with that trace's min and max, giving exactly what
+    normalize_traces would have for those samples; for traces that are never normalized as a whole
+    """
+    _min, _max = feature_range
+
+    data_range = np.float32(value_max) - np.float32(value_min)
+    if data_range == 0:
+        data_range = np.float32(1)
+
+    scaled_values = np.array(values, dtype=np.float32)
+    scaled_values -= np.float32(value_min)
+    scaled_values *= (_max - _min) / data_range
+    scaled_values += _min
+
+    return scaled_values
@@ -0,0 +1,137 @@
+""" QPainter trace rows; the same visuals as trace_plotting.plot_envelope without a matplotlib figure per row """
+
+import numpy as np
+import shiboken6
+
+from matplotlib.colors import to_rgba
+
+from PySide6.QtCore import QPointF, QRectF, QSize, Qt
+from PySide6.QtGui import QColor, QFont, QFontMetricsF, QImage, QPainter, QPen, QPolygonF
+
+from .trace_plotting import scale_to_range
+
+# matplotlib's default subplot placement (figure fractions), so rows from either backend line up
+AXES_LEFT = 0.125
+AXES_RIGHT = 0.9
+AXES_BOTTOM = 0.11
+AXES_TOP = 0.88
+NAME_LABEL_X = -0.1  # Axes fraction; where format_axes puts the cell name
+# Sizes in points, converted with the row's dpi like matplotlib does
+FONT_SIZE = 14
+SPINE_WIDTH = 0.8
+TICK_LENGTH = 3.5
+TICK_PAD = 3.5
+REFERENCE_LINE_WIDTH = 1.5
+REFERENCE_LINE_DASHES = [5, 10]  # In line widths, the same as the (0, (5, 10)) linestyle
+
+
+def paint_envelope(size: QSize, x_values, lows, highs, cell_name, trace_min, trace_max, trace_mean, x_window,
+                   figure_min_max=(0, 1), reference_line=True, reference_line_color='r', line_width=0.5,
+                   dpi=100) -> QImage:
+    """ Takes the same arguments as trace_plotting.plot_envelope plus the row's size and dpi """
+    points_to_pixels = dpi / 72
+
+    image = QImage(size, QImage.Format.Format_RGB32)
+    image.fill(Qt.GlobalColor.white)
+
+    axes_rect = QRectF(size.width() * AXES_LEFT, size.height() * (1 - AXES_TOP),
+                       size.width() * (AXES_RIGHT - AXES_LEFT), size.height() * (AXES_TOP - AXES_BOTTOM))
+
+    painter = QPainter(image)
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+
+    # ==Trace== #
+    polyline = envelope_polygon(axes_rect, x_values, lows, highs, x_window)
+
+    painter.save()
+    painter.setClipRect(axes_rect)
+    painter.setPen(QPen(QColor(Qt.GlobalColor.black), line_width * points_to_pixels))
+    painter.drawPolyline(polyline)
+
+    if reference_line:
+        y_line_val = scale_to_range(trace_mean, trace_min, trace_max, figure_min_max)
+        reference_pen = QPen(QColor.fromRgbF(*to_rgba(reference_line_color)), REFERENCE_LINE_WIDTH * points_to_pixels)
+        reference_pen.setDashPattern(REFERENCE_LINE_DASHES)
+        reference_pen.setCapStyle(Qt.PenCapStyle.FlatCap)
+        painter.setPen(reference_pen)
+        y_line = axes_rect.bottom() - y_line_val * axes_rect.height()
+        painter.drawLine(QPointF(axes_rect.left(), y_line), QPointF(axes_rect.right(), y_line))
+    painter.restore()
+
+    # ==Axes== #
+    painter.setPen(QPen(QColor(Qt.GlobalColor.black), SPINE_WIDTH * points_to_pixels))
+    painter.drawRect(axes_rect)
+
+    tick_length = TICK_LENGTH * points_to_pixels
+    for y in (axes_rect.top(), axes_rect.bottom()):  # y ticks sit on the right, like yaxis.tick_right()
+        painter.drawLine(QPointF(axes_rect.right(), y), QPointF(axes_rect.right() + tick_length, y))
+
+    # ==Labels== #
+    font = QFont('Arial')
+    font.setPixelSize(round(FONT_SIZE * points_to_pixels))
+
+    font.setBold(True)  # Tick labels follow font.weight, which trace_plotting sets to bold
+    label_left = axes_rect.right() + tick_length + TICK_PAD * points_to_pixels
+    for label, y in ((trace_max, axes_rect.top()), (trace_min, axes_rect.bottom())):
+        _draw_text(painter, font, str(round(float(label), 4)), label_left, y, Qt.AlignmentFlag.AlignLeft)
+
+    font.setBold(False)  # The name is the axes label, which keeps matplotlib's normal label weight
+    name_x = axes_rect.left() + NAME_LABEL_X * axes_rect.width()
+    _draw_text(painter, font, f'Cell: {cell_name}', name_x, axes_rect.center().y(), Qt.AlignmentFlag.AlignHCenter)
+
+    painter.end()
+    return image
+
+
+def envelope_polygon(axes_rect: QRectF, x_values, lows, highs, x_window) -> QPolygonF:
+    """ An EnvelopePyramid slice as one polyline, laid out like plot_envelope does (1% margin either side) """
+    if lows is highs:  # Raw samples
+        x_2_plot = np.asarray(x_values, dtype=np.float64)
+        data_2_plot = lows
+    else:  # A vertical stroke from each bin's min to its max
+        x_2_plot = np.repeat(np.asarray(x_values, dtype=np.float64), 2)
+        data_2_plot = np.column_stack((lows, highs)).ravel()
+
+    start, stop = x_window
+    xaxis_offset = (stop - 1 - start) * 0.01
+    x_limits = (start - xaxis_offset, stop - 1 + xaxis_offset)
+
+    return to_polygon(axes_rect, x_limits, x_2_plot, data_2_plot)
+
+
+def to_polygon(axes_rect: QRectF, x_limits, x_values, y_values) -> QPolygonF:
+    """
+    Maps data coordinates (y in [0, 1]) into axes_rect and writes them straight into the QPolygonF's point buffer, so
+    there's no Python per point
+    """
+    x_min, x_max = x_limits
+    polygon = QPolygonF()
+    polygon.resize(len(x_values))
+    if len(x_values) == 0:
+        return polygon
+
+    # QPointF is two doubles, so the polygon's storage is an (n, 2) float64 array
+    buffer = shiboken6.VoidPtr(polygon.data(), len(x_values) * 2 * 8, True)
+    points = np.frombuffer(buffer, dtype=np.float64).reshape(-1, 2)
+
+    points[:, 0] = x_values
+    points[:, 0] -= x_min
+    points[:, 0] *= axes_rect.width() / (x_max - x_min)
+    points[:, 0] += axes_rect.left()
+
+    points[:, 1] = y_values
+    points[:, 1] *= -axes_rect.height()
+    points[:, 1] += axes_rect.bottom()
+
+    return polygon
+
+
+def _draw_text(painter, font, text, x, y, horizontal_alignment):
+    # Anchored at (x, y) and vertically centered on it
+    painter.setFont(font)
+    metrics = QFontMetricsF(font)
+    width = metrics.horizontalAdvance(text)
+    left = x - width / 2 if horizontal_alignment == Qt.AlignmentFlag.AlignHCenter else x
+    rect = QRectF(left, y - metrics.height() / 2, width + 1, metrics.height())
+    painter.drawText(rect, horizontal_alignment | Qt.AlignmentFlag.AlignVCenter, text)
+
@@ -0,0 +1,93 @@
+""" Process pool that rasterizes trace rows off the GUI thread """
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from PySide6.QtCore import QObject, QTimer, Signal
+from PySide6.QtGui import QImage
+
+from .trace_plotting import rasterize_rows
+
+ROWS_PER_TASK = 4  # Small batches so the first visible rows come back quickly
+
+
+class TraceRenderEngine(QObject):
+    image_ready = Signal(object, QImage)
+    _results_ready = Signal(object)  # Emitted from the executor's callback thread, delivered on the GUI thread
+
+    def __init__(self, max_workers=None, parent=None):
+        super().__init__(parent)
+        # Spawn rather than fork; forking a process that is running a Qt event loop is not safe
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+        self.queued_jobs = []
+        self.in_flight = {}  # key: future, so a row that is repainted while pending isn't submitted twice
+        self.flush_scheduled = False
+        self._shut_down = False  # Set from the GUI thread, read from the executor's callback thread
+
+        self._results_ready.connect(self._on_results_ready)
+
+    def submit(self, job):
+        key = job[0]
+        if key in self.in_flight:
+            return
+
+        self.in_flight[key] = None
+        self.queued_jobs.append(job)
+
+        if not self.flush_scheduled:  # Collect every row requested during this paint pass into one flush
+            self.flush_scheduled = True
+            QTimer.singleShot(0, self._flush)
+
+    def cancel_pending(self):
+        self.queued_jobs.clear()
+
+        for key, future in list(self.in_flight.items()):
+            if future is None or future.cancel():
+                self.in_flight.pop(key)
+
+    def shutdown(self):
+        # Batches already running still finish after this; their results are dropped in _on_future_done
+        self._shut_down = True
+        self.queued_jobs.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _flush(self):
+        self.flush_scheduled = False
+        if self._shut_down:
+            return
+
+        jobs, self.queued_jobs = self.queued_jobs, []
+
+        for i in range(0, len(jobs), ROWS_PER_TASK):
+            batch = jobs[i:i + ROWS_PER_TASK]
+            batch_keys = [job[0] for job in batch]
+            future = self.executor.submit(rasterize_rows, batch)
+            future.add_done_callback(partial(self._on_future_done, batch_keys))
+
+            for job in batch:
+                self.in_flight[job[0]] = future
+
+    def _on_future_done(self, batch_keys, future):
+        if self._shut_down or future.cancelled():
+            return
+
+        if future.exception() is not None:  # Release the keys so the rows are retried on the next repaint
+            results = [(key, None, 0, 0) for key in batch_keys]
+        else:
+            results = future.result()
+
+        try:
+            self._results_ready.emit(results)
+        except RuntimeError:  # The engine was deleted between the check above and the emit
+            pass
+
+    def _on_results_ready(self, results):
+        for key, rgba_bytes, width, height in results:
+            if self.in_flight.pop(key, False) is False:  # Cancelled after it had already started
+                continue
+            if rgba_bytes is None:
+                continue
+
+            image = QImage(rgba_bytes, width, height, QImage.Format.Format_RGBA8888).copy()
+            self.image_ready.emit(key, image)
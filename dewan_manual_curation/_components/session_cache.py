@@ -0,0 +1,228 @@
+""" On-disk cache of a fully prepared session so re-opening it skips CSV/JSON parsing and preprocessing """
+import hashlib
+import json
+import os
+import pathlib
+
+import numpy as np
+
+CACHE_VERSION = 2  # Bump whenever the bundle layout or the preprocessing that produces it changes
+METRICS_VERSION = 1  # Bump whenever a metric's definition changes
+CACHE_DIR_NAME = '.manual_curation_cache'
+SESSION_BUNDLE_NAME = 'session.npz'
+METRICS_BUNDLE_NAME = 'metrics.npz'
+TRACE_STORE_DIR_NAME = 'trace_store'
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def cache_dir(project_folder):
+    return pathlib.Path(project_folder.inscopix_dir.cell_trace_path).parent / CACHE_DIR_NAME
+
+
+def source_paths(project_folder):
+    inscopix_dir = project_folder.inscopix_dir
+    return [pathlib.Path(inscopix_dir.cell_trace_path), pathlib.Path(inscopix_dir.props_path),
+            pathlib.Path(inscopix_dir.contours_path)]
+
+
+def source_signatures(project_folder):
+    """
+    Size and mtime of each source file. Take these before reading the sources and pass them to save_session_cache or
+    save_metrics_cache, which skip the write if a file changed in between rather than cache stale data as current.
+    """
+    return [_file_signature(path, with_hash=False) if path.exists() else None for path in source_paths(project_folder)]
+
+
+def load_session_cache(project_folder):
+    """
+    Returns the cached session dict, or None if there is no bundle or any source file changed. Size and mtime are
+    checked first; a file whose mtime moved (e.g. the folder was copied) is only treated as changed if its content
+    hash no longer matches. If it still matches, the bundle is re-saved with the new mtimes so the file isn't hashed
+    again on the next launch.
+    """
+    return _load_bundle(project_folder, SESSION_BUNDLE_NAME, CACHE_VERSION)
+
+
+def save_session_cache(project_folder, session: dict, sources):
+    """
+    session holds the arrays to store plus 'time_name'; writes atomically so a crash can't leave half a bundle.
+    sources are the source_signatures taken before the session was read.
+    """
+    _save_bundle(project_folder, SESSION_BUNDLE_NAME, CACHE_VERSION, session, sources,
+                 {'time_name': session['time_name']})
+
+
+def load_trace_store(project_folder):
+    """ The session's memory-mapped TraceStore, or None if it hasn't been built or the trace CSV changed since """
+    from .trace_store import open_store
+
+    store = open_store(cache_dir(project_folder) / TRACE_STORE_DIR_NAME)
+    if store is None:
+        return None
+
+    trace_path = pathlib.Path(project_folder.inscopix_dir.cell_trace_path)
+    matched, current_sources = _check_sources([trace_path], store.meta['extra'].get('sources', []))
+    if not matched:
+        return None
+
+    if current_sources is not None:  # Same content under a new mtime; remember it so it isn't hashed again
+        store.meta['extra']['sources'] = current_sources
+        try:
+            store.save_meta()
+        except OSError:  # Still a valid store; the hash is just checked again next time
+            pass
+
+    return store
+
+
+def build_trace_store(project_folder):
+    """ Streams the trace CSV into a new TraceStore in the cache folder; see trace_store.ingest_csv """
+    from .trace_store import ingest_csv
+
+    trace_path = pathlib.Path(project_folder.inscopix_dir.cell_trace_path)
+    directory = cache_dir(project_folder)
+    directory.mkdir(exist_ok=True)
+
+    sources = [_file_signature(trace_path, with_hash=True)]  # Before reading it, so a mid-ingest change shows up
+    return ingest_csv(trace_path, directory / TRACE_STORE_DIR_NAME, meta={'sources': sources})
+
+
+def load_metrics_cache(project_folder, cell_names):
+    """ Returns the cached {metric: values} for cell_names (in that order), or None if any of them isn't cached """
+    bundle = _load_bundle(project_folder, METRICS_BUNDLE_NAME, METRICS_VERSION)
+    if bundle is None:
+        return None
+
+    cached_rows = {cell: i for i, cell in enumerate(bundle.pop('cell_names').tolist())}
+    if not all(cell in cached_rows for cell in cell_names):
+        return None
+
+    rows = [cached_rows[cell] for cell in cell_names]
+    return {metric: values[rows] for metric, values in bundle.items()}
+
+
+def save_metrics_cache(project_folder, cell_names, metrics: dict, sources):
+    """ sources are the source_signatures taken before the data the metrics came from was read """
+    arrays = {metric: np.asarray(values, dtype=np.float64) for metric, values in metrics.items()}
+    arrays['cell_names'] = np.asarray(cell_names, dtype=str)
+    _save_bundle(project_folder, METRICS_BUNDLE_NAME, METRICS_VERSION, arrays, sources)
+
+
+def _load_bundle(project_folder, bundle_name, version):
+    bundle_path = cache_dir(project_folder) / bundle_name
+    if not bundle_path.exists():
+        return None
+
+    try:
+        with np.load(bundle_path, allow_pickle=False) as bundle:
+            meta = json.loads(str(bundle['meta']))
+            if meta.get('version') != version:
+                return None
+            matched, current_sources = _check_sources(source_paths(project_folder), meta['sources'])
+            if not matched:
+                return None
+
+            contents = {key: bundle[key] for key in bundle.files if key != 'meta'}
+    except (OSError, ValueError, KeyError):  # Partially written or from an incompatible version
+        return None
+
+    if current_sources is not None:  # Same content under a new mtime; one rewrite instead of a hash every launch
+        meta['sources'] = current_sources
+        try:
+            _write_bundle(bundle_path, meta, contents)
+        except OSError:  # Still a valid bundle; the hash is just checked again next time
+            pass
+
+    contents.update(meta.get('extra', {}))
+    return contents
+
+
+def _save_bundle(project_folder, bundle_name, version, contents: dict, sources, extra=None):
+    # extra holds the non-array values (e.g. the time column's name), which are kept in the JSON meta
+    signatures = _sign_unchanged(source_paths(project_folder), sources)
+    if signatures is None:  # A source changed after it was read; the next launch reads it again instead
+        return
+
+    directory = cache_dir(project_folder)
+    directory.mkdir(exist_ok=True)
+
+    extra = extra or {}
+    meta = {
+        'version': version,
+        'extra': extra,
+        'sources': signatures,
+    }
+    arrays = {key: value for key, value in contents.items() if key not in extra}
+
+    _write_bundle(directory / bundle_name, meta, arrays)
+
+
+def _write_bundle(bundle_path, meta, arrays):
+    temp_path = bundle_path.with_suffix('.tmp.npz')
+    np.savez(temp_path, meta=np.array(json.dumps(meta)), **arrays)  # Uncompressed; float traces barely compress
+    os.replace(temp_path, bundle_path)
+
+
+def _check_sources(paths, stored_signatures):
+    """
+    (matched, current signatures). The signatures are only returned when a file's mtime moved but its hash still
+    matches, so the caller can store them and skip hashing next time; otherwise they're None.
+    """
+    if len(paths) != len(stored_signatures):
+        return False, None
+
+    current_signatures = []
+    refreshed = False
+    for path, stored in zip(paths, stored_signatures):
+        if not path.exists():
+            return False, None
+
+        current = _file_signature(path, with_hash=False)
+        if current['size'] != stored['size']:
+            return False, None
+
+        if current['mtime_ns'] != stored['mtime_ns']:
+            if _hash_file(path) != stored['hash']:
+                return False, None
+            refreshed = True
+
+        current['hash'] = stored['hash']
+        current_signatures.append(current)
+
+    return True, current_signatures if refreshed else None
+
+
+def _sign_unchanged(paths, read_signatures):
+    """ Hashed signatures of paths, or None if any file's size or mtime no longer matches read_signatures """
+    signatures = []
+    for path, read in zip(paths, read_signatures):
+        if read is None or not path.exists():
+            return None
+
+        signature = _file_signature(path, with_hash=True)
+        # Checked again after hashing too, so a write while it was being hashed isn't missed
+        if any(current['size'] != read['size'] or current['mtime_ns'] != read['mtime_ns']
+               for current in (signature, _file_signature(path, with_hash=False))):
+            return None
+        signatures.append(signature)
+
+    return signatures
+
+
+def _file_signature(path, with_hash):
+    stat = path.stat()
+    signature = {'name': path.name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    if with_hash:
+        signature['hash'] = _hash_file(path)
+
+    return signature
+
+
+def _hash_file(path):
+    file_hash = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
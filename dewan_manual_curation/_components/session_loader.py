@@ -0,0 +1,218 @@
+""" Concurrent, progressive loading of a session's traces, props and contours """
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from PySide6.QtCore import QObject, Signal
+
+from .analog_trace import TraceMatrix
+from .contours import ContourStore
+from .instrumentation import stage
+from .trace_store import TraceStore
+
+TRACE_CHUNK_SIZE = 32  # Cells prepared per chunk; small enough that the first rows show up almost immediately
+
+logger = logging.getLogger(__name__)
+
+
+class SessionLoader(QObject):
+    """
+    Runs the three independent loads (traces, cell names from the props, contours) concurrently in a thread pool.
+    cells_ready fires as soon as the names and contours are in, which is everything the max projection and cell lists
+    need; once stream_traces() is called the trace matrix is prepared in chunks and each one is sent out through
+    traces_ready. Every public signal is delivered on the GUI thread. Optional tasks that fail (metrics, pairs) are
+    logged and reported through warning rather than failing the load.
+    """
+    cells_ready = Signal(object, object, object)  # (cell_names, ContourStore, cell_centroids)
+    traces_ready = Signal(int, object)  # (first row, TraceMatrix chunk)
+    metrics_ready = Signal(object)  # Per-cell metrics DataFrame
+    pairs_ready = Signal(object)  # Correlated cell pairs DataFrame
+    progress = Signal(int, int, str)  # (done, total, message)
+    finished = Signal()
+    failed = Signal(str)
+    warning = Signal(str)  # Something optional couldn't be loaded; the session is still usable
+    _task_done = Signal(str, object)  # Emitted from pool threads; (task name, result)
+    _task_failed = Signal(str, str)  # (task name, error)
+
+    def __init__(self, load_traces, load_cell_names, load_contours, cell_centroids=None, save_session=None,
+                 load_metrics=None, find_pairs=None, chunk_size=TRACE_CHUNK_SIZE, low_memory=False, parent=None):
+        """
+        The load_* arguments are zero-argument callables returning the preprocessed trace DataFrame (or a
+        TraceStore), the cell names and the contours respectively. save_session, if given, is called with the
+        prepared session once every trace chunk is out (e.g. to write the session cache). load_metrics, if given, is
+        called alongside the trace chunks with (cell_trace_data, cell_names, cell_contours) and its result is sent
+        out through metrics_ready; find_pairs is the same for pairs_ready. low_memory is passed on to every
+        TraceMatrix chunk. The trace DataFrame is let go once the chunks, metrics and pairs are done with it; from then
+        on the chunks' float32 matrices are the only copy of the traces. A TraceStore's chunks are views of its
+        memmap instead.
+        """
+        super().__init__(parent)
+        self.loaders = {'traces': load_traces, 'cell_names': load_cell_names, 'contours': load_contours}
+        self.cell_centroids = cell_centroids
+        self.save_session = save_session
+        self.load_metrics = load_metrics
+        self.find_pairs = find_pairs
+        self.chunk_size = chunk_size
+        self.low_memory = low_memory
+
+        self.executor = None
+        self.results = {}
+        self.cells_loaded = False
+        self.streaming = False
+        self.stream_started = False
+        self.cancelled = False
+        self.done = False
+        self.trace_consumers = set()  # Tasks still reading the trace DataFrame
+
+        self._task_done.connect(self._on_task_done)
+        self._task_failed.connect(self._on_task_failed)
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=len(self.loaders))
+        self.progress.emit(0, len(self.loaders), 'Loading session data...')
+
+        for name, loader in self.loaders.items():
+            self.executor.submit(self._run_task, name, loader)
+
+    def stream_traces(self):
+        """ Call once the receivers of traces_ready are connected; chunks start as soon as the traces are read """
+        self.streaming = True
+        self._maybe_stream_traces()
+
+    def cancel(self):
+        if self.done or self.cancelled:
+            return
+
+        self.cancelled = True
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run_task(self, name, task):
+        if self.cancelled:
+            return
+
+        try:
+            result = task()
+        except Exception as e:  # Surfaced through failed() on the GUI thread rather than lost in the pool
+            self._task_failed.emit(name, repr(e))
+            return
+
+        self._task_done.emit(name, result)
+
+    def _on_task_done(self, name, result):
+        if self.cancelled:
+            return
+
+        self._release_traces(name)
+
+        if name == 'metrics':
+            self.metrics_ready.emit(result)
+            return
+
+        if name == 'pairs':
+            self.pairs_ready.emit(result)
+            return
+
+        if name == 'chunks':  # Every trace chunk is out (and the session saved, if asked for)
+            self.done = True
+            self.executor.shutdown(wait=False)
+            self.finished.emit()
+            return
+
+        self.results[name] = result
+        loaded = [key for key in self.loaders if key in self.results]
+        self.progress.emit(len(loaded), len(self.loaders), f'Loaded {", ".join(loaded).replace("_", " ")}...')
+
+        if name in ('cell_names', 'contours') and 'cell_names' in self.results and 'contours' in self.results:
+            self._on_cells_loaded()
+
+        self._maybe_stream_traces()
+
+    def _on_task_failed(self, name, error):
+        if self.cancelled:
+            return
+
+        self._release_traces(name)
+
+        if name == 'metrics':  # The session is still usable without them; the sort/filter controls just stay empty
+            self._warn(f'Unable to compute cell metrics: {error}')
+            return
+
+        if name == 'pairs':
+            self._warn(f'Unable to find correlated cell pairs: {error}')
+            return
+
+        logger.warning('Unable to load %s: %s', name.replace('_', ' '), error)
+        self.cancel()
+        self.failed.emit(f'{name}: {error}')
+
+    def _warn(self, message):
+        logger.warning(message)
+        self.warning.emit(message)
+
+    def _on_cells_loaded(self):
+        cell_names = list(self.results['cell_names'])
+        cell_contours = ContourStore.from_dict(cell_names, self.results['contours'])
+
+        if self.cell_centroids is None:  # Not cached, so work them out now; vectorized over every cell
+            self.cell_centroids = dict(zip(cell_names, map(tuple, cell_contours.centroids())))
+
+        self.results['contours'] = cell_contours
+        self.cells_loaded = True
+        self.cells_ready.emit(cell_names, cell_contours, self.cell_centroids)
+
+    def _maybe_stream_traces(self):
+        if self.stream_started or not self.streaming or not self.cells_loaded or 'traces' not in self.results:
+            return
+
+        self.stream_started = True
+        self.trace_consumers.add('chunks')
+        self.executor.submit(self._run_task, 'chunks', self._prepare_chunks)
+
+        for name, task in (('metrics', self.load_metrics), ('pairs', self.find_pairs)):
+            if task is not None:
+                task = partial(task, self.results['traces'], list(self.results['cell_names']),
+                               self.results['contours'])
+                self.trace_consumers.add(name)
+                self.executor.submit(self._run_task, name, task)
+
+    def _release_traces(self, finished_task):
+        if finished_task not in self.trace_consumers:
+            return
+
+        self.trace_consumers.discard(finished_task)
+        if not self.trace_consumers:
+            self.results.pop('traces', None)
+            self.loaders['traces'] = None  # May be a closure over the DataFrame (e.g. a cached session)
+
+    def _prepare_chunks(self):
+        # Runs on a pool thread; each chunk is normalized and gets its envelope pyramid before it's handed over
+        cell_names = list(self.results['cell_names'])
+        cell_trace_data = self.results['traces']
+        n_cells = len(cell_names)
+
+        with stage('trace_generation'):
+            for first_row, chunk_names, trace_matrix in self._trace_chunks(cell_trace_data, cell_names):
+                if self.cancelled:
+                    return
+
+                self.traces_ready.emit(first_row, trace_matrix)
+
+                done = first_row + len(chunk_names)
+                self.progress.emit(done, n_cells, f'Preparing traces ({done}/{n_cells})...')
+
+        if self.save_session is not None:
+            self.save_session(cell_trace_data, cell_names, self.results['contours'], self.cell_centroids)
+
+    def _trace_chunks(self, cell_trace_data, cell_names):
+        if isinstance(cell_trace_data, TraceStore):
+            # Chunks are runs of neighboring rows in the store, so each one is a view of the memmap, never a copy
+            for first_row, chunk_names, rows in cell_trace_data.runs(cell_names, self.chunk_size):
+                yield first_row, chunk_names, TraceMatrix(chunk_names, rows,
+                                                          row_stats=cell_trace_data.row_stats(chunk_names))
+            return
+
+        for first_row in range(0, len(cell_names), self.chunk_size):
+            chunk_names = cell_names[first_row:first_row + self.chunk_size]
+            yield first_row, chunk_names, TraceMatrix(chunk_names, cell_trace_data[chunk_names].to_numpy().T,
+                                                      low_memory=self.low_memory)
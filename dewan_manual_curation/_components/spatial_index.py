@@ -0,0 +1,99 @@
+""" Uniform-grid spatial index over cell outlines for picking cells on the max projection """
+import numpy as np
+
+
+class SpatialIndex:
+    """
+    Buckets every outline's bounding box into a uniform grid once, so a pick only has to test the handful of
+    outlines sharing the query's grid cell instead of every polygon in the scene. Coordinates are in contour units.
+    """
+    def __init__(self, contour_store, bin_size=None):
+        self.contour_store = contour_store
+        self.bounding_boxes = self._bounding_boxes(contour_store)  # (n_cells, 4): min_x, min_y, max_x, max_y
+        self.areas = contour_store.areas()
+
+        extents = self.bounding_boxes[:, 2:] - self.bounding_boxes[:, :2]
+        if bin_size is None:  # About one outline per bin keeps the candidate lists short
+            bin_size = float(np.nanmedian(extents)) if np.isfinite(extents).any() else 1.0
+        self.bin_size = max(bin_size, 1.0)
+
+        self.bins = {}
+        self._build_bins()
+
+    def cells_at(self, x, y):
+        """ Indices of every outline containing (x, y), smallest first so the most specific ROI wins overlaps """
+        candidates = self.bins.get(self._bin_of(x, y))
+        if candidates is None:
+            return []
+
+        boxes = self.bounding_boxes[candidates]
+        in_box = (boxes[:, 0] <= x) & (x <= boxes[:, 2]) & (boxes[:, 1] <= y) & (y <= boxes[:, 3])
+
+        hits = [i for i in candidates[in_box]
+                if points_in_polygon(np.array([[x, y]]), self.contour_store.outline(i))[0]]
+
+        return sorted(hits, key=lambda i: self.areas[i])
+
+    def cells_in_polygon(self, polygon):
+        """ Indices of every outline that lies entirely inside polygon (e.g. a lasso drawn by the user) """
+        polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+        if len(polygon) < 3:
+            return []
+
+        lasso_min = polygon.min(axis=0)
+        lasso_max = polygon.max(axis=0)
+
+        boxes = self.bounding_boxes
+        candidates = np.flatnonzero((boxes[:, 0] >= lasso_min[0]) & (boxes[:, 1] >= lasso_min[1]) &
+                                    (boxes[:, 2] <= lasso_max[0]) & (boxes[:, 3] <= lasso_max[1]))
+
+        return [i for i in candidates if points_in_polygon(self.contour_store.outline(i), polygon).all()]
+
+    def _bin_of(self, x, y):
+        return int(np.floor(x / self.bin_size)), int(np.floor(y / self.bin_size))
+
+    def _build_bins(self):
+        has_outline = np.isfinite(self.bounding_boxes).all(axis=1)
+        boxes = np.nan_to_num(self.bounding_boxes)
+        first_bins = np.floor(boxes[:, :2] / self.bin_size).astype(int)
+        last_bins = np.floor(boxes[:, 2:] / self.bin_size).astype(int)
+
+        bins = {}
+        for i in np.flatnonzero(has_outline):
+            (x0, y0), (x1, y1) = first_bins[i], last_bins[i]
+            for bin_x in range(x0, x1 + 1):
+                for bin_y in range(y0, y1 + 1):
+                    bins.setdefault((bin_x, bin_y), []).append(i)
+
+        self.bins = {key: np.array(indices) for key, indices in bins.items()}
+
+    @staticmethod
+    def _bounding_boxes(contour_store):
+        boxes = np.full((len(contour_store), 4), np.nan)
+
+        non_empty = np.diff(contour_store.offsets) > 0
+        starts = contour_store.offsets[:-1][non_empty]
+        coordinates = contour_store.coordinates
+
+        if len(starts):
+            boxes[non_empty, :2] = np.minimum.reduceat(coordinates, starts, axis=0)
+            boxes[non_empty, 2:] = np.maximum.reduceat(coordinates, starts, axis=0)
+
+        return boxes
+
+
+def points_in_polygon(points, polygon):
+    """ Even-odd ray casting for many points against one polygon at once; returns a boolean per point """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    x = points[:, 0, np.newaxis]
+    y = points[:, 1, np.newaxis]
+
+    x1, y1 = polygon[:, 0], polygon[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+
+    straddles = (y1 > y) != (y2 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing_x = (x2 - x1) * (y - y1) / (y2 - y1) + x1
+    crossings = straddles & (x < crossing_x)
+
+    return (crossings.sum(axis=1) % 2) == 1
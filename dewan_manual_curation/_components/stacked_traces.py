@@ -0,0 +1,131 @@
+""" Single-canvas trace panel: every visible cell is a lane drawn in one QPainter pass """
+import math
+
+import numpy as np
+
+from PySide6.QtCore import QPointF, QRectF, QSize, Qt
+from PySide6.QtGui import QColor, QPainter, QPen
+from PySide6.QtWidgets import QAbstractScrollArea
+
+from .painter_renderer import envelope_polygon
+from .trace_plotting import scale_to_range
+
+LANE_HEIGHT = 48  # Pixels per cell
+LANE_PADDING = 4  # Gap above and below each trace so neighbouring lanes don't touch
+NAME_GUTTER = 90  # Room on the left for the cell names
+
+
+class StackedTraceView(QAbstractScrollArea):
+    """
+    Draws the rows of a TraceListModel as vertically offset lines in one widget instead of a row widget per cell.
+    Scrolling only moves the window of lanes that get painted, and hiding cells updates a visibility mask and re-packs
+    the lanes that are left. Follows the model's sort order (layoutChanged) and time window/new traces (dataChanged).
+    """
+    def __init__(self, model, lane_height=LANE_HEIGHT, parent=None):
+        super().__init__(parent)
+        self.model = model
+        self.lane_height = lane_height
+
+        n_rows = model.rowCount()
+        self.visible_rows = np.ones(n_rows, dtype=bool)  # Indexed by source row
+        self.lanes = np.arange(n_rows)  # Source rows of the visible cells, top to bottom
+
+        self.trace_pen = QPen(QColor(Qt.GlobalColor.black), 1)
+        self.reference_pen = QPen(QColor(Qt.GlobalColor.red), 1, Qt.PenStyle.DashLine)
+        self.separator_pen = QPen(QColor(Qt.GlobalColor.lightGray), 1)
+        self.name_pen = QPen(QColor(Qt.GlobalColor.black))
+        self.placeholder_pen = QPen(QColor(Qt.GlobalColor.gray))
+
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAsNeeded)
+
+        model.dataChanged.connect(lambda *_: self.viewport().update())
+        model.layoutChanged.connect(self._repack)
+
+    def set_visible_rows(self, visible_rows):
+        """ visible_rows is a boolean mask over the model's source rows """
+        self.visible_rows = np.array(visible_rows, dtype=bool)
+        self._repack()
+
+    def scroll_to_row(self, row):
+        lane = np.flatnonzero(self.lanes == row)
+        if len(lane) == 0:  # Hidden
+            return
+
+        viewport_height = self.viewport().height()
+        self.verticalScrollBar().setValue(int(lane[0] * self.lane_height - (viewport_height - self.lane_height) / 2))
+
+    def sizeHint(self):
+        return QSize(1000, 10 * self.lane_height)
+
+    def paintEvent(self, event):
+        painter = QPainter(self.viewport())
+        painter.fillRect(self.viewport().rect(), QColor(Qt.GlobalColor.white))
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+
+        top = self.verticalScrollBar().value()
+        first_lane = top // self.lane_height
+        last_lane = min(math.ceil((top + self.viewport().height()) / self.lane_height), len(self.lanes))
+
+        n_samples = self.model.n_samples()
+        time_window = self.model.time_window or (0, n_samples)
+        trace_width = max(self.viewport().width() - NAME_GUTTER, 1)
+        trace_size = QSize(trace_width, self.lane_height)
+
+        for lane in range(first_lane, last_lane):
+            row = int(self.lanes[lane])
+            lane_top = lane * self.lane_height - top
+            self._paint_lane(painter, row, lane_top, trace_size, time_window, n_samples is not None)
+
+        painter.end()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._update_scroll_range()
+
+    def scrollContentsBy(self, dx, dy):
+        self.viewport().update()
+
+    def _paint_lane(self, painter, row, lane_top, trace_size: QSize, time_window, have_samples):
+        ready = have_samples and self.model.is_row_ready(row)
+
+        painter.setPen(self.name_pen if ready else self.placeholder_pen)
+        painter.drawText(QRectF(4, lane_top, NAME_GUTTER - 8, self.lane_height),
+                         Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignLeft,
+                         str(self.model.trace_source.cells[row]))
+
+        painter.setPen(self.separator_pen)
+        lane_bottom = lane_top + self.lane_height - 0.5
+        painter.drawLine(QPointF(0, lane_bottom), QPointF(self.viewport().width(), lane_bottom))
+
+        if not ready:  # Still loading
+            return
+
+        plot_kwargs = self.model.trace_source.plot_kwargs(row, trace_size, time_window)
+        trace_rect = QRectF(NAME_GUTTER, lane_top + LANE_PADDING, trace_size.width(),
+                            self.lane_height - 2 * LANE_PADDING)
+
+        painter.setPen(self.trace_pen)
+        painter.drawPolyline(envelope_polygon(trace_rect, plot_kwargs['x_values'], plot_kwargs['lows'],
+                                              plot_kwargs['highs'], plot_kwargs['x_window']))
+
+        y_line_val = scale_to_range(plot_kwargs['trace_mean'], plot_kwargs['trace_min'], plot_kwargs['trace_max'],
+                                    (0, 1))
+        y_line = trace_rect.bottom() - y_line_val * trace_rect.height()
+        painter.setPen(self.reference_pen)
+        painter.drawLine(QPointF(trace_rect.left(), y_line), QPointF(trace_rect.right(), y_line))
+
+    def _repack(self):
+        row_order = self.model.row_order
+        order = np.arange(len(self.visible_rows)) if row_order is None else np.asarray(row_order)
+        self.lanes = order[self.visible_rows[order]]
+
+        self._update_scroll_range()
+        self.viewport().update()
+
+    def _update_scroll_range(self):
+        viewport_height = self.viewport().height()
+        scroll_bar = self.verticalScrollBar()
+        scroll_bar.setRange(0, max(len(self.lanes) * self.lane_height - viewport_height, 0))
+        scroll_bar.setPageStep(viewport_height)
+        scroll_bar.setSingleStep(self.lane_height)
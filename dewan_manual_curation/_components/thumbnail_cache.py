@@ -0,0 +1,135 @@
+""" Persistent cache of rendered trace rows, so re-opening a session blits images instead of re-rasterizing them """
+import logging
+import os
+import pathlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtGui import QImage
+
+THUMBNAIL_DIR_NAME = 'thumbnails'
+DEFAULT_MAX_BYTES = 256 * 2 ** 20
+IMAGE_SUFFIX = '.png'
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailCache:
+    """
+    Rendered rows stored as PNGs named by their content key (see TraceMatrix.thumbnail_key), capped at max_bytes with
+    least-recently-used eviction. A hit touches the file's mtime so recency survives restarts. PNG encoding and
+    eviction run on a single writer thread so they never hold up painting. hits/misses/writes/evictions count what
+    the cache has done since it was opened; stats() has them all.
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+        self.entries = OrderedDict()  # key: file size, least recently used first
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.writer = ThreadPoolExecutor(max_workers=1)
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+        self._scan()
+
+    def get(self, key) -> QImage | None:
+        with self.lock:
+            cached = key in self.entries
+            if cached:
+                self.entries.move_to_end(key)
+
+        image = QImage(str(self._path(key))) if cached else None
+        if image is None or image.isNull():  # Not cached, or the file went missing/bad behind our back
+            if cached:
+                self._forget(key)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        return image
+
+    def put(self, key, image: QImage):
+        with self.lock:
+            if key in self.entries:
+                return
+        self.writer.submit(self._write, key, image.copy())  # A detached copy is safe to encode on the writer thread
+
+    def flush(self):
+        """ Waits for every queued write to land """
+        self.writer.submit(lambda: None).result()
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+
+    def stats(self):
+        with self.lock:
+            n_entries, total_bytes = len(self.entries), self.total_bytes
+
+        return {'hits': self.hits, 'misses': self.misses, 'writes': self.writes, 'evictions': self.evictions,
+                'entries': n_entries, 'bytes': total_bytes}
+
+    def _write(self, key, image: QImage):
+        path = self._path(key)
+        temp_path = path.with_suffix('.tmp' + IMAGE_SUFFIX)
+
+        try:
+            if not image.save(str(temp_path), 'PNG'):
+                raise OSError(f'Unable to encode {path.name}')
+            os.replace(temp_path, path)
+            size = path.stat().st_size
+        except OSError as e:  # Out of space, read-only folder, ...; the row just gets rendered again next time
+            logger.warning('Unable to cache a rendered trace: %s', e)
+            temp_path.unlink(missing_ok=True)
+            return
+
+        with self.lock:
+            self.entries[key] = size
+            self.total_bytes += size
+            self.writes += 1
+            self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            self._path(key).unlink(missing_ok=True)
+
+    def _forget(self, key):
+        with self.lock:
+            size = self.entries.pop(key, None)
+            if size is not None:
+                self.total_bytes -= size
+
+    def _scan(self):
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(IMAGE_SUFFIX):
+                continue
+            if entry.name.endswith('.tmp' + IMAGE_SUFFIX):  # Left over from a crash mid-write
+                pathlib.Path(entry.path).unlink(missing_ok=True)
+                continue
+
+            stat = entry.stat()
+            found.append((stat.st_mtime_ns, entry.name[:-len(IMAGE_SUFFIX)], stat.st_size))
+
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+
+        with self.lock:
+            self._evict()  # The cap may have been lowered since the last session
+
+    def _path(self, key):
+        return self.directory / f'{key}{IMAGE_SUFFIX}'
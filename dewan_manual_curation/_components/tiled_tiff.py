@@ -0,0 +1,141 @@
+""" Minimal streaming writer for uncompressed, tiled, 8-bit RGB TIFF files """
+import math
+import os
+import pathlib
+import struct
+
+# Baseline/extension TIFF tag ids and field types used below
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC_INTERPRETATION = 262
+SAMPLES_PER_PIXEL = 277
+PLANAR_CONFIGURATION = 284
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+
+SHORT = 3
+LONG = 4
+
+MAX_CLASSIC_TIFF_BYTES = 2 ** 32
+
+
+class TiledTiffWriter:
+    """
+    Tiles are appended to the file as they arrive and the directory is written once at close(), so only one tile ever
+    has to be in memory. Tiles are tile_size x tile_size RGB888 rows; edge tiles are padded to the full size as the
+    format requires. The file is written to a temporary path and moved into place on close.
+    """
+    def __init__(self, path, width, height, tile_size=256):
+        if tile_size % 16 != 0:
+            raise ValueError(f'TIFF tile sizes must be a multiple of 16, got {tile_size}')
+
+        self.path = pathlib.Path(path)
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.samples_per_pixel = 3
+
+        self.tiles_across = math.ceil(width / tile_size)
+        self.tiles_down = math.ceil(height / tile_size)
+        self.n_tiles = self.tiles_across * self.tiles_down
+        self.tile_bytes = tile_size * tile_size * self.samples_per_pixel
+
+        if self.n_tiles * self.tile_bytes >= MAX_CLASSIC_TIFF_BYTES:
+            raise ValueError(f'A {width}x{height} image is too large for a classic TIFF; lower the export scale')
+
+        self.tile_offsets = [0] * self.n_tiles
+        self.tile_byte_counts = [0] * self.n_tiles
+
+        self.temp_path = self.path.with_suffix('.tmp.tif')
+        self.file = open(self.temp_path, 'wb')
+        self.file.write(struct.pack('<2sHI', b'II', 42, 0))  # First IFD offset is patched in at close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write_tile(self, index, data):
+        """ index counts tiles left to right, then top to bottom """
+        if len(data) != self.tile_bytes:
+            raise ValueError(f'Tile {index} has {len(data)} bytes, expected {self.tile_bytes}')
+
+        self.tile_offsets[index] = self.file.tell()
+        self.tile_byte_counts[index] = len(data)
+        self.file.write(data)
+
+    def close(self):
+        if self.file is None:
+            return
+
+        if not all(self.tile_byte_counts):
+            missing = self.tile_byte_counts.count(0)
+            self.abort()
+            raise ValueError(f'{missing} of {self.n_tiles} tiles were never written')
+
+        self._write_directory()
+        self.file.close()
+        self.file = None
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        if self.file is None:
+            return
+
+        self.file.close()
+        self.file = None
+        self.temp_path.unlink(missing_ok=True)
+
+    def _write_directory(self):
+        entries = [
+            (IMAGE_WIDTH, LONG, [self.width]),
+            (IMAGE_LENGTH, LONG, [self.height]),
+            (BITS_PER_SAMPLE, SHORT, [8] * self.samples_per_pixel),
+            (COMPRESSION, SHORT, [1]),  # None
+            (PHOTOMETRIC_INTERPRETATION, SHORT, [2]),  # RGB
+            (SAMPLES_PER_PIXEL, SHORT, [self.samples_per_pixel]),
+            (PLANAR_CONFIGURATION, SHORT, [1]),  # Chunky (RGBRGB...)
+            (TILE_WIDTH, LONG, [self.tile_size]),
+            (TILE_LENGTH, LONG, [self.tile_size]),
+            (TILE_OFFSETS, LONG, self.tile_offsets),
+            (TILE_BYTE_COUNTS, LONG, self.tile_byte_counts),
+        ]
+
+        if self.file.tell() % 2:  # The directory has to start on a word boundary
+            self.file.write(b'\0')
+        directory_offset = self.file.tell()
+
+        # Values that don't fit in the 4 bytes of an entry go after the directory
+        directory_size = 2 + len(entries) * 12 + 4
+        overflow_offset = directory_offset + directory_size
+        packed_entries = []
+        overflow = bytearray()
+
+        for tag, field_type, values in entries:
+            value_format = 'H' if field_type == SHORT else 'I'
+            value_bytes = struct.pack(f'<{len(values)}{value_format}', *values)
+
+            if len(value_bytes) <= 4:
+                packed_entries.append(struct.pack('<HHI', tag, field_type, len(values)) + value_bytes.ljust(4, b'\0'))
+            else:
+                packed_entries.append(struct.pack('<HHII', tag, field_type, len(values),
+                                                  overflow_offset + len(overflow)))
+                overflow += value_bytes
+                if len(overflow) % 2:
+                    overflow += b'\0'
+
+        self.file.write(struct.pack('<H', len(entries)))
+        self.file.write(b''.join(packed_entries))
+        self.file.write(struct.pack('<I', 0))  # No further directories
+        self.file.write(overflow)
+
+        self.file.seek(4)
+        self.file.write(struct.pack('<I', directory_offset))
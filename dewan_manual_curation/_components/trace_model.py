@@ -0,0 +1,229 @@
+""" Model/View classes for the cell trace panel """
+from collections import OrderedDict
+
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex, QSize, Signal
+from PySide6.QtGui import QPixmap, QImage, QColor
+from PySide6.QtWidgets import QAbstractItemView, QStyledItemDelegate
+
+from .memory_budget import MIN_CACHED_ROWS
+
+PIXMAP_CACHE_SIZE = 64  # Rendered rows kept around; only needs to cover a few screens worth of traces
+
+
+class TraceListModel(QAbstractListModel):
+    row_ready = Signal(object, QPixmap)  # (cache key, pixmap) for rows rendered by the render engine
+
+    def __init__(self, trace_source, render_engine=None, parent=None, thumbnail_cache=None):
+        super().__init__(parent)
+        self.trace_source = trace_source
+        self.time_window = None  # (start, stop) in samples; None shows the whole trace
+        # Display order as a list of source rows (None keeps the source order). Everything else -- cache keys, render
+        # jobs, TraceRow handles -- works in source rows, so re-sorting never invalidates a rendered row
+        self.row_order = None
+        self.view_rows = None
+        self.tooltips = None
+
+        self.render_engine = None
+        if render_engine is not None and hasattr(trace_source, 'render_job'):  # Pre-plotted traces render in-process
+            self.render_engine = render_engine
+            self.render_engine.image_ready.connect(self._on_image_ready)
+
+        # On-disk ThumbnailCache; only sources that can name a row by its content (thumbnail_key) use it
+        self.thumbnail_cache = thumbnail_cache if hasattr(trace_source, 'thumbnail_key') else None
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.trace_source)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+
+        row = self.source_row(index.row())
+
+        if role == Qt.ItemDataRole.DisplayRole:
+            return str(self.trace_source.cells[row])
+        elif role == Qt.ItemDataRole.SizeHintRole:
+            return self.trace_source.size_hint(row)
+        elif role == Qt.ItemDataRole.ToolTipRole and self.tooltips is not None:
+            return self.tooltips[row]
+
+        return None
+
+    def source_row(self, row):
+        return row if self.row_order is None else self.row_order[row]
+
+    def view_row(self, source_row):
+        return source_row if self.view_rows is None else self.view_rows[source_row]
+
+    def set_row_order(self, row_order):
+        """ Re-sorts the panel; row_order lists source rows in display order, or None for the source order """
+        self.layoutAboutToBeChanged.emit()
+
+        old_source_rows = [self.source_row(index.row()) for index in self.persistentIndexList()]
+        self.row_order = None if row_order is None else list(row_order)
+        self.view_rows = None if row_order is None else {row: i for i, row in enumerate(self.row_order)}
+
+        # Moves the view's own per-row state (e.g. hidden rows) along with the cells
+        self.changePersistentIndexList(self.persistentIndexList(),
+                                       [self.index(self.view_row(row)) for row in old_source_rows])
+        self.layoutChanged.emit()
+
+    def set_tooltips(self, tooltips):
+        """ One tooltip string per source row, e.g. the cell's metrics """
+        self.tooltips = tooltips
+
+    def cache_key(self, row, size: QSize):
+        return self.source_row(row), size.width(), size.height(), self.time_window
+
+    def request_row(self, row, size: QSize):
+        """ Renders the row right away, or queues it on the render engine and returns None until row_ready fires """
+        source_row = self.source_row(row)
+        if not self.is_row_ready(source_row):  # Still loading; add_traces repaints it once it arrives
+            return None
+
+        thumbnail_key = self._thumbnail_key(source_row, size, self.time_window)
+        if thumbnail_key is not None:
+            image = self.thumbnail_cache.get(thumbnail_key)
+            if image is not None:
+                return QPixmap.fromImage(image)
+
+        if self.render_engine is None:
+            return self.render_row(row, size)
+
+        job = self.trace_source.render_job(self.cache_key(row, size), source_row, size, self.time_window)
+        self.render_engine.submit(job)
+        return None
+
+    def render_row(self, row, size: QSize) -> QPixmap:
+        source_row = self.source_row(row)
+        image = self.trace_source.render(source_row, size, self.time_window)
+        self._store_thumbnail(source_row, size, self.time_window, image)
+        return QPixmap.fromImage(image)
+
+    def _on_image_ready(self, key, image: QImage):
+        source_row, width, height, time_window = key  # The window the job was rendered for, not necessarily today's
+        self._store_thumbnail(source_row, QSize(width, height), time_window, image)
+        self.row_ready.emit(key, QPixmap.fromImage(image))
+        row_index = self.index(self.view_row(key[0]))
+        self.dataChanged.emit(row_index, row_index)
+
+    def _thumbnail_key(self, source_row, size: QSize, time_window):
+        if self.thumbnail_cache is None:
+            return None
+        return self.trace_source.thumbnail_key(source_row, size, time_window)
+
+    def _store_thumbnail(self, source_row, size: QSize, time_window, image: QImage):
+        thumbnail_key = self._thumbnail_key(source_row, size, time_window)
+        if thumbnail_key is not None:
+            self.thumbnail_cache.put(thumbnail_key, image)
+
+    def n_samples(self):
+        return self.trace_source.n_samples
+
+    def is_row_ready(self, row):
+        return not hasattr(self.trace_source, 'is_ready') or self.trace_source.is_ready(row)
+
+    def add_traces(self, first_row, trace_matrix):
+        """ Fills in rows of a StreamingTraceMatrix source as a chunk of the session finishes loading """
+        self.trace_source.add_chunk(first_row, trace_matrix)
+
+        if self.row_order is None:
+            self.dataChanged.emit(self.index(first_row), self.index(first_row + len(trace_matrix) - 1))
+        else:  # The chunk is scattered through the sorted rows
+            self.dataChanged.emit(self.index(0), self.index(self.rowCount() - 1))
+
+    def set_time_window(self, start, stop):
+        self.time_window = (start, stop)
+        if self.render_engine is not None:  # Anything still queued is for the old window
+            self.render_engine.cancel_pending()
+        # One signal for every row; the view only repaints the rows that are on screen
+        self.dataChanged.emit(self.index(0), self.index(self.rowCount() - 1))
+
+
+class TraceDelegate(QStyledItemDelegate):
+    """
+    Paints trace rows from a bounded LRU cache so only rows that are actually on screen get rendered. With a
+    MemoryBudget the cache is also held to the bytes the budget has left over, down to MIN_CACHED_ROWS.
+    """
+    def __init__(self, parent=None, cache_size=PIXMAP_CACHE_SIZE, memory_budget=None):
+        super().__init__(parent)
+        self.cache_size = cache_size
+        self.memory_budget = memory_budget
+        self.pixmap_cache = OrderedDict()
+        self.cache_bytes = 0
+
+    def paint(self, painter, option, index):
+        pixmap = self._get_pixmap(index, option.rect.size())
+
+        if pixmap is None:  # Still being rendered; draw a placeholder with the cell name until it arrives
+            painter.fillRect(option.rect, QColor(Qt.GlobalColor.white))
+            painter.setPen(QColor(Qt.GlobalColor.gray))
+            painter.drawText(option.rect.adjusted(10, 0, 0, 0), Qt.AlignmentFlag.AlignVCenter,
+                             f'Cell: {index.data()}')
+            return
+
+        painter.drawPixmap(option.rect.topLeft(), pixmap)
+
+    def sizeHint(self, option, index):
+        return index.data(Qt.ItemDataRole.SizeHintRole)
+
+    def clear_cache(self):
+        self.pixmap_cache.clear()
+        self.cache_bytes = 0
+
+    def add_pixmap(self, key, pixmap: QPixmap):
+        old_pixmap = self.pixmap_cache.pop(key, None)
+        if old_pixmap is not None:
+            self.cache_bytes -= _pixmap_bytes(old_pixmap)
+
+        self.pixmap_cache[key] = pixmap
+        self.cache_bytes += _pixmap_bytes(pixmap)
+
+        while len(self.pixmap_cache) > self.cache_size or self._over_budget():
+            _, evicted = self.pixmap_cache.popitem(last=False)  # Evict the least recently drawn row
+            self.cache_bytes -= _pixmap_bytes(evicted)
+
+    def _over_budget(self):
+        if self.memory_budget is None or len(self.pixmap_cache) <= MIN_CACHED_ROWS:
+            return False
+        return self.cache_bytes > self.memory_budget.pixmap_bytes()
+
+    def _get_pixmap(self, index, size: QSize):
+        model = index.model()
+        key = model.cache_key(index.row(), size)
+
+        if key in self.pixmap_cache:
+            self.pixmap_cache.move_to_end(key)
+            return self.pixmap_cache[key]
+
+        pixmap = model.request_row(index.row(), size)
+        if pixmap is not None:
+            self.add_pixmap(key, pixmap)
+
+        return pixmap
+
+
+def _pixmap_bytes(pixmap: QPixmap):
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+
+class TraceRow:
+    """ Handle for a single row of the trace panel; stands in for the old QListWidgetItem in trace_pointers """
+    def __init__(self, view, row):
+        self.view = view
+        self.row = row
+
+    def setHidden(self, hide: bool):
+        self.view.setRowHidden(self._view_row(), hide)
+
+    def isHidden(self):
+        return self.view.isRowHidden(self._view_row())
+
+    def scroll_into_view(self):
+        self.view.scrollTo(self.view.model().index(self._view_row()), QAbstractItemView.ScrollHint.PositionAtCenter)
+
+    def _view_row(self):
+        # row is a source row; the panel may be sorted
+        return self.view.model().view_row(self.row)
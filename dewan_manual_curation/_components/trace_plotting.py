@@ -0,0 +1,123 @@
+""" Qt-free trace drawing shared by AnalogTrace and the render engine's worker processes """
+
+import numpy as np
+
+import matplotlib as mpl
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Let's set the default font to be Arial Bold 14pt
+mpl.rcParams['font.family'] = 'arial'
+mpl.rcParams['font.weight'] = 'bold'
+mpl.rcParams['font.size'] = 14
+
+
+def plot_envelope(axes, x_values, lows, highs, cell_name, trace_min, trace_max, trace_mean, x_window,
+                  figure_min_max=(0, 1), reference_line=True, reference_line_color='r', line_width=0.5):
+    """
+    Plots a min/max envelope taken from an EnvelopePyramid over already normalized data; trace_min/max/mean are the
+    original values from normalize_traces. When lows and highs are the same array (raw samples), this is an ordinary
+    line; otherwise each bin is drawn as a vertical stroke from its min to its max, which rasterizes the same as the
+    raw samples would at this resolution.
+    """
+    sub_name = f'Cell: {cell_name}'
+
+    ymin_label = round(float(trace_min), 4)
+    ymax_label = round(float(trace_max), 4)
+
+    if lows is highs:
+        x_2_plot = x_values
+        data_2_plot = lows
+    else:
+        x_2_plot = np.repeat(x_values, 2)
+        data_2_plot = np.column_stack((lows, highs)).ravel()
+
+    y_line_val = scale_to_range(trace_mean, trace_min, trace_max, figure_min_max)
+
+    axes.plot(x_2_plot, data_2_plot, color='k', linewidth=line_width)
+
+    start, stop = x_window
+    xaxis_offset = (stop - 1 - start) * 0.01
+    format_axes(axes, sub_name, ymin_label, ymax_label, (start - xaxis_offset, stop - 1 + xaxis_offset),
+                show_x_ticks=False, y_line_val=y_line_val if reference_line else None,
+                reference_line_color=reference_line_color)
+
+
+def plot_sniff(axes, time_values, sniff_data, lick_times, trial_name, trial_min, trial_max, x_limits,
+               line_width=1.0):
+    """
+    Plots one FV-aligned sniff trial (already normalized) from a SniffTrialMatrix row; the trial's licks are drawn as
+    a single LineCollection and FV onset as a cyan line at t=0
+    """
+    axes.plot(time_values, sniff_data, color='k', linewidth=line_width)
+    plot_licks(axes, lick_times)
+    axes.vlines(x=0, ymin=0, ymax=1, color='cyan', linewidth=3.0)
+
+    format_axes(axes, str(trial_name), round(float(trial_min), 4), round(float(trial_max), 4), x_limits,
+                show_x_ticks=True)
+
+
+def plot_licks(axes, lick_times, y_limits=(.8, 1), color='red', line_width=1.2):
+    # One (n_licks, 2, 2) segment array instead of an artist per lick
+    lick_times = np.asarray(lick_times, dtype=np.float64).ravel()
+    segments = np.empty((len(lick_times), 2, 2))
+    segments[:, :, 0] = lick_times[:, np.newaxis]
+    segments[:, :, 1] = y_limits
+
+    axes.add_collection(LineCollection(segments, colors=color, linewidths=line_width), autolim=False)
+
+
+def format_axes(axes, sub_name, ymin_label, ymax_label, x_limits, show_x_ticks, y_line_val=None,
+                reference_line_color='r'):
+    x_minlim, x_maxlim = x_limits
+    axes.set_ylim([0, 1])  # y-values will always be [0, 1]
+
+    if y_line_val is not None:
+        axes.hlines(y=y_line_val, xmin=x_minlim, xmax=x_maxlim,
+                    linestyles=(0, (5, 10)), colors=reference_line_color)
+
+    if not show_x_ticks:
+        axes.tick_params(axis='both', which='both', left=False, bottom=False)
+        axes.set_xticks([], labels=[])
+    else:
+        axes.tick_params(axis='both', which='both', left=False, bottom=True)
+
+    axes.set_xlim([x_minlim, x_maxlim])
+    axes.set_yticks([0, 1], labels=[ymin_label, ymax_label])
+
+    axes.get_yaxis().set_label_coords(-0.1, 0.5)  # Align all the things
+    axes.yaxis.tick_right()
+
+    axes.set_ylabel(f'{sub_name}', rotation=0, va='center', ha='center')
+
+
+def scale_to_range(value, data_min, data_max, feature_range: tuple):
+    # Maps a single original value (e.g. the trace mean) the same way normalize_traces mapped the data
+    _min, _max = feature_range
+    data_range = data_max - data_min
+
+    if data_range == 0:
+        data_range = 1
+
+    return (value - data_min) / data_range * (_max - _min) + _min
+
+
+def rasterize_rows(jobs):
+    """
+    Worker entry point for the render engine. Each job is (key, width, height, dpi, plot_kwargs) where plot_kwargs
+    are the arguments to plot_envelope; returns (key, rgba_bytes, width, height) for every job.
+    """
+    results = []
+
+    for key, width, height, dpi, plot_kwargs in jobs:
+        figure = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+        canvas = FigureCanvasAgg(figure)
+        axes = figure.add_subplot(111)
+        plot_envelope(axes, **plot_kwargs)
+        canvas.draw()
+
+        image_width, image_height = canvas.get_width_height()
+        results.append((key, bytes(canvas.buffer_rgba()), image_width, image_height))
+
+    return results
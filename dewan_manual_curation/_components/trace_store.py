@@ -0,0 +1,241 @@
+""" Cell-major, memory-mapped trace store streamed out of the Inscopix CSV, for recordings that don't fit in RAM """
+import csv
+import json
+import os
+import pathlib
+import shutil
+
+import numpy as np
+
+STORE_VERSION = 1  # Bump whenever the layout or the preprocessing applied during ingest changes
+TRACES_NAME = 'traces.f32'  # Raw float32, n_cells x capacity, row-major so each cell's trace is contiguous
+TIME_NAME = 'time.npy'
+STATS_NAME = 'row_stats.npz'
+META_NAME = 'meta.json'
+INGEST_BLOCK_BYTES = 16 * 2 ** 20  # CSV text parsed per streamed batch; bounds memory while ingesting
+COUNT_CHUNK_BYTES = 16 * 2 ** 20
+
+
+class TraceStore:
+    """
+    A session's traces as an on-disk float32 matrix with one contiguous row per cell, opened read-only with np.memmap
+    so rows are paged in as they're touched rather than loaded up front. Also holds the time index (rounded to 2
+    decimals, like _preprocess_trace_data) and each cell's min/max/mean, which were worked out while ingesting.
+    """
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.meta = json.loads((self.directory / META_NAME).read_text())
+
+        self.cells = self.meta['cells']
+        self.cell_rows = {cell: i for i, cell in enumerate(self.cells)}
+        self.time_name = self.meta['time_name']
+        self.n_samples = self.meta['n_samples']
+
+        capacity = self.meta['capacity']  # Rows were allocated for every line of the CSV; some may be unused
+        traces = np.memmap(self.directory / TRACES_NAME, dtype=np.float32, mode='r',
+                           shape=(len(self.cells), capacity)) if capacity else np.empty((len(self.cells), 0),
+                                                                                        dtype=np.float32)
+        self.traces = traces[:, :self.n_samples]  # Still a view; each row stays contiguous
+        self.time_index = np.load(self.directory / TIME_NAME, mmap_mode='r')
+
+        with np.load(self.directory / STATS_NAME) as stats:
+            self.trace_min, self.trace_max, self.trace_mean = stats['min'], stats['max'], stats['mean']
+
+    def __len__(self):
+        return len(self.cells)
+
+    def save_meta(self):
+        """ Writes self.meta back (e.g. refreshed source signatures); atomic, so a crash leaves the old one """
+        meta_path = self.directory / META_NAME
+        temp_path = meta_path.with_suffix('.tmp')
+        temp_path.write_text(json.dumps(self.meta))
+        os.replace(temp_path, meta_path)
+
+    def rows(self, cell_names):
+        """
+        cells x time rows for cell_names; a zero-copy memmap view when they're a contiguous run of the store (e.g. the
+        whole session), otherwise a RowSelection that only reads the rows it's indexed with
+        """
+        store_rows = self.store_rows(cell_names)
+        if len(store_rows) and np.array_equal(store_rows, np.arange(store_rows[0], store_rows[0] + len(store_rows))):
+            return self.traces[store_rows[0]:store_rows[0] + len(store_rows)]
+
+        return RowSelection(self.traces, store_rows)
+
+    def row_stats(self, cell_names):
+        """ (min, max, mean) for cell_names, as normalize_traces would have worked them out """
+        store_rows = self.store_rows(cell_names)
+        return self.trace_min[store_rows], self.trace_max[store_rows], self.trace_mean[store_rows]
+
+    def runs(self, cell_names, max_rows):
+        """
+        Splits cell_names into runs that sit next to each other in the store, at most max_rows long, so each run's
+        rows are a single memmap view. Yields (position of the run's first cell in cell_names, its cells, its rows).
+        """
+        store_rows = self.store_rows(cell_names)
+        cell_names = list(cell_names)
+
+        first = 0
+        while first < len(cell_names):
+            last = first + 1
+            while last < len(cell_names) and last - first < max_rows and store_rows[last] == store_rows[last - 1] + 1:
+                last += 1
+
+            yield first, cell_names[first:last], self.traces[store_rows[first]:store_rows[last - 1] + 1]
+            first = last
+
+    def store_rows(self, cell_names):
+        return np.array([self.cell_rows[cell] for cell in cell_names], dtype=np.int64)
+
+
+class RowSelection:
+    """
+    Some rows of a (memory-mapped) matrix, indexed like a cells x time array; only the rows asked for are read.
+    Enough of the ndarray interface for the blockwise metrics and correlation code.
+    """
+    def __init__(self, matrix, rows):
+        self.matrix = matrix
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.shape = (len(self.rows), matrix.shape[1])
+        self.dtype = matrix.dtype
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            row_key, *rest = key
+            return self.matrix[(self.rows[row_key], *rest)]
+
+        return self.matrix[self.rows[key]]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.matrix[self.rows], dtype=dtype)
+
+
+def ingest_csv(cell_trace_path, directory, meta=None, block_bytes=INGEST_BLOCK_BYTES):
+    """
+    Streams the Inscopix trace CSV into a TraceStore at directory, one batch of rows at a time, transposing each batch
+    into the cell-major matrix on disk; memory use is bounded by block_bytes, not by the length of the recording.
+    The 'undecided' row is skipped and spaces are stripped from the cell names, as in the in-memory path. meta is kept
+    with the store (e.g. what it was built from). Written to a temporary directory first and moved into place.
+    """
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    cell_trace_path = pathlib.Path(cell_trace_path)
+    directory = pathlib.Path(directory)
+
+    with open(cell_trace_path, newline='') as trace_file:
+        time_name, *cell_columns = next(csv.reader(trace_file))
+    cells = [column.replace(' ', '') for column in cell_columns]
+    n_cells = len(cells)
+
+    # The memmap needs its shape up front; every line past the header and the label row is at most one frame
+    capacity = max(_count_lines(cell_trace_path) - 2, 0)
+
+    temp_directory = directory.with_name(directory.name + '.tmp')
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    temp_directory.mkdir(parents=True)
+
+    traces = np.memmap(temp_directory / TRACES_NAME, dtype=np.float32, mode='w+',
+                       shape=(n_cells, capacity)) if capacity and n_cells else None
+    time_values = np.empty(capacity, dtype=np.float64)
+    trace_min = np.full(n_cells, np.nan, dtype=np.float32)
+    trace_max = np.full(n_cells, np.nan, dtype=np.float32)
+    trace_sum = np.zeros(n_cells, dtype=np.float64)
+    trace_count = np.zeros(n_cells, dtype=np.int64)
+
+    column_types = {time_name: pa.float64()}
+    column_types.update({column: pa.float32() for column in cell_columns})
+    reader = pa_csv.open_csv(cell_trace_path,
+                             read_options=pa_csv.ReadOptions(skip_rows_after_names=1, block_size=block_bytes),
+                             convert_options=pa_csv.ConvertOptions(column_types=column_types))
+
+    n_samples = 0
+    for batch in reader:
+        n_rows = batch.num_rows
+        if n_rows == 0:
+            continue
+
+        time_values[n_samples:n_samples + n_rows] = batch.column(0).to_numpy(zero_copy_only=False)
+
+        block = np.empty((n_cells, n_rows), dtype=np.float32)  # Already transposed; one row per cell
+        for i in range(n_cells):
+            block[i] = batch.column(i + 1).to_numpy(zero_copy_only=False)  # Missing values come through as NaN
+
+        if traces is not None:
+            traces[:, n_samples:n_samples + n_rows] = block
+
+        # fmin/fmax skip NaNs; a cell with no samples at all ends up NaN, as nanmin would leave it
+        np.fmin(trace_min, np.fmin.reduce(block, axis=1), out=trace_min)
+        np.fmax(trace_max, np.fmax.reduce(block, axis=1), out=trace_max)
+        trace_sum += np.nansum(block, axis=1, dtype=np.float64)
+        trace_count += np.count_nonzero(~np.isnan(block), axis=1)
+        n_samples += n_rows
+
+    if traces is not None:
+        traces.flush()
+        del traces
+    else:  # Nothing to map; still leave a file behind so the store opens the same way
+        (temp_directory / TRACES_NAME).touch()
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        trace_mean = trace_sum / trace_count
+
+    np.save(temp_directory / TIME_NAME, np.round(time_values[:n_samples], 2))
+    np.savez(temp_directory / STATS_NAME, min=trace_min, max=trace_max, mean=trace_mean)
+    (temp_directory / META_NAME).write_text(json.dumps({
+        'version': STORE_VERSION,
+        'cells': cells,
+        'time_name': time_name,
+        'n_samples': n_samples,
+        'capacity': capacity if n_cells else 0,
+        'extra': meta or {},
+    }))
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(temp_directory, directory)
+
+    return TraceStore(directory)
+
+
+def open_store(directory):
+    """ The TraceStore at directory, or None if there isn't a complete one from this STORE_VERSION """
+    try:
+        store = TraceStore(directory)
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return store if store.meta.get('version') == STORE_VERSION else None
+
+
+def trace_rows(cell_trace_data, cell_names, dtype=None):
+    """ cells x time rows for cell_names from a preprocessed trace DataFrame or a TraceStore """
+    if isinstance(cell_trace_data, TraceStore):
+        return cell_trace_data.rows(cell_names)
+
+    return cell_trace_data[list(cell_names)].to_numpy(dtype=dtype).T
+
+
+def time_values(cell_trace_data):
+    """ The session's time index, from a preprocessed trace DataFrame or a TraceStore """
+    if isinstance(cell_trace_data, TraceStore):
+        return cell_trace_data.time_index
+
+    return cell_trace_data.index
+
+
+def _count_lines(path):
+    n_lines = 0
+    last_chunk = b''
+
+    with open(path, 'rb') as file:
+        while chunk := file.read(COUNT_CHUNK_BYTES):
+            n_lines += chunk.count(b'\n')
+            last_chunk = chunk
+
+    if last_chunk and not last_chunk.endswith(b'\n'):  # The last line has no newline of its own
+        n_lines += 1
+
+    return n_lines
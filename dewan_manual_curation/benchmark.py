@@ -0,0 +1,303 @@
+"""
+Offscreen benchmark suite for the curation pipeline.
+
+Generates a synthetic session (N cells x T frames of traces, random contours and a max projection image), then times
+each stage a curator waits on and samples the process's resident memory while it runs. Results can be saved as a
+baseline and later runs compared against it. Run it with:
+    QT_QPA_PLATFORM=offscreen python -m dewan_manual_curation.benchmark [--cells 500] [--frames 20000]
+        [--save-baseline baseline.json] [--baseline baseline.json]
+The full 5,000 cells x 100k frames needs about 8 GB of RAM; the trace data alone is 2 GB at that size.
+"""
+import argparse
+import gc
+import json
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from ._components.instrumentation import RssSampler
+
+DEFAULT_CELLS = 500
+DEFAULT_FRAMES = 20000
+DEFAULT_REPEATS = 3  # Best of, for the interactive stages; the heavy stages run once
+DEFAULT_TOLERANCE = 0.25  # Slower than the baseline by more than this fraction counts as a regression...
+NOISE_FLOOR = 0.005  # ...as long as it's also this many seconds slower; millisecond stages jitter by more than 25%
+FRAME_RATE = 20  # Hz; only sets the time column
+CONTOUR_FIELD = (640, 400)  # Width, height the contours are drawn in; the max projection is CONTOUR_SCALE times this
+CELL_RADIUS = (3, 8)
+CONTOUR_VERTICES = (20, 60)
+TIME_COLUMN = 'Time(s)/Cell Status'
+STAGES = ('preprocess_trace_data', 'generate_cell_traces', 'maximum_projection', 'curation_ui', 'select_all',
+          'view_none', 'transfer_view', 'reset_polygon_colors', 'image_levels_preview', 'image_levels',
+          'save_max_projection')
+
+
+# ==Synthetic session== #
+def synthetic_trace_table(n_cells, n_frames, seed=0):
+    """ A pyarrow table laid out like _read_cell_trace_data's (time column, then one float32 column per cell) """
+    import pyarrow as pa
+
+    rng = np.random.default_rng(seed)
+    traces = rng.standard_normal((n_cells, n_frames), dtype=np.float32)
+    np.cumsum(traces, axis=1, out=traces)  # Random walks, generated in place; this is the one full-size array
+    traces *= 0.05
+    transient_frames = rng.integers(0, n_frames, (n_cells, max(n_frames // 2000, 1)))
+    np.put_along_axis(traces, transient_frames, rng.uniform(5, 20, transient_frames.shape).astype(np.float32), axis=1)
+
+    cell_names = cell_name_list(n_cells)
+    times = np.arange(n_frames, dtype=np.float64) / FRAME_RATE
+    columns = [pa.array(times)] + [pa.array(trace) for trace in traces]  # Rows are contiguous, so no copies
+
+    return pa.Table.from_arrays(columns, names=[TIME_COLUMN] + cell_names), cell_names
+
+
+def cell_name_list(n_cells):
+    width = max(len(str(n_cells - 1)), 3)
+    return [f'C{i:0{width}d}' for i in range(n_cells)]
+
+
+def synthetic_contours(cell_names, seed=0):
+    """ A ContourStore of randomly placed, randomly sized polygonal 'circles' """
+    from ._components.contours import ContourStore
+
+    rng = np.random.default_rng(seed + 1)
+    n_cells = len(cell_names)
+    field_width, field_height = CONTOUR_FIELD
+
+    radii = rng.uniform(*CELL_RADIUS, n_cells)
+    centers = np.column_stack((rng.uniform(radii, field_width - radii), rng.uniform(radii, field_height - radii)))
+    lengths = rng.integers(*CONTOUR_VERTICES, n_cells)
+
+    offsets = np.zeros(n_cells + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    owner = np.repeat(np.arange(n_cells), lengths)
+    vertex = np.arange(offsets[-1]) - offsets[owner]
+    angles = 2 * np.pi * vertex / lengths[owner]
+    coordinates = centers[owner] + radii[owner, np.newaxis] * np.column_stack((np.cos(angles), np.sin(angles)))
+
+    return ContourStore(cell_names, coordinates, offsets)
+
+
+def synthetic_max_projection(path, cell_contours, seed=0):
+    """ Writes a 16-bit grayscale image with a bright blob under every cell on a noisy background """
+    from PySide6.QtGui import QImage
+    from ._components.maxprojection import CONTOUR_SCALE
+
+    rng = np.random.default_rng(seed + 2)
+    field_width, field_height = CONTOUR_FIELD
+    image = rng.normal(8000, 1500, (field_height, field_width))
+
+    y, x = np.mgrid[:field_height, :field_width]
+    for cx, cy in cell_contours.centroids():
+        y0, y1 = max(int(cy) - 12, 0), min(int(cy) + 13, field_height)
+        x0, x1 = max(int(cx) - 12, 0), min(int(cx) + 13, field_width)
+        patch_y, patch_x = y[y0:y1, x0:x1], x[y0:y1, x0:x1]
+        image[y0:y1, x0:x1] += 20000 * np.exp(-((patch_x - cx) ** 2 + (patch_y - cy) ** 2) / (2 * 4 ** 2))
+
+    # The HD image is CONTOUR_SCALE times the contour resolution
+    image = np.repeat(np.repeat(image, CONTOUR_SCALE, axis=0), CONTOUR_SCALE, axis=1)
+    pixels = np.ascontiguousarray(np.clip(image, 0, 65535).astype(np.uint16))
+
+    height, width = pixels.shape
+    qimage = QImage(pixels.data, width, height, pixels.strides[0], QImage.Format.Format_Grayscale16)
+    if not qimage.save(str(path)):
+        raise OSError(f'Unable to write {path}')
+
+    return pathlib.Path(path)
+
+
+# ==Stages== #
+def measure(name, function, results, repeats=1):
+    """ Runs function repeats times and records the best time and the peak RSS over all of them in results """
+    gc.collect()
+    best = np.inf
+    return_value = None
+
+    with RssSampler() as sampler:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            return_value = function()
+            best = min(best, time.perf_counter() - start)
+
+    results[name] = {
+        'seconds': best,
+        'peak_rss_mb': _megabytes(sampler.peak_rss),
+        'rss_growth_mb': _megabytes(None if sampler.peak_rss is None else sampler.peak_rss - sampler.start_rss),
+    }
+    return return_value
+
+
+def run_benchmark(n_cells=DEFAULT_CELLS, n_frames=DEFAULT_FRAMES, repeats=DEFAULT_REPEATS, workdir=None, seed=0,
+                  progress=print):
+    """ Returns {stage: {'seconds', 'peak_rss_mb', 'rss_growth_mb'}} for every stage in STAGES, in order """
+    from PySide6.QtCore import QEventLoop
+    from PySide6.QtWidgets import QApplication
+
+    from .gui import ManualCurationUI
+    from .manual_curation import _preprocess_trace_data
+    from ._components.analog_trace import AnalogTrace
+    from ._components.maxprojection import MaximumProjection
+
+    app = QApplication.instance() or QApplication([])
+
+    with tempfile.TemporaryDirectory(dir=workdir) as session_dir:
+        progress(f'Generating {n_cells} cells x {n_frames} frames...')
+        trace_table, cell_names = synthetic_trace_table(n_cells, n_frames, seed)
+        cell_contours = synthetic_contours(cell_names, seed)
+        image_path = synthetic_max_projection(pathlib.Path(session_dir) / 'maxproj.tif', cell_contours, seed)
+
+        results = {}
+
+        def stage(name, function, stage_repeats=1):
+            progress(f'  {name}')
+            value = measure(name, function, results, stage_repeats)
+            app.processEvents()
+            return value
+
+        def interactive(function):  # Includes the repaint the action triggers
+            def run():
+                function()
+                app.processEvents()
+            return run
+
+        cell_trace_data = stage('preprocess_trace_data', lambda: _preprocess_trace_data(trace_table))
+        del trace_table
+        cell_traces = stage('generate_cell_traces',
+                            lambda: AnalogTrace.generate_cell_traces(cell_trace_data, cell_names))
+        del cell_trace_data
+
+        max_projection = stage('maximum_projection',
+                               lambda: MaximumProjection(cell_names, cell_contours, image_path))
+        del max_projection
+
+        def build_window():
+            window = ManualCurationUI(cell_names, cell_traces, cell_contours, image_path, render_workers=0)
+            window.resize(1400, 900)
+            window.show()
+            app.processEvents()  # First layout and paint
+            return window
+
+        window = stage('curation_ui', build_window)
+
+        window.select_none()
+        stage('select_all', interactive(window.select_all), repeats)
+        stage('view_none', interactive(window.view_none), repeats)
+        window.cell_view_model.set_rows_checked(np.arange(0, n_cells, 2), True)  # Something to transfer
+        stage('transfer_view', interactive(window.transfer_view), repeats)
+        stage('reset_polygon_colors', interactive(window.max_projection.reset_polygon_colors), repeats)
+
+        gammas = iter(np.linspace(0.5, 2, 2 * repeats))  # A new setting each time, so no cached tables
+        stage('image_levels_preview',
+              interactive(lambda: window.max_projection.set_levels(gamma=next(gammas), preview=True)), repeats)
+        stage('image_levels', interactive(lambda: window.max_projection.set_levels(gamma=next(gammas))), repeats)
+
+        def save():
+            exporter = window.max_projection.save()
+            loop = QEventLoop()
+            errors = []
+            exporter.finished.connect(loop.quit)
+            exporter.failed.connect(errors.append)
+            exporter.failed.connect(loop.quit)
+            loop.exec()
+            if errors:
+                raise RuntimeError(f'Max projection export failed: {errors[0]}')
+
+        stage('save_max_projection', save)
+
+        window.done(0)
+        window.deleteLater()
+        app.processEvents()
+
+    return results
+
+
+# ==Baselines== #
+def save_baseline(path, results, n_cells, n_frames):
+    baseline = {'cells': n_cells, 'frames': n_frames, 'python': platform.python_version(),
+                'machine': platform.platform(), 'stages': results}
+    pathlib.Path(path).write_text(json.dumps(baseline, indent=2))
+
+
+def load_baseline(path):
+    return json.loads(pathlib.Path(path).read_text())
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """ {stage: time relative to the baseline}, and the stages that got slower than tolerance allows """
+    ratios = {}
+    regressions = []
+    for name, result in results.items():
+        baseline_stage = baseline['stages'].get(name)
+        if not baseline_stage or baseline_stage['seconds'] <= 0:
+            continue
+
+        ratios[name] = result['seconds'] / baseline_stage['seconds']
+        if ratios[name] > 1 + tolerance and result['seconds'] - baseline_stage['seconds'] > NOISE_FLOOR:
+            regressions.append(name)
+
+    return ratios, regressions
+
+
+def format_report(results, baseline=None, tolerance=DEFAULT_TOLERANCE):
+    lines = [f'{"stage":<24}{"time":>12}{"peak RSS":>12}{"growth":>12}' + ('  vs baseline' if baseline else '')]
+    ratios, regressions = compare(results, baseline, tolerance) if baseline else ({}, [])
+
+    for name, result in results.items():
+        line = (f'{name:<24}{_format_seconds(result["seconds"]):>12}{_format_mb(result["peak_rss_mb"]):>12}'
+                f'{_format_mb(result["rss_growth_mb"]):>12}')
+        if name in ratios:
+            line += f'  {ratios[name]:6.2f}x' + ('  SLOWER' if name in regressions else '')
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def _format_seconds(seconds):
+    return f'{seconds * 1000:.1f} ms' if seconds < 1 else f'{seconds:.2f} s'
+
+
+def _format_mb(megabytes):
+    return 'n/a' if megabytes is None else f'{megabytes:.0f} MB'
+
+
+def _megabytes(n_bytes):
+    return None if n_bytes is None else n_bytes / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the curation pipeline on a synthetic session')
+    parser.add_argument('--cells', type=int, default=DEFAULT_CELLS)
+    parser.add_argument('--frames', type=int, default=DEFAULT_FRAMES)
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS,
+                        help='Best of this many runs for the interactive stages')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help='Where the synthetic session is written (a temporary folder by default)')
+    parser.add_argument('--save-baseline', metavar='PATH', help='Write the results to PATH as a baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='Compare against the baseline at PATH')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Fraction slower than the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline) if args.baseline else None
+    if baseline is not None and (baseline['cells'], baseline['frames']) != (args.cells, args.frames):
+        print(f'Warning: the baseline is for {baseline["cells"]} cells x {baseline["frames"]} frames')
+
+    results = run_benchmark(args.cells, args.frames, args.repeats, args.workdir, args.seed)
+
+    print(f'\n{args.cells} cells x {args.frames} frames')
+    print(format_report(results, baseline, args.tolerance))
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results, args.cells, args.frames)
+        print(f'Saved baseline to {args.save_baseline}')
+
+    if baseline is not None and compare(results, baseline, args.tolerance)[1]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
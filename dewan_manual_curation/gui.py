@@ -1,60 +1,96 @@
 from PySide6.QtCore import Qt
 from PySide6.QtGui import QFont, QWheelEvent, QShowEvent
-from PySide6.QtWidgets import (QDialog, QPushButton, QVBoxLayout, QHBoxLayout, QGroupBox, QScrollArea, QSizePolicy,
-                               QGraphicsView, QWidget, QListWidget, QAbstractItemView)
+from PySide6.QtGui import QDoubleValidator
+from PySide6.QtWidgets import (QDialog, QPushButton, QVBoxLayout, QHBoxLayout, QGroupBox, QSizePolicy,
+                               QGraphicsView, QListView, QAbstractItemView, QScrollBar, QProgressBar,
+                               QComboBox, QCheckBox, QLabel, QLineEdit, QSlider, QDoubleSpinBox)
 
-from ._components.analog_trace import AnalogTrace
 from ._components.callbacks import GuiCallbacks
-from ._components.funcs import GuiFuncs
+from ._components.funcs import GuiFuncs, DEFAULT_CLIP_PERCENT
+from ._components.instrumentation import stage, track_interaction
 from ._components.maxprojection import MaximumProjection
 
 
 class ManualCurationUI(GuiFuncs, GuiCallbacks, QDialog):
 
-    def __init__(self, cell_names, cell_traces, cell_contours, maxproj_path):
+    def __init__(self, cell_names, cell_traces, cell_contours, maxproj_path, render_workers=None,
+                 cell_centroids=None, thumbnail_cache=None, memory_budget=None):
 
         super().__init__()
         self.default_font = QFont("Arial", 12)
         self.cells = cell_names
         self.cell_traces = cell_traces
         self.cell_contours = cell_contours
+        self.cell_centroids = cell_centroids
         self.maxproj_path = maxproj_path
+        self.render_workers = render_workers  # Size of the trace rendering process pool; None/0 renders in-process
+        self.thumbnail_cache = thumbnail_cache  # On-disk ThumbnailCache of rendered trace rows, or None
+        self.memory_budget = memory_budget  # MemoryBudget in low-memory mode, or None
 
         #  Cell Selection List Components
-        self.cell_scroll_area = None
         self.cell_list = None
         self.select_all_button = None
         self.select_none_button = None
         self.export_cells_button = None
-        self.cell_selection_checkbox_list = []
-        self.cell_view_checkbox_list = []
+        self.cell_selection_model = None  # Check state of both lists lives in these models' masks
+        self.cell_view_model = None
         # Cell View List Components
         self.cell_view_list = None
-        self.cell_view_scroll_area = None
         self.view_all_button = None
         self.view_none_button = None
         self.transfer_view_button = None
         # Cell Trace List Components
         self.cell_trace_scroll_area_contents = None
         self.cell_trace_scroll_area = None
+        self.cell_trace_model = None
+        self.cell_trace_delegate = None
+        self.render_engine = None
         self.trace_pointers = []
         self.trace_pointers_dict = {}
+        self.stacked_trace_view = None
+        self.stacked_view_button = None
+        self.trace_visible = None  # Boolean mask over the trace rows; drives whichever trace view is showing
+        self.trace_list_hidden = None  # What the list view's rows were last set to
+        # Trace Time Window Controls
+        self.time_zoom_in = None
+        self.time_zoom_out = None
+        self.time_zoom_reset = None
+        self.time_scroll_bar = None
+        self.time_window_length = None
+        # Metric Sort/Filter Controls
+        self.cell_metrics = None
+        self.correlated_pairs = None
+        self.pair_partners = {}  # Cell: (its most correlated flagged neighbor, r)
+        self.filter_passes = None  # Boolean mask over the cells the metric filter lets through
+        self.sort_metric_box = None
+        self.sort_descending_box = None
+        self.filter_metric_box = None
+        self.filter_min_edit = None
+        self.filter_max_edit = None
+        # Session Loading Progress
+        self.load_progress_bar = None
+        self.cancel_load_button = None
+        self.status_label = None  # Problems that don't stop curation, e.g. metrics that couldn't be computed
         #  Layouts
         self.main_layout = None
         self.top_half_container = None
         self.bottom_half_layout = None
         self.cell_list_layout = None
         self.cell_list_control_layout = None
-        self.cell_select_checkbox_layout = None
         self.max_projection_layout = None
         self.max_projection_controls = None
-        self.cell_view_checkbox_layout = None
+        self.max_projection_image_layout = None
+        self.contrast_controls_layout = None
         self.bottom_half_container = None
         self.cell_trace_box_layout = None
         self.cell_trace_contents_layout = None
         self.cell_view_layout = None
         self.cell_view_controls_layout = None
         self.cell_list_control_selection_layout = None
+        self.cell_trace_view_layout = None
+        self.time_controls_layout = None
+        self.load_progress_layout = None
+        self.metric_controls_layout = None
         #  Group Boxes
         self.cell_list_box = None
         self.max_projection_box = None
@@ -66,6 +102,13 @@ class ManualCurationUI(GuiFuncs, GuiCallbacks, QDialog):
         self.zoom_in = None
         self.zoom_out = None
         self.zoom_reset = None
+        #  Max Projection Contrast Controls
+        self.black_level_slider = None
+        self.white_level_slider = None
+        self.gamma_slider = None
+        self.clip_percent_box = None
+        self.auto_contrast_button = None
+        self.reset_contrast_button = None
         #  Image View Components
         self.max_projection_view = None
         self.max_projection = None
@@ -79,19 +122,27 @@ class ManualCurationUI(GuiFuncs, GuiCallbacks, QDialog):
             self._configure_maxproj_view()
         self._populate_cell_traces()
         self._get_trace_pointers()
+        self._configure_time_controls()
 
     #  Function Overloads
     def eventFilter(self, obj, event):
         if type(event) is QWheelEvent:
-            if type(obj) is AnalogTrace:
-                self.cell_trace_scroll_area.wheelEvent(event)
-                return True
-            elif obj is self.max_projection_view.viewport():
+            zooming = event.modifiers() == Qt.KeyboardModifier.ControlModifier
+            if self.max_projection_view is not None and obj is self.max_projection_view.viewport():
+                track_interaction('wheel_zoom_image' if zooming else 'wheel_scroll_image')
                 if event.modifiers() == Qt.KeyboardModifier.ControlModifier:
                     num_degrees = event.angleDelta() / 8
                     steps = int(num_degrees.y() / 15)
                     self._zoom_image(steps)
                     return True
+            elif obj is self.cell_trace_scroll_area.viewport() or (
+                    self.stacked_trace_view is not None and obj is self.stacked_trace_view.viewport()):
+                track_interaction('wheel_zoom_time' if zooming else 'wheel_scroll_traces')
+                if event.modifiers() == Qt.KeyboardModifier.ControlModifier:
+                    steps = int(event.angleDelta().y() / 120)
+                    if steps != 0:
+                        self._zoom_time(0.5 ** steps)  # Each notch halves/doubles the time window
+                    return True
         elif type(event) is QShowEvent and self.max_projection_view is not None and obj is self.max_projection_view.viewport():
             self.max_projection_view.fitInView(self.max_projection.itemsBoundingRect(), Qt.KeepAspectRatio)
             # We don't actually wanna handle this event, just needed to run this with it
@@ -129,13 +180,10 @@ class ManualCurationUI(GuiFuncs, GuiCallbacks, QDialog):
         self.cell_list_layout = QVBoxLayout()
         self.cell_list_box.setLayout(self.cell_list_layout)
 
-        self.cell_list = QWidget()
-        self.cell_select_checkbox_layout = QVBoxLayout(self.cell_list)
+        self.cell_list = QListView()
+        self.cell_list.setUniformItemSizes(True)
         self._populate_selection_list()
-
-        self.cell_scroll_area = QScrollArea()  # Add the scroll area to the layout
-        self.cell_scroll_area.setWidget(self.cell_list)
-        self.cell_list_layout.addWidget(self.cell_scroll_area)
+        self.cell_list_layout.addWidget(self.cell_list)
 
         # ==Cell Selection List Controls== #
         self.cell_list_control_layout = QVBoxLayout()
@@ -183,12 +231,43 @@ class ManualCurationUI(GuiFuncs, GuiCallbacks, QDialog):
             self.max_projection_controls.addWidget(self.zoom_out)
             self.max_projection_controls.addWidget(self.zoom_reset)
             self.max_projection_layout.addLayout(self.max_projection_controls)
-            self.max_projection = MaximumProjection(self.cells, self.cell_contours, self.maxproj_path)
+            with stage('scene_construction'):
+                self.max_projection = MaximumProjection(self.cells, self.cell_contours, self.maxproj_path,
+                                                        self.cell_centroids)
             self.max_projection_view = QGraphicsView()
 
             self.max_projection_view.setScene(self.max_projection)
 
-            self.max_projection_layout.addWidget(self.max_projection_view)
+            self.max_projection_image_layout = QVBoxLayout()
+            self.max_projection_image_layout.addWidget(self.max_projection_view)
+
+            # ==Max Projection Contrast Controls== #
+            self.contrast_controls_layout = QHBoxLayout()
+            self.black_level_slider = QSlider(Qt.Orientation.Horizontal)
+            self.white_level_slider = QSlider(Qt.Orientation.Horizontal)
+            self.gamma_slider = QSlider(Qt.Orientation.Horizontal)
+            self.clip_percent_box = QDoubleSpinBox()
+            self.clip_percent_box.setRange(0, 10)
+            self.clip_percent_box.setSingleStep(0.1)
+            self.clip_percent_box.setValue(DEFAULT_CLIP_PERCENT)
+            self.clip_percent_box.setSuffix(' %')
+            self.clip_percent_box.setToolTip('Pixels clipped to black and to white by Auto')
+            self.auto_contrast_button = QPushButton('Auto')
+            self.reset_contrast_button = QPushButton('Reset')
+
+            for slider in (self.black_level_slider, self.white_level_slider, self.gamma_slider):
+                slider.valueChanged.connect(self.adjust_image_levels)
+                slider.sliderReleased.connect(self.adjust_image_levels)  # Swaps the drag preview for the full image
+            self.auto_contrast_button.clicked.connect(self.auto_contrast)
+            self.reset_contrast_button.clicked.connect(self.reset_contrast)
+
+            for widget in (QLabel('Black'), self.black_level_slider, QLabel('White'), self.white_level_slider,
+                           QLabel('Gamma'), self.gamma_slider, self.clip_percent_box, self.auto_contrast_button,
+                           self.reset_contrast_button):
+                self.contrast_controls_layout.addWidget(widget)
+            self.max_projection_image_layout.addLayout(self.contrast_controls_layout)
+
+            self.max_projection_layout.addLayout(self.max_projection_image_layout)
 
             # Add the list and max projection box to the top half layout
         self.top_half_container.addWidget(self.max_projection_box)
@@ -209,15 +288,12 @@ class ManualCurationUI(GuiFuncs, GuiCallbacks, QDialog):
         # ==Cell View List== #
         self.cell_view_layout = QVBoxLayout()
 
-        self.cell_view_list = QWidget()
-        self.cell_view_checkbox_layout = QVBoxLayout(self.cell_view_list)
+        self.cell_view_list = QListView()
+        self.cell_view_list.setUniformItemSizes(True)
+        self.cell_view_list.setSizePolicy(QSizePolicy.Policy.Minimum, QSizePolicy.Policy.Expanding)
+        self.cell_view_list.setMinimumWidth(100)
         self._populate_view_list()
 
-        self.cell_view_scroll_area = QScrollArea()
-        self.cell_view_scroll_area.setSizePolicy(QSizePolicy.Policy.Minimum, QSizePolicy.Policy.Expanding)
-        self.cell_view_scroll_area.setMinimumWidth(100)
-        self.cell_view_scroll_area.setWidget(self.cell_view_list)
-
         self.cell_view_controls_layout = QHBoxLayout()
         self.view_all_button = QPushButton(u'View All')
         self.view_none_button = QPushButton(u'View None')
@@ -228,20 +304,95 @@ class ManualCurationUI(GuiFuncs, GuiCallbacks, QDialog):
         self.cell_view_controls_layout.addWidget(self.view_all_button)
         self.cell_view_controls_layout.addWidget(self.view_none_button)
 
-        self.cell_view_layout.addWidget(self.cell_view_scroll_area)
+        self.cell_view_layout.addWidget(self.cell_view_list)
         self.cell_view_layout.addLayout(self.cell_view_controls_layout)
         self.cell_view_layout.addWidget(self.transfer_view_button) 
         self.cell_trace_box_layout.addLayout(self.cell_view_layout)
 
         # ==Cell Trace View== #
-        self.cell_trace_scroll_area = QListWidget()
-        self.cell_trace_box_layout.addWidget(self.cell_trace_scroll_area)
-        self.cell_trace_scroll_area.setSizeAdjustPolicy(QListWidget.SizeAdjustPolicy.AdjustToContents)
+        self.cell_trace_view_layout = QVBoxLayout()
+
+        # ==Metric Sort/Filter Controls== #
+        self.metric_controls_layout = QHBoxLayout()
+        self.sort_metric_box = QComboBox()
+        self.sort_metric_box.addItem('Session order', None)
+        self.sort_descending_box = QCheckBox('Descending')
+        self.filter_metric_box = QComboBox()
+        self.filter_metric_box.addItem('No filter', None)
+        self.filter_min_edit = QLineEdit()
+        self.filter_max_edit = QLineEdit()
+
+        for bound_edit, placeholder in ((self.filter_min_edit, 'min'), (self.filter_max_edit, 'max')):
+            bound_edit.setPlaceholderText(placeholder)
+            bound_edit.setValidator(QDoubleValidator())
+            bound_edit.setMaximumWidth(80)
+            bound_edit.editingFinished.connect(self.apply_metric_view)
+
+        self.sort_metric_box.currentIndexChanged.connect(self.apply_metric_view)
+        self.sort_descending_box.toggled.connect(self.apply_metric_view)
+        self.filter_metric_box.currentIndexChanged.connect(self.apply_metric_view)
+
+        for widget in (QLabel('Sort by'), self.sort_metric_box, self.sort_descending_box, QLabel('Filter'),
+                       self.filter_metric_box, self.filter_min_edit, self.filter_max_edit):
+            self.metric_controls_layout.addWidget(widget)
+        self.metric_controls_layout.addStretch(1)
+
+        # One canvas for every trace instead of a row per cell; enabled once the traces are known to support it
+        self.stacked_view_button = QPushButton('Stacked View')
+        self.stacked_view_button.setCheckable(True)
+        self.stacked_view_button.setEnabled(False)
+        self.stacked_view_button.toggled.connect(self.set_stacked_view)
+        self.metric_controls_layout.addWidget(self.stacked_view_button)
+
+        self.cell_trace_view_layout.addLayout(self.metric_controls_layout)
+        self._enable_metric_controls(False)  # Until the metrics arrive
+
+        self.cell_trace_scroll_area = QListView()
+        self.cell_trace_view_layout.addWidget(self.cell_trace_scroll_area)
+        self.cell_trace_scroll_area.setSizeAdjustPolicy(QListView.SizeAdjustPolicy.AdjustToContents)
         self.cell_trace_scroll_area.setSizePolicy(QSizePolicy.Policy.MinimumExpanding,
                                                   QSizePolicy.Policy.MinimumExpanding)
         self.cell_trace_scroll_area.setSpacing(2)
         self.cell_trace_scroll_area.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
         self.cell_trace_scroll_area.verticalScrollBar().setSingleStep(7)
+        self.cell_trace_scroll_area.setUniformItemSizes(True)
+        self.cell_trace_scroll_area.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        self.cell_trace_scroll_area.viewport().installEventFilter(self)
+
+        # ==Trace Time Window Controls== #
+        self.time_controls_layout = QHBoxLayout()
+        self.time_zoom_in = QPushButton("+")
+        self.time_zoom_out = QPushButton("-")
+        self.time_zoom_reset = QPushButton("R")
+        self.time_zoom_in.clicked.connect(self.zoom_time_in)
+        self.time_zoom_out.clicked.connect(self.zoom_time_out)
+        self.time_zoom_reset.clicked.connect(self.reset_time_zoom)
+        self.time_scroll_bar = QScrollBar(Qt.Orientation.Horizontal)
+        self.time_scroll_bar.valueChanged.connect(self.pan_time)
+
+        for button in (self.time_zoom_in, self.time_zoom_out, self.time_zoom_reset):
+            button.setMaximumWidth(40)
+            self.time_controls_layout.addWidget(button)
+        self.time_controls_layout.addWidget(self.time_scroll_bar, 1)
+        self.cell_trace_view_layout.addLayout(self.time_controls_layout)
+
+        # ==Session Loading Progress== #
+        self.load_progress_layout = QHBoxLayout()
+        self.load_progress_bar = QProgressBar()
+        self.cancel_load_button = QPushButton("Cancel")
+        self.cancel_load_button.clicked.connect(self.reject)
+        self.load_progress_layout.addWidget(self.load_progress_bar, 1)
+        self.load_progress_layout.addWidget(self.cancel_load_button)
+        self.cell_trace_view_layout.addLayout(self.load_progress_layout)
+        self.load_progress_bar.hide()  # Only shown while traces are still streaming in
+        self.cancel_load_button.hide()
+
+        self.status_label = QLabel()
+        self.status_label.setWordWrap(True)
+        self.cell_trace_view_layout.addWidget(self.status_label)
+        self.status_label.hide()  # Until there's something to report
+
+        self.cell_trace_box_layout.addLayout(self.cell_trace_view_layout)
 
         self.bottom_half_container.addWidget(self.cell_trace_box)
         self.main_layout.addLayout(self.bottom_half_container)
@@ -252,3 +403,8 @@ class ManualCurationUI(GuiFuncs, GuiCallbacks, QDialog):
     def reject(self):
         self.curated_cells = []
         super().reject()
+
+    def done(self, result):
+        if self.render_engine is not None:
+            self.render_engine.shutdown()
+        super().done(result)
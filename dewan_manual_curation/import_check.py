@@ -0,0 +1,86 @@
+"""
+Import-time budget for the manual curation package.
+
+Runs `python -X importtime -c "import dewan_manual_curation.manual_curation"` in a fresh interpreter and fails if the
+import takes longer than the budget, or if any of the heavy libraries that are meant to load lazily show up during it.
+Run it with:  python -m dewan_manual_curation.import_check [--budget-ms 50] [--module ...]
+"""
+import argparse
+import re
+import subprocess
+import sys
+
+DEFAULT_MODULE = 'dewan_manual_curation.manual_curation'
+DEFAULT_BUDGET_MS = 50
+# These should only be imported once the code path that needs them runs
+LAZY_MODULES = ('PySide6', 'matplotlib', 'pandas', 'pyarrow', 'qdarktheme', 'shapely', 'sklearn')
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def measure_import(module=DEFAULT_MODULE):
+    """ Returns ({name: cumulative_us}, total_us) for everything a cold import of module pulled in """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'Importing {module} failed:\n{result.stderr}')
+
+    entries = []  # (depth, name, cumulative_us) in the order the imports finished
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is not None:
+            _self_us, cumulative_us, indent, name = match.groups()
+            entries.append((len(indent), name, int(cumulative_us)))
+
+    module_index = max(i for i, entry in enumerate(entries) if entry[1] == module)
+    module_depth, _, total_us = entries[module_index]
+
+    # Children finish before their parent and are indented deeper, so walk back from the module's own line;
+    # anything before that at the same depth is interpreter startup (site, encodings, ...)
+    cumulative_times = {module: total_us}
+    for depth, name, cumulative_us in reversed(entries[:module_index]):
+        if depth <= module_depth:
+            break
+        cumulative_times[name] = cumulative_us
+
+    return cumulative_times, total_us
+
+
+def check_import_budget(module=DEFAULT_MODULE, budget_ms=DEFAULT_BUDGET_MS):
+    cumulative_times, total_us = measure_import(module)
+    problems = []
+
+    eager_imports = sorted({name.split('.')[0] for name in cumulative_times} & set(LAZY_MODULES))
+    if eager_imports:
+        problems.append(f'imported eagerly: {", ".join(eager_imports)}')
+
+    total_ms = total_us / 1000
+    if total_ms > budget_ms:
+        problems.append(f'import took {total_ms:.1f} ms, budget is {budget_ms} ms')
+
+    return total_ms, problems, cumulative_times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fail if importing the package regresses past its time budget')
+    parser.add_argument('--module', default=DEFAULT_MODULE)
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS)
+    args = parser.parse_args()
+
+    total_ms, problems, cumulative_times = check_import_budget(args.module, args.budget_ms)
+
+    print(f'{args.module}: {total_ms:.1f} ms (budget {args.budget_ms} ms)')
+    slowest = sorted(cumulative_times.items(), key=lambda item: item[1], reverse=True)[:10]
+    for name, cumulative_us in slowest:
+        print(f'  {cumulative_us / 1000:8.1f} ms  {name}')
+
+    if problems:
+        for problem in problems:
+            print(f'FAIL: {problem}')
+        sys.exit(1)
+
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,26 +6,81 @@ Desc: User interface to enable simultaneous visualization of 1-P calcium fluores
 spatial positioning of different cells. This interface is intended to be launched both from,
 or independent of, the DewanLab InscopixAnalysis.ipynb processing pipeline notebook.
 """
+import logging
 import os
 os.environ['ISX'] = '0'
 
-import qdarktheme
-import pandas as pd
-from PySide6.QtWidgets import QApplication
-
-# Our Libraries
-from .gui import ManualCurationUI
-from ._components.analog_trace import AnalogTrace
-
-import os
+# Qt, pandas, matplotlib and friends are imported inside the functions that use them so importing this module
+# stays cheap; see import_check.py for the budget this is held to
+from ._components import instrumentation
+from ._components.instrumentation import stage
 
 if 'calcium' in os.environ:
     from dewan_calcium.helpers.project_folder import ProjectFolder
     from dewan_calcium.helpers import parse_json
 
 
+DEFAULT_RENDER_WORKERS = max(os.cpu_count() - 1, 1)  # Leave a core for the GUI thread
+CURATED_CELLS_NAME = 'curated_cells.json'  # Written next to the trace file for each session curated from a queue
+
+logger = logging.getLogger(__name__)
+
+
 def launch_gui(root_directory_override=None, project_folder_override=None, cell_trace_data_override=None,
-               cell_props_override=None, cell_contours_override=None):
+               cell_props_override=None, cell_contours_override=None, render_workers=DEFAULT_RENDER_WORKERS,
+               splash=None, use_session_cache=True, export_scale=1.0, export_labeled=True, cell_subset=None,
+               render_backend='matplotlib', find_duplicates=True, duplicate_threshold=None, all_pairs=False,
+               thumbnail_cache_mb=256, instrument=None, memory_budget_mb=None, out_of_core=False):
+    """
+    render_workers sets the size of the trace rendering process pool; pass 0 to render on the GUI thread.
+    render_backend is 'matplotlib' or 'qpainter'; QPainter draws the same rows far quicker (always on the GUI thread,
+    so render_workers is ignored), matplotlib is the one to use for publication-quality output.
+    splash is an optional QSplashScreen that gets progress messages while loading and is closed once the window opens.
+    use_session_cache reuses the prepared session stored in the project folder when none of the inputs changed; it
+    only applies when nothing is overridden.
+    export_scale and export_labeled control the max projection TIFF written after curation (see MaximumProjection.save).
+    The window opens once the cell list and contours are loaded and the traces fill in afterwards; cancelling or
+    closing it before they are all in returns None.
+    cell_subset limits the window to those cells, e.g. the ambiguous cells left over by batch_curate.
+    find_duplicates correlates the traces of neighboring ROIs in the background and flags the pairs at or above
+    duplicate_threshold (correlation.DUPLICATE_THRESHOLD by default) on the max projection; they can then be sorted
+    next to each other in the trace panel. all_pairs compares every pair of cells instead of just neighbors.
+    thumbnail_cache_mb caps the rendered trace rows kept in the project's cache folder, so re-opening a session
+    doesn't re-render rows whose traces haven't changed; pass 0 to turn it off.
+    instrument records how long each launch stage takes and how much memory it uses, plus how quickly the window
+    responds to scrolling and check box toggles, to a JSON log in the folder holding the session's trace file. None
+    (the default) leaves it to the instrumentation.PROFILE_ENV_VAR environment variable.
+    memory_budget_mb turns on low-memory mode: the traces are kept only as one float32 matrix (no cached envelope
+    levels) and rendered rows are only cached in whatever the budget has left over, so memory grows with the rows on
+    screen instead of the number of cells. See memory_budget.MemoryBudget.
+    out_of_core streams the trace CSV into a cell-major float32 memmap in the project's cache folder (reused while
+    the CSV is unchanged) instead of reading it into a DataFrame; the trace panel, metrics and correlations then read
+    cell rows straight from the memmap, so the recording's length isn't limited by RAM. See trace_store.TraceStore.
+    project_folder_override may also be a list of project folders, which are opened one after another; while one is
+    being curated the next one is prepared in a background process (see _launch_queue). Each finished session's
+    curated cells are written to CURATED_CELLS_NAME next to its trace file, and a list with one result per folder is
+    returned. The *_override arguments and cell_subset are per session, so they can't be used with a list.
+    """
+    if isinstance(project_folder_override, (list, tuple)):
+        if cell_trace_data_override is not None or cell_props_override is not None \
+                or cell_contours_override is not None or cell_subset is not None:
+            raise ValueError('Data overrides and cell_subset can\'t be combined with a list of project folders')
+
+        return _launch_queue(project_folder_override, render_workers=render_workers, splash=splash,
+                             use_session_cache=use_session_cache, export_scale=export_scale,
+                             export_labeled=export_labeled, render_backend=render_backend,
+                             find_duplicates=find_duplicates, duplicate_threshold=duplicate_threshold,
+                             all_pairs=all_pairs, thumbnail_cache_mb=thumbnail_cache_mb, instrument=instrument,
+                             memory_budget_mb=memory_budget_mb, out_of_core=out_of_core)
+
+    if instrument is None:
+        instrument = instrumentation.enabled_by_env()
+    profile = instrumentation.Instrumentation() if instrument else None
+    instrumentation.activate(profile)
+
+    import qdarktheme
+    from PySide6.QtWidgets import QApplication
+
     # See if an application exists, if not make our own
     app = QApplication.instance()
     if not app:
@@ -34,41 +89,107 @@ def launch_gui(root_directory_override=None, project_folder_override=None, cell_
     qdarktheme.setup_theme('dark')
 
     if project_folder_override is None:
+        if splash is not None:
+            splash.hide()  # Don't sit on top of the folder picker
         project_folder = ProjectFolder('MAN', root_dir=root_directory_override,
                                        select_dir=True, existing_app=app)
         # If no folder provided, we pick
+        if splash is not None:
+            splash.show()
     else:
         project_folder = project_folder_override
 
-    cell_trace_data, cell_props, cell_contours = get_data(project_folder, cell_trace_data_override,
-                                                          cell_props_override, cell_contours_override)
-    # Load all the raw data
-
-    # There is some preprocessing needed if we load the data from disk
-    # This replicates what is seen in the jupyter notebooks
-    if cell_trace_data_override is None:
-        cell_trace_data = _preprocess_trace_data(cell_trace_data)
-    if cell_props_override is None:
-        cell_props, cell_names = _preprocess_props(cell_props)
-
-    cell_names = cell_props['Name'].values
-
-    cell_traces = AnalogTrace.generate_cell_traces(cell_trace_data, cell_names)
+    _show_progress(splash, 'Loading session data...')
+    from functools import partial
+    from PySide6.QtCore import QEventLoop
+
+    # Traces, props and contours are read concurrently; the window opens as soon as the cells are known and the
+    # traces stream into it afterwards
+    find_pairs = partial(_correlated_pairs, threshold=duplicate_threshold, all_pairs=all_pairs) if find_duplicates \
+        else None
+    loader = _make_session_loader(project_folder, cell_trace_data_override, cell_props_override,
+                                  cell_contours_override, use_session_cache, cell_subset, find_pairs,
+                                  low_memory=memory_budget_mb is not None, out_of_core=out_of_core)
+
+    def splash_progress(done, total, message):
+        _show_splash_message(splash, message)
+
+    loaded_cells = []
+    load_errors = []
+    loop = QEventLoop()
+    loader.progress.connect(splash_progress)
+    loader.cells_ready.connect(lambda *cells: loaded_cells.extend(cells))
+    loader.cells_ready.connect(loop.quit)
+    loader.failed.connect(load_errors.append)  # The loader logs it; once the window is up it's shown there instead
+    loader.failed.connect(loop.quit)
+    loader.start()
+
+    from .gui import ManualCurationUI  # Imported while the files are being read
+    from ._components.analog_trace import StreamingTraceMatrix
+    loop.exec()
+
+    if not loaded_cells:
+        if splash is not None:
+            splash.close()
+        if load_errors:
+            _show_failure(f'Unable to load the session: {load_errors[0]}')
+        _finish_profile(profile, project_folder)
+        return None
 
-    window = ManualCurationUI(cell_names, cell_traces, cell_contours,
-                              project_folder.inscopix_dir.max_projection_path)
+    cell_names, cell_contours, cell_centroids = loaded_cells
+    loader.progress.disconnect(splash_progress)
+
+    _show_progress(splash, 'Building window...')
+    thumbnail_cache = _open_thumbnail_cache(project_folder, thumbnail_cache_mb)
+    with stage('window_construction'):
+        window = ManualCurationUI(cell_names, StreamingTraceMatrix(cell_names, backend=render_backend),
+                                  cell_contours, project_folder.inscopix_dir.max_projection_path, render_workers,
+                                  cell_centroids, thumbnail_cache, _memory_budget(memory_budget_mb))
+    loader.traces_ready.connect(window.add_cell_traces)
+    loader.metrics_ready.connect(window.set_cell_metrics)
+    loader.pairs_ready.connect(window.set_correlated_pairs)
+    loader.progress.connect(window.show_load_progress)
+    loader.finished.connect(window.finish_loading)
+    loader.failed.connect(window.load_failed)
+    loader.warning.connect(window.show_warning)
+    window.rejected.connect(loader.cancel)  # Covers the progress bar's Cancel button and closing the window
+    loader.stream_traces()
 
     window.show()
+    instrumentation.stage_until_idle('first_paint')
+    if profile is not None:
+        profile.start_loop_monitor()
+    if splash is not None:
+        splash.finish(window)
     return_val = app.exec()
 
-    if return_val == 0:  # 0: Success! | 1: Failure!
-        window.max_projection.save()
+    cancelled_while_loading = loader.cancelled
+    loader.cancel()  # Accepted before every trace was in; nothing left to stream
+    if thumbnail_cache is not None:
+        thumbnail_cache.close()  # Lets the last rows finish writing
+        stats = thumbnail_cache.stats()
+        logger.info('Trace thumbnails: %d from cache, %d rendered, %d evicted', stats['hits'], stats['misses'],
+                    stats['evictions'])
+    _finish_profile(profile, project_folder)
+
+    if return_val == 0 and not cancelled_while_loading:  # 0: Success! | 1: Failure!
+        _export_max_projection(window.max_projection, export_scale, export_labeled)
         return window.curated_cells
     else:
         return None
 
 
-def launch_sniff_gui(sniff_traces: list[AnalogTrace], trial_names):
+def launch_sniff_gui(sniff_traces: 'SniffTrialMatrix | list[AnalogTrace]', trial_names=None, memory_budget_mb=None):
+    """
+    sniff_traces is a SniffTrialMatrix (see AnalogTrace.generate_sniff_matrix), whose trials are only plotted as they
+    scroll into view, or a list of already plotted AnalogTraces. trial_names defaults to the matrix's trials.
+    memory_budget_mb is the same low-memory mode as launch_gui's; plotted AnalogTraces are also compressed into PNGs
+    and their figures cleared once the window is up.
+    """
+    import qdarktheme
+    from PySide6.QtWidgets import QApplication
+    from .gui import ManualCurationUI
+
     # See if an application exists, if not make our own
     app = QApplication.instance()
     if not app:
@@ -76,9 +197,11 @@ def launch_sniff_gui(sniff_traces: list[AnalogTrace], trial_names):
 
     qdarktheme.setup_theme('dark')
 
+    if trial_names is None:
+        trial_names = sniff_traces.cells
 
     window = ManualCurationUI(trial_names, sniff_traces, None,
-                              None)
+                              None, memory_budget=_memory_budget(memory_budget_mb))
     window.show()
     return_val = app.exec()
 
@@ -88,26 +211,449 @@ def launch_sniff_gui(sniff_traces: list[AnalogTrace], trial_names):
         return None
 
 
+def curate_headless(project_folder, rules, cell_trace_data_override=None, cell_props_override=None,
+                    cell_contours_override=None, out_of_core=False):
+    """
+    Curates a session without a GUI (no QApplication is created) by applying a declarative rule set to per-cell
+    metrics; see curation_rules.classify_cells for the rule format. rules may also be a path to a JSON rules file.
+    Returns (curated_cells, ambiguous_cells); curated_cells matches what launch_gui returns, and ambiguous_cells are
+    the cells the rules couldn't decide on, to be reviewed with launch_gui(cell_subset=...). out_of_core reads the
+    traces through the memory-mapped trace store, as in launch_gui.
+    """
+    from ._components.contours import ContourStore
+    from ._components.curation_rules import classify_cells, load_rules
+    from ._components.metrics import join_props
+    from ._components.session_cache import source_signatures
+
+    if not isinstance(rules, dict):
+        rules = load_rules(rules)
+
+    nothing_overridden = cell_trace_data_override is None and cell_props_override is None \
+        and cell_contours_override is None
+    sources = source_signatures(project_folder)  # Before anything is read, for the metrics cache
+    if out_of_core and cell_trace_data_override is None:
+        # Passed along like an override (no preprocessing), but it's still this project folder's data
+        cell_trace_data_override = _load_trace_store(project_folder)
+
+    cell_trace_data, cell_props, cell_contours = get_data(project_folder, cell_trace_data_override,
+                                                          cell_props_override, cell_contours_override)
+    if cell_trace_data_override is None:
+        cell_trace_data = _preprocess_trace_data(cell_trace_data)
+    if cell_props_override is None:
+        cell_props, _ = _preprocess_props(cell_props)
+
+    cell_names = list(cell_props['Name'].values)
+    cell_contours = ContourStore.from_dict(cell_names, cell_contours)
+
+    metrics = _cell_metrics(project_folder, sources, cell_trace_data, cell_names, cell_contours,
+                            use_cache=nothing_overridden)
+
+    curated_cells, _, ambiguous_cells = classify_cells(join_props(metrics, cell_props), rules)
+
+    return curated_cells, ambiguous_cells
+
+
+def batch_curate(project_folders, rules, max_workers=None, review_ambiguous=False):
+    """
+    Runs curate_headless over many project folders in a process pool and returns a (curated_cells, ambiguous_cells)
+    pair per folder, in order. With review_ambiguous, each session's ambiguous cells are then opened in the GUI one
+    session at a time and whatever is kept there is added to curated_cells; a session whose review is cancelled
+    gets None instead.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+
+    # Spawn so this is also safe to call from a process that already has a Qt event loop running
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        results = list(executor.map(partial(curate_headless, rules=rules), project_folders))
+
+    if not review_ambiguous:
+        return results
+
+    reviewed_results = []
+    for project_folder, (curated_cells, ambiguous_cells) in zip(project_folders, results):
+        if not ambiguous_cells:
+            reviewed_results.append((curated_cells, []))
+            continue
+
+        reviewed_cells = launch_gui(project_folder_override=project_folder, cell_subset=ambiguous_cells)
+        if reviewed_cells is None:
+            reviewed_results.append(None)
+        else:
+            reviewed_results.append((curated_cells + reviewed_cells, []))
+
+    return reviewed_results
+
+
+def prepare_session(project_folder, use_cache=True):
+    """
+    Loads and preprocesses a session straight from the project folder. The prepared state is stored in a binary
+    bundle under the project folder, so a warm launch skips the CSV/JSON parsing and preprocessing entirely.
+    Returns cell_trace_data, cell_names, cell_contours, cell_centroids.
+    """
+    from ._components.contours import ContourStore
+    from ._components.session_cache import load_session_cache, source_signatures
+
+    session = load_session_cache(project_folder) if use_cache else None
+
+    if session is not None:
+        return _session_from_cache(session)
+
+    sources = source_signatures(project_folder)
+    cell_trace_data, cell_props, cell_contours = get_data(project_folder, None, None, None)
+    with stage('preprocess_trace_data'):
+        cell_trace_data = _preprocess_trace_data(cell_trace_data)
+    cell_props, cell_names = _preprocess_props(cell_props)
+    cell_contours = ContourStore.from_dict(cell_names, cell_contours)
+    cell_centroids = dict(zip(cell_names, map(tuple, cell_contours.centroids())))
+
+    if use_cache:
+        _save_session(project_folder, sources, cell_trace_data, cell_names, cell_contours, cell_centroids)
+
+    return cell_trace_data, cell_names, cell_contours, cell_centroids
+
+
+def _launch_queue(project_folders, splash=None, use_session_cache=True, out_of_core=False, **launch_kwargs):
+    """
+    Curates project_folders in order with launch_gui. The next session's session and metrics caches are filled by a
+    single spawned worker process while the current one is open, so it opens warm; if that fails the GUI just loads it
+    the usual way. A session launch_gui returns None for (closed before its traces were in) gets None, nothing is
+    saved for it, and the queue moves on.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    project_folders = list(project_folders)
+    results = []
+
+    # Spawn rather than fork; forking a process that is running a Qt event loop is not safe
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as prefetcher:
+        prefetch = None
+
+        for i, project_folder in enumerate(project_folders):
+            if prefetch is not None:
+                _wait_for_prefetch(prefetch)
+
+            has_next = i + 1 < len(project_folders)
+            prefetch = prefetcher.submit(_prefetch_session, project_folders[i + 1], out_of_core) \
+                if has_next and use_session_cache else None
+
+            curated_cells = launch_gui(project_folder_override=project_folder, splash=splash if i == 0 else None,
+                                       use_session_cache=use_session_cache, out_of_core=out_of_core,
+                                       **launch_kwargs)
+            if curated_cells is not None:
+                _save_curated_cells(project_folder, curated_cells)
+
+            results.append(curated_cells)
+
+    return results
+
+
+def _prefetch_session(project_folder, out_of_core=False):
+    # Runs in the prefetch process; only the on-disk caches are kept, nothing is sent back
+    from ._components.session_cache import source_signatures
+
+    sources = source_signatures(project_folder)
+    if out_of_core:
+        from ._components.contours import ContourStore
+
+        cell_trace_data = _load_trace_store(project_folder)
+        cell_names = _load_cell_names(project_folder, None)
+        cell_contours = ContourStore.from_dict(cell_names, _load_cell_contours(project_folder, None))
+    else:
+        cell_trace_data, cell_names, cell_contours, _ = prepare_session(project_folder)
+
+    _cell_metrics(project_folder, sources, cell_trace_data, cell_names, cell_contours)
+
+
+def _wait_for_prefetch(prefetch):
+    if not prefetch.done():
+        logger.info('Waiting for the next session to finish preparing...')
+
+    try:
+        prefetch.result()
+    except Exception as e:  # Includes a broken pool or a project folder that can't be pickled
+        # Not worth interrupting the user for; the next session just loads the usual way
+        logger.warning('Unable to prepare the next session in the background: %r', e)
+
+
+def _save_curated_cells(project_folder, curated_cells):
+    import json
+    import pathlib
+
+    save_path = pathlib.Path(project_folder.inscopix_dir.cell_trace_path).parent / CURATED_CELLS_NAME
+    try:
+        save_path.write_text(json.dumps(curated_cells, indent=2))
+    except OSError as e:  # The session's window is already closed, so this gets a message box of its own
+        logger.warning('Unable to save the curated cells to %s: %s', save_path, e)
+        _show_failure(f'Unable to save the curated cells to {save_path}: {e}')
+        return
+
+    logger.info('Curated cells written to %s', save_path)
+
+
+def _finish_profile(profile, project_folder):
+    instrumentation.activate(None)
+    if profile is None:
+        return
+
+    import pathlib
+
+    profile.stop_loop_monitor()
+    try:
+        log_path = profile.write(pathlib.Path(project_folder.inscopix_dir.cell_trace_path).parent)
+    except OSError as e:
+        logger.warning('Unable to write the profile log: %s', e)
+        return
+
+    logger.info('Profile written to %s', log_path)
+
+
+def _memory_budget(max_mb):
+    if max_mb is None:
+        return None
+
+    from ._components.memory_budget import MemoryBudget
+
+    return MemoryBudget(int(max_mb * 2 ** 20))
+
+
+def _open_thumbnail_cache(project_folder, max_mb):
+    if not max_mb:
+        return None
+
+    from ._components.session_cache import cache_dir
+    from ._components.thumbnail_cache import ThumbnailCache, THUMBNAIL_DIR_NAME
+
+    try:
+        return ThumbnailCache(cache_dir(project_folder) / THUMBNAIL_DIR_NAME, max_bytes=int(max_mb * 2 ** 20))
+    except OSError as e:  # e.g. a read-only project folder; rows are just rendered every time
+        logger.warning('Unable to open the trace thumbnail cache: %s', e)
+        return None
+
+
+def _make_session_loader(project_folder, cell_trace_data_override, cell_props_override, cell_contours_override,
+                         use_session_cache, cell_subset=None, find_pairs=None, low_memory=False, out_of_core=False):
+    from functools import partial
+    from ._components.session_cache import load_session_cache, source_signatures
+    from ._components.session_loader import SessionLoader
+
+    nothing_overridden = cell_trace_data_override is None and cell_props_override is None \
+        and cell_contours_override is None
+    use_session_cache = use_session_cache and nothing_overridden
+    # Only a full session is worth caching
+    update_cache = use_session_cache and cell_subset is None
+    sources = source_signatures(project_folder) if nothing_overridden else None  # Before the loader reads anything
+    load_metrics = partial(_cell_metrics, project_folder, sources, use_cache=use_session_cache,
+                           update_cache=update_cache)
+
+    if out_of_core and cell_trace_data_override is None:
+        # The store is the trace cache here; the session bundle would hold another full copy of the matrix
+        return SessionLoader(partial(_load_trace_store, project_folder, reuse=use_session_cache),
+                             partial(_load_cell_names, project_folder, cell_props_override, cell_subset),
+                             partial(_load_cell_contours, project_folder, cell_contours_override),
+                             load_metrics=load_metrics, find_pairs=find_pairs)
+
+    with stage('read_session_cache'):
+        session = load_session_cache(project_folder) if use_session_cache else None
+
+    if session is not None:  # Everything is already prepared; the loader just streams the traces out
+        cell_trace_data, cell_names, cell_contours, cell_centroids = _session_from_cache(session)
+        return SessionLoader(lambda: cell_trace_data, partial(_filter_cells, cell_names, cell_subset),
+                             lambda: cell_contours, cell_centroids, load_metrics=load_metrics, find_pairs=find_pairs,
+                             low_memory=low_memory)
+
+    return SessionLoader(partial(_load_cell_trace_data, project_folder, cell_trace_data_override),
+                         partial(_load_cell_names, project_folder, cell_props_override, cell_subset),
+                         partial(_load_cell_contours, project_folder, cell_contours_override),
+                         save_session=partial(_save_session, project_folder, sources) if update_cache else None,
+                         load_metrics=load_metrics, find_pairs=find_pairs, low_memory=low_memory)
+
+
+def _cell_metrics(project_folder, sources, cell_trace_data, cell_names, cell_contours, use_cache=True,
+                  update_cache=None):
+    """
+    Per-cell metrics DataFrame for cell_names, read from the metrics cache when every cell is already in it.
+    update_cache (defaults to use_cache) controls whether freshly computed metrics are written back; sources are the
+    session_cache.source_signatures taken before the data was read.
+    """
+    import numpy as np
+    import pandas as pd
+    from ._components.metrics import compute_cell_metrics, sampling_rate
+    from ._components.session_cache import load_metrics_cache, save_metrics_cache
+    from ._components.trace_store import time_values, trace_rows
+
+    cell_names = list(cell_names)
+    cached_metrics = load_metrics_cache(project_folder, cell_names) if use_cache else None
+    if cached_metrics is not None:
+        return pd.DataFrame(cached_metrics, index=pd.Index(cell_names, name='Name'))
+
+    with stage('cell_metrics'):
+        trace_matrix = trace_rows(cell_trace_data, cell_names, dtype=np.float32)
+        metrics = compute_cell_metrics(cell_names, trace_matrix, cell_contours,
+                                       sampling_rate=sampling_rate(time_values(cell_trace_data)))
+
+    if use_cache if update_cache is None else update_cache:
+        save_metrics_cache(project_folder, cell_names, {column: metrics[column] for column in metrics}, sources)
+
+    return metrics
+
+
+def _correlated_pairs(cell_trace_data, cell_names, cell_contours, threshold=None, all_pairs=False):
+    import numpy as np
+    from ._components.correlation import DUPLICATE_THRESHOLD, find_correlated_pairs
+    from ._components.trace_store import trace_rows
+
+    # One float32 copy of a DataFrame's traces (a view for a TraceStore); find_correlated_pairs then only adds a
+    # standardized block at a time on top of it
+    trace_matrix = trace_rows(cell_trace_data, cell_names, dtype=np.float32)
+    threshold = DUPLICATE_THRESHOLD if threshold is None else threshold
+
+    with stage('correlated_pairs'):
+        return find_correlated_pairs(cell_names, trace_matrix, cell_contours, threshold, all_pairs=all_pairs)
+
+
+def _session_from_cache(session):
+    import pandas as pd
+    from ._components.contours import ContourStore
+
+    cell_names = session['cell_names'].tolist()
+    time_index = pd.Index(session['time_index'], name=session['time_name'])
+    cell_trace_data = pd.DataFrame(session['trace_matrix'].T, index=time_index, columns=cell_names)
+    cell_contours = ContourStore(cell_names, session['contour_coordinates'], session['contour_offsets'])
+    cell_centroids = dict(zip(cell_names, map(tuple, session['centroids'])))
+
+    return cell_trace_data, cell_names, cell_contours, cell_centroids
+
+
+def _save_session(project_folder, sources, cell_trace_data, cell_names, cell_contours, cell_centroids):
+    import numpy as np
+    from ._components.session_cache import save_session_cache
+
+    with stage('write_session_cache'):
+        save_session_cache(project_folder, {
+            'trace_matrix': cell_trace_data[cell_names].to_numpy(dtype=np.float32).T,
+            'time_index': cell_trace_data.index.to_numpy(dtype=np.float64),
+            'time_name': str(cell_trace_data.index.name),
+            'cell_names': np.asarray(cell_names, dtype=str),
+            'contour_coordinates': cell_contours.coordinates,
+            'contour_offsets': cell_contours.offsets,
+            'centroids': np.array([cell_centroids[cell] for cell in cell_names], dtype=np.float64),
+        }, sources)
+
+
 def get_data(project_folder, cell_trace_data_override, cell_props_override, cell_contours_override):
     if cell_trace_data_override is None:
-        cell_trace_data = pd.read_csv(project_folder.inscopix_dir.cell_trace_path, engine='pyarrow')
+        with stage('read_cell_trace_data'):
+            cell_trace_data = _read_cell_trace_data(project_folder.inscopix_dir.cell_trace_path)
     else:
         cell_trace_data = cell_trace_data_override
 
     if cell_props_override is None:
-        cell_props = pd.read_csv(project_folder.inscopix_dir.props_path, header=0, engine='pyarrow')
+        with stage('read_cell_props'):
+            cell_props = _read_cell_props(project_folder.inscopix_dir.props_path)
     else:
         cell_props = cell_props_override
 
-    if cell_contours_override is None:
-        cell_contours = parse_json.get_outline_coordinates(project_folder.inscopix_dir.contours_path)
-    else:
-        cell_contours = cell_contours_override
+    cell_contours = _load_cell_contours(project_folder, cell_contours_override)
 
     return cell_trace_data, cell_props, cell_contours
 
 
+def _load_cell_trace_data(project_folder, cell_trace_data_override):
+    # Overrides are used as-is; anything read from disk gets the notebook preprocessing
+    if cell_trace_data_override is not None:
+        return cell_trace_data_override
+
+    with stage('read_cell_trace_data'):
+        cell_trace_data = _read_cell_trace_data(project_folder.inscopix_dir.cell_trace_path)
+    with stage('preprocess_trace_data'):
+        return _preprocess_trace_data(cell_trace_data)
+
+
+def _load_trace_store(project_folder, reuse=True):
+    from ._components.session_cache import build_trace_store, load_trace_store
+
+    with stage('read_trace_store'):
+        trace_store = load_trace_store(project_folder) if reuse else None
+    if trace_store is None:
+        with stage('ingest_cell_trace_data'):
+            trace_store = build_trace_store(project_folder)
+
+    return trace_store
+
+
+def _load_cell_names(project_folder, cell_props_override, cell_subset=None):
+    if cell_props_override is None:
+        with stage('read_cell_props'):
+            cell_props, _ = _preprocess_props(_read_cell_props(project_folder.inscopix_dir.props_path))
+    else:
+        cell_props = cell_props_override
+
+    return _filter_cells(cell_props['Name'].values, cell_subset)
+
+
+def _filter_cells(cell_names, cell_subset):
+    # Keeps the session's own cell order
+    if cell_subset is None:
+        return cell_names
+
+    cell_subset = set(cell_subset)
+    return [cell for cell in cell_names if cell in cell_subset]
+
+
+def _load_cell_contours(project_folder, cell_contours_override):
+    if cell_contours_override is not None:
+        return cell_contours_override
+
+    with stage('read_cell_contours'):
+        return parse_json.get_outline_coordinates(project_folder.inscopix_dir.contours_path)
+
+
+def _read_cell_props(props_path):
+    import pandas as pd
+
+    return pd.read_csv(props_path, header=0, engine='pyarrow')
+
+
+def _read_cell_trace_data(cell_trace_path):
+    """
+    Reads the Inscopix trace CSV as a typed pyarrow Table. The row of 'undecided' labels under the header is skipped
+    at parse time, so every cell column can be declared float32 up front instead of being read as strings and
+    converted afterwards. Spaces are stripped from the cell names once, on the schema.
+    """
+    import csv
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    with open(cell_trace_path, newline='') as trace_file:
+        time_name, *cell_columns = next(csv.reader(trace_file))
+
+    column_types = {time_name: pa.float64()}
+    column_types.update({column: pa.float32() for column in cell_columns})
+
+    cell_trace_table = pa_csv.read_csv(cell_trace_path,
+                                       read_options=pa_csv.ReadOptions(skip_rows_after_names=1),
+                                       convert_options=pa_csv.ConvertOptions(column_types=column_types))
+
+    return cell_trace_table.rename_columns([time_name] + [column.replace(" ", "") for column in cell_columns])
+
+
 def _preprocess_trace_data(cell_trace_data):
+    import numpy as np
+    import pandas as pd
+
+    if not isinstance(cell_trace_data, pd.DataFrame):  # Typed table from _read_cell_trace_data
+        # Round the times to 2 decimal places and use them as the index so the listed data is all dF/F values
+        time_index = pd.Index(np.round(cell_trace_data.column(0).to_numpy(), 2), name=cell_trace_data.column_names[0])
+        # The cell columns are all float32, so this converts into a single block
+        cell_trace_data = cell_trace_data.remove_column(0).to_pandas()
+        cell_trace_data.index = time_index
+
+        return cell_trace_data
+
+    # An untyped frame read some other way (e.g. pd.read_csv in a notebook)
     # Drop the first row which contains all 'undecided' labels which is the Inscopix default label.
     cell_trace_data = cell_trace_data.drop([0])
     # Force all dF/F values to be numbers and round times to 2 decimal places
@@ -131,3 +677,56 @@ def _preprocess_props(cell_props):
 
     return cell_props, cell_names
 
+
+
+def _export_max_projection(max_projection, scale, labeled):
+    # The main loop has already returned, so run a local one until the tiled export is written
+    from PySide6.QtCore import QEventLoop
+    from PySide6.QtWidgets import QProgressDialog
+
+    exporter = max_projection.save(scale, labeled)
+
+    progress_dialog = QProgressDialog('Exporting max projection...', 'Cancel', 0, exporter.n_tiles)
+    progress_dialog.setMinimumDuration(500)
+    progress_dialog.canceled.connect(exporter.cancel)
+    exporter.progress.connect(lambda done, total: progress_dialog.setValue(done))
+
+    loop = QEventLoop()
+    exporter.finished.connect(loop.quit)
+    exporter.aborted.connect(lambda: logger.info('Max projection export cancelled'))
+    exporter.aborted.connect(loop.quit)
+    export_errors = []
+    exporter.failed.connect(export_errors.append)
+    exporter.failed.connect(loop.quit)
+    loop.exec()
+
+    progress_dialog.close()
+    if export_errors:
+        logger.warning('Max projection export failed: %s', export_errors[0])
+        _show_failure(f'Max projection export failed: {export_errors[0]}')
+
+
+def _show_failure(message):
+    # For failures after the curation window has closed (or before it opened), where there's no status area to use
+    from PySide6.QtWidgets import QMessageBox
+
+    QMessageBox.warning(None, 'Dewan Manual Curation', message)
+
+
+def _show_progress(splash, message):
+    if splash is None:
+        return
+
+    from PySide6.QtWidgets import QApplication
+
+    _show_splash_message(splash, message)
+    QApplication.processEvents()  # Nothing else is pumping events while we load
+
+
+def _show_splash_message(splash, message):
+    if splash is None:
+        return
+
+    from PySide6.QtCore import Qt
+
+    splash.showMessage(message, Qt.AlignmentFlag.AlignBottom | Qt.AlignmentFlag.AlignHCenter, Qt.GlobalColor.white)
@@ -0,0 +1,79 @@
+"""
+Per-trace rendering benchmark for the trace panel's backends.
+
+Renders the same rows of a synthetic session with each backend in RENDER_BACKENDS (whole-trace view, at the panel's
+row size) and reports the time per trace. Run it with:
+    python -m dewan_manual_curation.render_benchmark [--cells 50] [--samples 20000] [--repeats 3]
+Set QT_QPA_PLATFORM=offscreen to run it without a display.
+"""
+import argparse
+import time
+
+import numpy as np
+
+DEFAULT_CELLS = 50
+DEFAULT_SAMPLES = 20000
+DEFAULT_REPEATS = 3
+
+
+def synthetic_traces(n_cells, n_samples, seed=0):
+    # Random walks with a few transients; the look doesn't matter, only how many points end up on screen
+    rng = np.random.default_rng(seed)
+    traces = np.cumsum(rng.normal(0, 1, (n_cells, n_samples)), axis=1)
+    traces[:, ::997] += rng.uniform(20, 60, (n_cells, 1))
+    return traces.astype(np.float32)
+
+
+def time_backend(trace_matrix, backend, size, repeats):
+    """ Returns every per-trace render time (s) for one backend, best of repeats for each row """
+    per_trace = np.full((repeats, len(trace_matrix)), np.inf)
+
+    for repeat in range(repeats):
+        for row in range(len(trace_matrix)):
+            start = time.perf_counter()
+            trace_matrix.render(row, size, backend=backend)
+            per_trace[repeat, row] = time.perf_counter() - start
+
+    return per_trace.min(axis=0)
+
+
+def run_benchmark(n_cells=DEFAULT_CELLS, n_samples=DEFAULT_SAMPLES, repeats=DEFAULT_REPEATS):
+    """ Returns {backend: per-trace times (s)} """
+    from PySide6.QtWidgets import QApplication
+    from ._components.analog_trace import CELL_TRACE_SIZE, RENDER_BACKENDS, TraceMatrix
+
+    _app = QApplication.instance() or QApplication([])  # AnalogTrace is a widget, and QPainter needs one for fonts
+
+    cell_names = [f'C{i:03d}' for i in range(n_cells)]
+    trace_matrix = TraceMatrix(cell_names, synthetic_traces(n_cells, n_samples))
+
+    results = {}
+    for backend in RENDER_BACKENDS:
+        trace_matrix.render(0, CELL_TRACE_SIZE, backend=backend)  # Warm up fonts and caches
+        results[backend] = time_backend(trace_matrix, backend, CELL_TRACE_SIZE, repeats)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the per-trace render time of the trace panel backends')
+    parser.add_argument('--cells', type=int, default=DEFAULT_CELLS)
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES)
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    args = parser.parse_args()
+
+    results = run_benchmark(args.cells, args.samples, args.repeats)
+
+    print(f'{args.cells} traces x {args.samples} samples, best of {args.repeats}')
+    for backend, per_trace in results.items():
+        print(f'  {backend:>10}: {np.median(per_trace) * 1000:7.2f} ms/trace median, '
+              f'{np.percentile(per_trace, 95) * 1000:7.2f} ms p95')
+
+    baseline = np.median(results['matplotlib'])
+    for backend, per_trace in results.items():
+        if backend != 'matplotlib':
+            print(f'  {backend} is {baseline / np.median(per_trace):.1f}x matplotlib')
+
+
+if __name__ == '__main__':
+    main()